@@ -0,0 +1,229 @@
+# async_database.py
+#
+# Awaitable versions of the database.py functions. Every call runs on one
+# dedicated database thread, so a slow SQLite commit never blocks the event
+# loop, and all writes go through a single connection in submission order.
+#
+# Writes are group-committed: calls arriving within BATCH_WINDOW seconds (or
+# up to BATCH_MAX_OPS of them) share one transaction, and each caller still
+# gets its own result or exception. A read commits the writes queued before it
+# first, so it never sees the database as it was before them.
+
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Single worker: SQLite allows one writer at a time anyway, and a single
+# thread keeps one warm connection from database.get_connection().
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+# Group commit tuning
+BATCH_WINDOW = 0.002  # Seconds to wait for more writes before committing
+BATCH_MAX_OPS = 256   # Commit immediately once this many writes are queued
+
+DB_CALL_SECONDS = metrics.histogram(
+    'bot_db_call_seconds', 'Seconds a database call took, including the wait for the database thread.',
+    ('op', 'kind'), buckets=metrics.FAST_BUCKETS)
+DB_BATCH_SIZE = metrics.histogram(
+    'bot_db_batch_operations', 'Writes committed per group commit.', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+async def _run(func, *args, **kwargs):
+    """Run a blocking database.py function on the database thread."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    if _batcher._pending:
+        # Queued on the database thread ahead of the read, which then sees these writes
+        _batcher._flush()
+    try:
+        return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+    finally:
+        DB_CALL_SECONDS.labels(func.__name__, 'read').observe(time.perf_counter() - start)
+
+class _WriteBatcher:
+    """Collects write calls from many handlers and commits them together."""
+
+    def __init__(self):
+        self._pending = []
+        self._timer = None
+        self.batches = 0
+        self.operations = 0
+
+    async def submit(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((func, args, kwargs, future))
+        if len(self._pending) >= BATCH_MAX_OPS:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(BATCH_WINDOW, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        self.batches += 1
+        self.operations += len(batch)
+        DB_BATCH_SIZE.observe(len(batch))
+        # While this batch commits on the database thread, new writes queue up for the next one
+        operations = [(func, args, kwargs) for func, args, kwargs, _ in batch]
+        done = asyncio.get_running_loop().run_in_executor(_executor, database.run_batch, operations)
+        done.add_done_callback(lambda done: self._resolve(batch, done))
+
+    @staticmethod
+    def _resolve(batch, done):
+        if done.exception() is not None:
+            for *_, future in batch:
+                if not future.done():
+                    future.set_exception(done.exception())
+            return
+        for (*_, future), (error, result) in zip(batch, done.result()):
+            if future.done():
+                continue  # Caller was cancelled; the write still happened
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'average_batch_size': self.operations / self.batches if self.batches else 0.0,
+            'queued': len(self._pending),
+        }
+
+_batcher = _WriteBatcher()
+
+metrics.gauge('bot_db_executor_queue_depth', 'Calls waiting for the database thread.',
+              callback=lambda: _executor._work_queue.qsize())
+metrics.gauge('bot_db_writes_pending', 'Writes waiting for the next group commit.',
+              callback=lambda: len(_batcher._pending))
+
+async def _write(func, *args, **kwargs):
+    """Queue a write for the next group commit."""
+    start = time.perf_counter()
+    try:
+        return await _batcher.submit(func, *args, **kwargs)
+    finally:
+        DB_CALL_SECONDS.labels(func.__name__, 'write').observe(time.perf_counter() - start)
+
+async def initialize_database():
+    """Initialize the SQLite database and create the users, ledger and cache tables."""
+    return await _run(database.initialize_database)
+
+async def ping():
+    """Check that the database answers; used by readiness checks."""
+    return await _run(database.ping)
+
+async def get_user(user_id):
+    """Retrieve user data from the database, creating the user if missing (a write, ordered after queued writes)."""
+    return await _run(database.get_user, user_id)
+
+async def update_user(user_id, free_interactions_used=None, indecent_credits=None):
+    """Update user data in the database."""
+    return await _write(database.update_user, user_id, free_interactions_used=free_interactions_used, indecent_credits=indecent_credits)
+
+async def add_credits(user_id, credits_to_add):
+    """Add Indecent Credits to a user's balance."""
+    return await _write(database.add_credits, user_id, credits_to_add)
+
+async def apply_payment(user_id, charge_id, credits):
+    """Credit a purchase exactly once. See database.apply_payment()."""
+    return await _write(database.apply_payment, user_id, charge_id, credits)
+
+async def consume_credit(user_id):
+    """Consume one Indecent Credit from a user's balance."""
+    return await _write(database.consume_credit, user_id)
+
+async def increment_free_interactions(user_id):
+    """Increment the count of free interactions used by the user."""
+    return await _write(database.increment_free_interactions, user_id)
+
+async def charge_interaction(user_id, free_limit, cost):
+    """Charge one interaction atomically. See database.charge_interaction()."""
+    return await _write(database.charge_interaction, user_id, free_limit, cost)
+
+async def apply_deltas(deltas):
+    """Apply batched balance changes in one transaction. See database.apply_deltas()."""
+    return await _write(database.apply_deltas, deltas)
+
+async def reconcile_ledger():
+    """Compare balances with their ledger sums. See database.reconcile_ledger()."""
+    return await _run(database.reconcile_ledger)
+
+async def get_cached_response(cache_key, now):
+    """Look up a cached LLM response. See database.get_cached_response()."""
+    return await _run(database.get_cached_response, cache_key, now)
+
+async def store_cached_response(cache_key, model, response, expires_at, now):
+    """Store an LLM response in the persistent cache."""
+    return await _write(database.store_cached_response, cache_key, model, response, expires_at, now)
+
+async def evict_cached_responses(max_bytes, now):
+    """Trim the persistent response cache. See database.evict_cached_responses()."""
+    return await _write(database.evict_cached_responses, max_bytes, now)
+
+async def get_tts_entry(cache_key, now):
+    """Look up a TTS cache entry. See database.get_tts_entry()."""
+    return await _run(database.get_tts_entry, cache_key, now)
+
+async def store_tts_entry(cache_key, path=None, size=None, file_id=None, now=0.0):
+    """Create or update a TTS cache entry."""
+    return await _write(database.store_tts_entry, cache_key, path=path, size=size, file_id=file_id, now=now)
+
+async def forget_tts_file_id(cache_key):
+    """Drop a stale Telegram file_id from the TTS cache."""
+    return await _write(database.forget_tts_file_id, cache_key)
+
+async def evict_tts_files(max_bytes):
+    """Release least recently used TTS audio files. See database.evict_tts_files()."""
+    return await _write(database.evict_tts_files, max_bytes)
+
+async def get_conversation(user_id):
+    """Load a user's conversation summary and turns. See database.get_conversation()."""
+    return await _run(database.get_conversation, user_id)
+
+async def append_conversation_turns(user_id, turns, ring_size):
+    """Store conversation turns in the user's ring buffer."""
+    return await _write(database.append_conversation_turns, user_id, turns, ring_size)
+
+async def store_conversation_summary(user_id, summary, tokens, summarized_through):
+    """Replace a user's rolling conversation summary."""
+    return await _write(database.store_conversation_summary, user_id, summary, tokens, summarized_through)
+
+async def clear_conversation(user_id):
+    """Forget a user's conversation history."""
+    return await _write(database.clear_conversation, user_id)
+
+async def get_persistent_data(kind, owner_id):
+    """Load the stored keys of one user, chat or the bot. See database.get_persistent_data()."""
+    return await _run(database.get_persistent_data, kind, owner_id)
+
+async def store_persistent_data(kind, owner_id, changed, removed):
+    """Write changed keys and delete removed keys of one user, chat or the bot."""
+    return await _write(database.store_persistent_data, kind, owner_id, changed, removed)
+
+async def drop_persistent_data(kind, owner_id):
+    """Delete everything stored for one user, chat or the bot."""
+    return await _write(database.drop_persistent_data, kind, owner_id)
+
+def batch_stats():
+    """Group commit counters: batches committed, operations and queue length."""
+    return _batcher.stats()
+
+def shutdown():
+    """Wait for queued database work to finish and close the connection."""
+    _executor.submit(database.close_connections).result()
+    _executor.shutdown(wait=True)
+    logger.debug("Database thread shut down.")
@@ -0,0 +1,140 @@
+# audio.py
+#
+# Bounded-memory buffers for synthesized speech. Provider chunks are written
+# to a spooled temp file that stays in memory up to SPOOL_MAX_MEMORY and rolls
+# over to disk beyond it. A per-request meter records the most audio held in
+# memory at once, and MP3 can be re-encoded to OGG/Opus with ffmpeg, when it
+# is installed, so Telegram gets a real voice note.
+
+import asyncio
+import contextvars
+import logging
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import concurrency
+
+logger = logging.getLogger(__name__)
+
+SPOOL_MAX_MEMORY = 256 * 1024  # Bytes of audio kept in memory before spilling to disk
+CHUNK_SIZE = 64 * 1024
+OPUS_BITRATE = '32k'
+FFMPEG = shutil.which('ffmpeg')
+
+_meter = contextvars.ContextVar('audio_meter', default=None)
+_stats = {'spools': 0, 'rolled_to_disk': 0, 'max_request_peak': 0}
+
+class MemoryMeter:
+    """Audio bytes currently held in memory for one request, and the peak."""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()  # gTTS writes from an executor thread
+
+    def add(self, delta):
+        with self._lock:
+            self.current += delta
+            self.peak = max(self.peak, self.current)
+
+@contextmanager
+def metered():
+    """Meter every AudioSpool created in this context, including tasks and executor calls it starts."""
+    meter = MemoryMeter()
+    token = _meter.set(meter)
+    try:
+        yield meter
+    finally:
+        _meter.reset(token)
+        _stats['max_request_peak'] = max(_stats['max_request_peak'], meter.peak)
+
+class AudioSpool:
+    """A file-like audio buffer that holds at most max_memory bytes in RAM."""
+
+    def __init__(self, extension='mp3', max_memory=SPOOL_MAX_MEMORY):
+        self.name = f"voice.{extension}"  # Lets Telegram guess the MIME type
+        self.max_memory = max_memory
+        self.size = 0
+        self._file = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        self._in_memory = 0
+        self._meter = _meter.get()
+        _stats['spools'] += 1
+
+    def _account(self, in_memory):
+        if self._meter is not None and in_memory != self._in_memory:
+            self._meter.add(in_memory - self._in_memory)
+        self._in_memory = in_memory
+
+    def write(self, data):
+        self._file.write(data)
+        self.size += len(data)
+        if self.size <= self.max_memory:
+            self._account(self.size)
+        elif self._in_memory:
+            # SpooledTemporaryFile has just moved everything to disk
+            _stats['rolled_to_disk'] += 1
+            self._account(0)
+        return len(data)
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self._file.seek(offset, whence)
+
+    def tell(self):
+        return self._file.tell()
+
+    def close(self):
+        self._account(0)
+        self._file.close()
+
+async def to_opus(source):
+    """
+    Re-encode audio (e.g. gTTS MP3) to OGG/Opus with ffmpeg, streaming through
+    pipes into a new spool. Closes `source` and returns the new AudioSpool, or
+    None if encoding failed. Only call this when FFMPEG is set.
+    """
+    target = AudioSpool('ogg')
+    async with concurrency.limit('ffmpeg'):
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG, '-loglevel', 'error', '-i', 'pipe:0', '-c:a', 'libopus', '-b:a', OPUS_BITRATE,
+            '-application', 'voip', '-f', 'ogg', 'pipe:1',
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+
+        async def feed():
+            try:
+                source.seek(0)
+                while chunk := source.read(CHUNK_SIZE):
+                    process.stdin.write(chunk)
+                    await process.stdin.drain()
+            finally:
+                process.stdin.close()
+
+        feeder = asyncio.create_task(feed())
+        stderr = asyncio.create_task(process.stderr.read())
+        while chunk := await process.stdout.read(CHUNK_SIZE):
+            target.write(chunk)
+        try:
+            await feeder
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg exited early; its return code says why
+        returncode = await process.wait()
+
+    if returncode != 0:
+        logger.warning(f"ffmpeg Opus encoding failed ({returncode}): {(await stderr).decode(errors='replace').strip()}")
+        target.close()
+        source.close()
+        return None
+    source.close()
+    target.seek(0)
+    return target
+
+def stats():
+    """Spool counters and the largest per-request peak of in-memory audio bytes."""
+    return dict(_stats)
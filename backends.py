@@ -0,0 +1,370 @@
+# backends.py
+#
+# Routing and hedging across LLM backends.
+#
+# BackendRouter tracks each backend's rolling error rate and latency, trips a
+# circuit breaker after repeated failures, lets a few half-open probe requests
+# through once the breaker cools down, and routes each request to the
+# healthiest backends.
+#
+# Hedging: the primary backend gets a head start. If it hasn't produced output
+# by the hedge delay (a percentile of its recent latency), the secondary is
+# started too, the first one to answer wins and the other is cancelled. A
+# primary failure starts the secondary immediately.
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+class BackendError(Exception):
+    """Raised when every backend failed or timed out."""
+
+# Circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+class CircuitBreaker:
+    """Opens after consecutive failures; after `reset_timeout` lets probe requests through."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, half_open_max_calls=1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probes_in_flight = 0
+        self.times_opened = 0
+
+    def available(self):
+        """Whether a request may be sent now (moves OPEN to HALF_OPEN once cooled down)."""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = HALF_OPEN
+            self.probes_in_flight = 0
+        if self.state == HALF_OPEN:
+            return self.probes_in_flight < self.half_open_max_calls
+        return self.state == CLOSED
+
+    def begin(self):
+        if self.state == HALF_OPEN:
+            self.probes_in_flight += 1
+
+    def abandon(self):
+        """The request was cancelled before it finished; it proves nothing."""
+        if self.state == HALF_OPEN and self.probes_in_flight > 0:
+            self.probes_in_flight -= 1
+
+    def record_success(self):
+        self.consecutive_failures = 0
+        self.state = CLOSED
+        self.probes_in_flight = 0
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != OPEN:
+                self.times_opened += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.probes_in_flight = 0
+
+class Backend:
+    """
+    An LLM backend. `call(*args)` is an async function returning the reply text
+    (None or empty counts as a failure), or, for streaming backends, an async
+    iterator of text chunks. `timeout` bounds the time to the full reply (or to
+    each streamed chunk).
+
+    Health samples older than `window_seconds` are dropped, so a backend that was
+    routed around because of old samples gets traffic again once they expire.
+    """
+
+    def __init__(self, name, call, timeout=60.0, window=200, window_seconds=300.0, breaker=None):
+        self.name = name
+        self.call = call
+        self.timeout = timeout
+        self.window_seconds = window_seconds
+        self._latencies = deque(maxlen=window)  # (timestamp, seconds) of recent successes
+        self._outcomes = deque(maxlen=window)   # (timestamp, succeeded) of recent requests
+        self.breaker = breaker or CircuitBreaker()
+
+    def _prune(self):
+        cutoff = time.monotonic() - self.window_seconds
+        for samples in (self._latencies, self._outcomes):
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+
+    @property
+    def latencies(self):
+        """Recent successful latencies in seconds."""
+        self._prune()
+        return [latency for _, latency in self._latencies]
+
+    @property
+    def outcomes(self):
+        """Recent request results, True for success."""
+        self._prune()
+        return [succeeded for _, succeeded in self._outcomes]
+
+    def latency_percentile(self, percentile):
+        """Return the given percentile (0-1) of recent latencies, or None without samples."""
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return None
+        return latencies[min(int(percentile * len(latencies)), len(latencies) - 1)]
+
+    @property
+    def error_rate(self):
+        outcomes = self.outcomes
+        if not outcomes:
+            return 0.0
+        return outcomes.count(False) / len(outcomes)
+
+    def record_success(self, latency):
+        now = time.monotonic()
+        if self.breaker.state != CLOSED:
+            # Recovered: judge it on fresh samples, not the outage
+            self._outcomes.clear()
+            logger.info("Circuit closed after a successful probe", extra={'backend': self.name})
+        self._latencies.append((now, latency))
+        self._outcomes.append((now, True))
+        self.breaker.record_success()
+
+    def record_failure(self):
+        self._outcomes.append((time.monotonic(), False))
+        was_open = self.breaker.state == OPEN
+        self.breaker.record_failure()
+        if self.breaker.state == OPEN and not was_open:
+            logger.warning(f"Circuit for backend {self.name} opened after {self.breaker.consecutive_failures} consecutive failures.")
+
+    def stats(self):
+        p50 = self.latency_percentile(0.5)
+        p95 = self.latency_percentile(0.95)
+        return {
+            'state': self.breaker.state,
+            'error_rate': round(self.error_rate, 3),
+            'p50_latency': round(p50, 3) if p50 is not None else None,
+            'p95_latency': round(p95, 3) if p95 is not None else None,
+            'samples': len(self.outcomes),
+            'times_opened': self.breaker.times_opened,
+        }
+
+class HedgePolicy:
+    """When to start the secondary backend, based on the primary's latency history."""
+
+    def __init__(self, percentile=0.95, min_samples=20, initial_delay=5.0, min_delay=0.5, max_delay=30.0, enabled=True):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay  # Used until the primary has min_samples latencies
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.enabled = enabled
+
+    def delay(self, primary):
+        """Seconds to wait for the primary before hedging; None disables hedging."""
+        if not self.enabled:
+            return None
+        if len(primary.latencies) < self.min_samples:
+            return self.initial_delay
+        return min(max(primary.latency_percentile(self.percentile), self.min_delay), self.max_delay)
+
+# Counters per "primary->secondary" pair
+_stats = {}
+
+LLM_SECONDS = metrics.histogram(
+    'bot_llm_seconds', 'Seconds until an LLM backend produced its first output or failed.', ('backend', 'outcome'))
+HEDGE_EVENTS = metrics.counter(
+    'bot_llm_hedge_events_total', 'Hedged LLM requests by backend pair and event (hedges_fired, fallbacks, ...).', ('pair', 'event'))
+
+def _count(primary, secondary, key):
+    pair = f"{primary.name}->{secondary.name}" if secondary else primary.name
+    counters = _stats.setdefault(pair, {
+        'requests': 0, 'hedges_fired': 0, 'fallbacks': 0,
+        'primary_wins': 0, 'secondary_wins': 0, 'failures': 0,
+    })
+    counters[key] += 1
+    HEDGE_EVENTS.labels(pair, key).inc()
+
+def hedge_stats():
+    """Return hedging counters, including how often the hedge fired."""
+    stats = {}
+    for pair, counters in _stats.items():
+        stats[pair] = dict(counters)
+        stats[pair]['hedge_rate'] = counters['hedges_fired'] / counters['requests'] if counters['requests'] else 0.0
+    return stats
+
+async def _first_result(backend, args):
+    """Run a non-streaming backend; returns (None, text)."""
+    text = await asyncio.wait_for(backend.call(*args), backend.timeout)
+    if not text:
+        raise BackendError(f"{backend.name} returned no response")
+    return None, text
+
+async def _first_chunk(backend, args):
+    """Start a streaming backend; returns (iterator, first chunk)."""
+    iterator = backend.call(*args).__aiter__()
+    try:
+        while True:
+            chunk = await asyncio.wait_for(iterator.__anext__(), backend.timeout)
+            if chunk:
+                return iterator, chunk
+    except StopAsyncIteration:
+        raise BackendError(f"{backend.name} returned no response")
+    except BaseException:
+        await iterator.aclose()
+        raise
+
+async def _attempt(backend, args, start_backend):
+    """Run one backend and feed the outcome into its health tracking."""
+    backend.breaker.begin()
+    start = time.monotonic()
+    try:
+        result = await start_backend(backend, args)
+    except asyncio.CancelledError:
+        backend.breaker.abandon()
+        LLM_SECONDS.labels(backend.name, 'cancelled').observe(time.monotonic() - start)
+        raise
+    except Exception:
+        backend.record_failure()
+        LLM_SECONDS.labels(backend.name, 'failure').observe(time.monotonic() - start)
+        raise
+    latency = time.monotonic() - start
+    backend.record_success(latency)
+    LLM_SECONDS.labels(backend.name, 'success').observe(latency)
+    return result
+
+async def _race(primary, secondary, args, policy, start_backend):
+    """Run the hedge and return (winner, iterator, first output)."""
+    _count(primary, secondary, 'requests')
+    tasks = {asyncio.ensure_future(_attempt(primary, args, start_backend)): primary}
+    secondary_started = secondary is None
+
+    try:
+        if not secondary_started:
+            done, _ = await asyncio.wait(tasks, timeout=policy.delay(primary))
+            if not done and policy.enabled:
+                logger.debug("No output yet, hedging", extra={'backend': primary.name, 'seconds': round(policy.delay(primary), 2), 'hedge': secondary.name})
+                _count(primary, secondary, 'hedges_fired')
+                tasks[asyncio.ensure_future(_attempt(secondary, args, start_backend))] = secondary
+                secondary_started = True
+
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                backend = tasks.pop(task)
+                if task.exception() is None:
+                    _count(primary, secondary, 'primary_wins' if backend is primary else 'secondary_wins')
+                    iterator, output = task.result()
+                    return backend, iterator, output
+
+                logger.warning(f"{backend.name} failed: {task.exception()!r}")
+                if backend is primary and not secondary_started:
+                    # Plain fallback: the primary failed before the hedge fired
+                    _count(primary, secondary, 'fallbacks')
+                    tasks[asyncio.ensure_future(_attempt(secondary, args, start_backend))] = secondary
+                    secondary_started = True
+    finally:
+        # Cancel the loser (or everything, if we were cancelled ourselves)
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                iterator, _ = await task
+            except BaseException:
+                continue
+            if iterator is not None:
+                await iterator.aclose()
+
+    _count(primary, secondary, 'failures')
+    names = f"{primary.name} and {secondary.name}" if secondary else primary.name
+    raise BackendError(f"{names} failed")
+
+async def hedged_call(primary, secondary, *args, policy):
+    """Return the first successful reply from two non-streaming backends (secondary may be None)."""
+    _, _, text = await _race(primary, secondary, args, policy, _first_result)
+    return text
+
+async def hedged_stream(primary, secondary, *args, policy):
+    """Yield the reply of whichever streaming backend produces output first (secondary may be None)."""
+    winner, iterator, chunk = await _race(primary, secondary, args, policy, _first_chunk)
+    try:
+        yield chunk
+        while True:
+            try:
+                chunk = await asyncio.wait_for(iterator.__anext__(), winner.timeout)
+            except StopAsyncIteration:
+                break
+            yield chunk
+    finally:
+        await iterator.aclose()
+
+class BackendRouter:
+    """
+    Picks the primary and secondary backend for each request.
+
+    Backends are listed in order of preference. The preferred order is kept while
+    backends are healthy; a backend whose circuit is open is skipped, and one whose
+    error rate or p95 latency is over the limits is moved behind healthy ones.
+    Unhealthy backends keep serving as the hedge/fallback, and their old samples
+    expire, so they are retried as primary after Backend.window_seconds.
+    """
+
+    def __init__(self, backends, policy, max_error_rate=0.5, max_p95_latency=None, min_samples=10):
+        self.backends = list(backends)
+        self.policy = policy
+        self.max_error_rate = max_error_rate
+        self.max_p95_latency = max_p95_latency
+        self.min_samples = min_samples
+        self.decisions = {}  # "primary->secondary" -> count
+
+    def healthy(self, backend):
+        if backend.breaker.state == HALF_OPEN:
+            return True  # Let the probe decide
+        if len(backend.outcomes) < self.min_samples:
+            return True
+        if backend.error_rate > self.max_error_rate:
+            return False
+        p95 = backend.latency_percentile(0.95)
+        return self.max_p95_latency is None or p95 is None or p95 <= self.max_p95_latency
+
+    def route(self):
+        """Return the backends to try, best first."""
+        available = [backend for backend in self.backends if backend.breaker.available()]
+        if not available:
+            # Everything is open: probe the backend whose breaker opened first
+            return sorted(self.backends, key=lambda backend: backend.breaker.opened_at)[:1]
+        # A half-open backend keeps its place so it gets a real probe request; the
+        # hedge to the next backend bounds the latency cost if the probe is slow.
+        return sorted(available, key=lambda backend: (not self.healthy(backend), self.backends.index(backend)))
+
+    def _pick(self):
+        ordered = self.route()
+        primary = ordered[0]
+        secondary = ordered[1] if len(ordered) > 1 else None
+        decision = f"{primary.name}->{secondary.name}" if secondary else primary.name
+        self.decisions[decision] = self.decisions.get(decision, 0) + 1
+        return primary, secondary
+
+    async def call(self, *args):
+        """Get a full reply, hedged across the two best backends."""
+        primary, secondary = self._pick()
+        return await hedged_call(primary, secondary, *args, policy=self.policy)
+
+    async def stream(self, *args):
+        """Stream a reply, hedged across the two best backends."""
+        primary, secondary = self._pick()
+        async for chunk in hedged_stream(primary, secondary, *args, policy=self.policy):
+            yield chunk
+
+    def stats(self):
+        """Per-backend health and circuit state, plus how requests were routed."""
+        return {
+            'backends': {backend.name: dict(backend.stats(), healthy=self.healthy(backend)) for backend in self.backends},
+            'routing': dict(self.decisions),
+        }
@@ -0,0 +1,74 @@
+# benchmarks/bench_async_database.py
+#
+# Shows that a slow SQLite commit stalls every other update when database.py
+# is called directly from a handler, but not when it goes through
+# async_database. Commits are slowed artificially to make the effect visible.
+#
+# Usage: python benchmarks/bench_async_database.py
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import database
+import async_database
+
+logging.disable(logging.CRITICAL)
+
+SLOW_COMMIT_SECONDS = 0.2
+TICK_SECONDS = 0.005
+
+def slow_charge_interaction(user_id, free_limit, cost):
+    time.sleep(SLOW_COMMIT_SECONDS)  # Simulate a commit waiting on a busy disk
+    return _charge_interaction(user_id, free_limit, cost)
+
+_charge_interaction = database.charge_interaction
+
+async def unrelated_updates(stop):
+    """Stand-in for other users' updates: record how late each tick runs."""
+    worst = 0.0
+    while not stop.is_set():
+        expected = time.perf_counter() + TICK_SECONDS
+        await asyncio.sleep(TICK_SECONDS)
+        worst = max(worst, time.perf_counter() - expected)
+    return worst
+
+async def measure(label, charge):
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(unrelated_updates(stop))
+    await asyncio.sleep(TICK_SECONDS * 2)
+    for user_id in range(3):
+        await charge(user_id)
+    stop.set()
+    worst = await ticker
+    print(f"{label:<16} worst delay of unrelated updates: {worst * 1000:7.1f} ms")
+    return worst
+
+async def main():
+    database.charge_interaction = slow_charge_interaction
+
+    async def blocking_charge(user_id):
+        database.charge_interaction(user_id, 10, 1)
+
+    async def async_charge(user_id):
+        await async_database.charge_interaction(user_id, 10, 1)
+
+    blocking = await measure('direct database', blocking_charge)
+    offloaded = await measure('async_database', async_charge)
+    if offloaded >= SLOW_COMMIT_SECONDS or offloaded >= blocking:
+        print("FAIL: slow commits still delay unrelated updates")
+        return 1
+    print("OK: slow commits no longer delay unrelated updates")
+    return 0
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILENAME = os.path.join(tmp, 'bench.db')
+        database.initialize_database()
+        status = asyncio.run(main())
+        async_database.shutdown()
+    sys.exit(status)
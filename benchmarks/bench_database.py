@@ -0,0 +1,90 @@
+# benchmarks/bench_database.py
+#
+# Compares the old connect-per-call database access with the pooled
+# connection layer in database.py, replaying the queries a paid message makes,
+# and with the single-call charge_interaction().
+#
+# Usage: python benchmarks/bench_database.py [operations]
+
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import database
+
+logging.disable(logging.CRITICAL)
+
+def legacy_get_user(user_id):
+    """The original get_user: fresh connection and default journal settings."""
+    conn = sqlite3.connect(database.DB_FILENAME)
+    cursor = conn.cursor()
+    cursor.execute('SELECT free_interactions_used, indecent_credits FROM users WHERE user_id = ?', (user_id,))
+    result = cursor.fetchone()
+    if result is None:
+        cursor.execute('INSERT INTO users (user_id, indecent_credits) VALUES (?, ?)', (user_id, 0))
+        conn.commit()
+        result = (0, 0)
+    conn.close()
+    return {'free_interactions_used': result[0], 'indecent_credits': result[1]}
+
+def legacy_update_credits(user_id, indecent_credits):
+    conn = sqlite3.connect(database.DB_FILENAME)
+    conn.execute('UPDATE users SET indecent_credits = ? WHERE user_id = ?', (indecent_credits, user_id))
+    conn.commit()
+    conn.close()
+
+def legacy_paid_message(user_id):
+    legacy_get_user(user_id)
+    # consume_credit() used to re-read the user before writing
+    user = legacy_get_user(user_id)
+    legacy_update_credits(user_id, user['indecent_credits'] - 1)
+
+def pooled_paid_message(user_id):
+    database.get_user(user_id)
+    database.consume_credit(user_id)
+
+def charged_paid_message(user_id):
+    database.charge_interaction(user_id, 0, 1)
+
+def seed(users, credits):
+    """Insert users with a raw connection so the journal mode is left untouched."""
+    conn = sqlite3.connect(database.DB_FILENAME)
+    conn.execute('CREATE TABLE IF NOT EXISTS users (user_id INTEGER PRIMARY KEY, free_interactions_used INTEGER DEFAULT 0, indecent_credits INTEGER DEFAULT 0)')
+    # The credit ledger that debits are recorded in; seeded balances count as opening entries
+    conn.execute('CREATE TABLE IF NOT EXISTS transactions (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, kind TEXT NOT NULL, '
+                 'credits INTEGER NOT NULL, charge_id TEXT UNIQUE, created_at REAL NOT NULL)')
+    conn.execute('CREATE INDEX IF NOT EXISTS transactions_user ON transactions (user_id, credits)')
+    conn.executemany("INSERT INTO transactions (user_id, kind, credits, created_at) VALUES (?, 'opening', ?, 0)",
+                     [(user_id, credits) for user_id in range(users)])
+    conn.executemany('INSERT INTO users (user_id, indecent_credits) VALUES (?, ?)', [(user_id, credits) for user_id in range(users)])
+    conn.commit()
+    conn.close()
+
+def run(label, paid_message, operations, users=100):
+    seed(users, operations)
+    start = time.perf_counter()
+    for i in range(operations):
+        paid_message(i % users)
+    elapsed = time.perf_counter() - start
+    print(f"{label:<10} {operations / elapsed:>10.0f} messages/sec  ({elapsed * 1000 / operations:.3f} ms/message)")
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with tempfile.TemporaryDirectory() as tmp:
+        # Legacy run against a database in the default rollback-journal mode
+        database.DB_FILENAME = os.path.join(tmp, 'legacy.db')
+        run('before', legacy_paid_message, operations)
+
+        database.DB_FILENAME = os.path.join(tmp, 'pooled.db')
+        run('pooled', pooled_paid_message, operations)
+
+        database.DB_FILENAME = os.path.join(tmp, 'charged.db')
+        run('atomic', charged_paid_message, operations)
+        database.close_connections()
+
+if __name__ == '__main__':
+    main()
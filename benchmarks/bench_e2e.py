@@ -0,0 +1,309 @@
+# benchmarks/bench_e2e.py
+#
+# End-to-end benchmark of the real message handlers. The bot module
+# (telegramBot.py or buybot.py) is imported with its API endpoints pointed at
+# the local stand-ins in fake_services.py, its Application is started without
+# polling, and synthetic users put text updates on its update queue: each
+# user sends a message, waits for the reply, thinks, and sends the next.
+#
+# Reported per update, as count/p50/p95/p99/max:
+#   end_to_end      update queued -> handler finished
+#   first_reply     update queued -> first sendMessage/sendVoice reaches Telegram
+#   llm, tts        first request start -> last response end at the fake providers
+#   telegram        time spent in Bot API calls for the update's chat
+# plus throughput, error replies and the fake services' request counts.
+#
+# Results are compared with benchmarks/baselines/<bot>-<profile>.json when it
+# exists; --save-baseline writes it. Record baselines on the machine that runs
+# the comparison, since absolute numbers depend on the hardware.
+#
+# Usage: python benchmarks/bench_e2e.py [--bot telegramBot|buybot] [--profile fast|realistic|degraded]
+#        [--users 50] [--messages 4] [--think 0.5] [--audio-share 0.25]
+#        [--openai-error-rate R] [--replicate-error-rate R] [--tts-error-rate R] [--telegram-flood-rate R]
+#        [--no-send-limits] [--save-baseline] [--check] [--tolerance 0.1] [--profiler SECONDS]
+
+import argparse
+import asyncio
+import copy
+import datetime
+import importlib
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+import fake_services
+import log_pipeline
+import profiler
+
+BASELINE_DIR = os.path.join(os.path.dirname(__file__), 'baselines')
+FIRST_USER_ID = 1000
+STAGES = ('end_to_end', 'first_reply', 'llm', 'tts', 'telegram')
+REPLY_METHODS = ('sendMessage', 'sendVoice', 'sendAudio')
+
+def percentile(values, fraction):
+    index = min(len(values) - 1, max(0, round(fraction * len(values)) - 1))
+    return values[index]
+
+def summarize(values):
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'p50': statistics.median(values),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': values[-1],
+    }
+
+def build_profiles(args):
+    profiles = copy.deepcopy(fake_services.PROFILES[args.profile])
+    overrides = {
+        'openai': args.openai_error_rate,
+        'replicate': args.replicate_error_rate,
+        'elevenlabs': args.tts_error_rate,
+        'gtts': args.tts_error_rate,
+        'telegram': args.telegram_flood_rate,
+    }
+    for name, rate in overrides.items():
+        if rate is not None:
+            profiles.setdefault(name, fake_services.Profile()).error_rate = rate
+    return profiles
+
+def import_bot(name, services, tmp):
+    """Import the bot module against the fake services and a scratch database."""
+    os.environ.update({
+        'TELEGRAM_BOT_TOKEN': '123456:bench',
+        'TELEGRAM_API_BASE_URL': services.url('telegram') + '/bot',
+        'OPENAI_API_KEY': 'bench',
+        'OPENAI_BASE_URL': services.url('openai') + '/v1',
+        'REPLICATE_API_TOKEN': 'bench',
+        'REPLICATE_BASE_URL': services.url('replicate'),
+        'ELEVENLABS_API_KEY': 'bench',
+        'ELEVENLABS_BASE_URL': services.url('elevenlabs'),
+        'METRICS_PORT': '0',
+    })
+    import database
+    import tts_cache
+    database.DB_FILENAME = os.path.join(tmp, 'bench.db')
+    tts_cache.CACHE_DIR = os.path.join(tmp, 'tts_cache')
+
+    # gTTS builds an https URL from a Google domain; send it to the fake instead
+    import gtts.tts
+    gtts.tts._translate_url = lambda tld='com', path='': f"{services.url('gtts')}/{path}"
+
+    bot = importlib.import_module(name)
+    bot.configure()
+
+    # Keep the bot's logging setup (its cost is part of what is measured) but write it to a file
+    log_path = os.path.join(tmp, 'bot.log')
+    log_pipeline.configure(
+        level=bot.LOG_LEVEL,
+        levels=log_pipeline.parse_levels(bot.LOG_LEVELS),
+        sample_rates=log_pipeline.parse_rates(bot.LOG_SAMPLE_RATES),
+        json_format=bot.LOG_FORMAT == 'json',
+        filename=log_path,
+    )
+    return bot, log_path
+
+async def run_load(bot, args):
+    from telegram import Chat, Message, Update, User
+    from telegram.ext import TypeHandler
+    import async_database
+    import outbound
+
+    if args.no_send_limits:
+        outbound.configure(global_rate=1e6, global_burst=1000000, chat_rate=1e6, chat_burst=1000000)
+
+    done = {}
+
+    async def finished(update, context):
+        event = done.get(update.update_id)
+        if event is not None:
+            event.set()
+
+    application = bot.build_application()
+    application.add_handler(TypeHandler(Update, finished), group=100)  # Runs after the bot's handlers
+
+    # The Application.run_polling lifecycle, minus the updater
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    users = list(range(FIRST_USER_ID, FIRST_USER_ID + args.users))
+    for index, user_id in enumerate(users):
+        await async_database.add_credits(user_id, 1000000)
+        if index < args.audio_share * args.users:
+            application.user_data[user_id]['audio_enabled'] = True
+
+    timings = {}  # (user_id, message) -> (queued, finished)
+    update_ids = iter(range(1, 10 ** 9))
+
+    async def user(user_id):
+        await asyncio.sleep(random.uniform(0, args.ramp))
+        sender = User(user_id, f"user{user_id}", False)
+        chat = Chat(user_id, Chat.PRIVATE)
+        for number in range(args.messages):
+            update_id = next(update_ids)
+            text = f"u{user_id}m{number} tell me something about topic {random.randint(1, 10 ** 6)}"
+            message = Message(update_id, datetime.datetime.now(datetime.timezone.utc), chat, from_user=sender, text=text)
+            message.set_bot(application.bot)
+            update = Update(update_id, message=message)
+            done[update_id] = asyncio.Event()
+            queued = time.perf_counter()
+            await application.update_queue.put(update)
+            await done[update_id].wait()
+            timings[(user_id, number)] = (queued, time.perf_counter())
+            del done[update_id]
+            await asyncio.sleep(random.expovariate(1 / args.think) if args.think > 0 else 0)
+
+    profile = asyncio.create_task(profiler.profile(args.profiler)) if args.profiler else None
+    start = time.perf_counter()
+    await asyncio.gather(*(user(user_id) for user_id in users))
+    elapsed = time.perf_counter() - start
+    if profile is not None:
+        profiler.stop()  # If the load finished first
+        print(profiler.format_summary(await profile))
+
+    import http_pool
+    print("HTTP pools: " + ', '.join(f"{name} {pool['requests']} requests / {pool['connections']} connections"
+                                     for name, pool in sorted(http_pool.stats().items())))
+
+    await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+    return timings, elapsed
+
+def analyze(bot, records, timings, elapsed):
+    by_tag = {}
+    by_chat = {}
+    for record in records:
+        if record.end is None:
+            continue
+        if record.tag is not None:
+            by_tag.setdefault(record.tag, []).append(record)
+        if record.service == 'telegram' and record.chat_id is not None:
+            by_chat.setdefault(record.chat_id, []).append(record)
+
+    stages = {stage: [] for stage in STAGES}
+    error_replies = 0
+    for (user_id, number), (queued, finished) in timings.items():
+        stages['end_to_end'].append(finished - queued)
+        calls = [r for r in by_chat.get(user_id, ()) if queued <= r.start <= finished]
+        sends = [r for r in calls if r.path.endswith(REPLY_METHODS)]
+        if sends:
+            stages['first_reply'].append(min(r.start for r in sends) - queued)
+        if calls:
+            stages['telegram'].append(sum(r.end - r.start for r in calls))
+        if any(r.text == bot.OPENAI_ERROR_REPLY for r in calls):
+            error_replies += 1
+        tagged = by_tag.get((user_id, number), ())
+        for stage, services in (('llm', ('openai', 'replicate', 'replicate-create')), ('tts', ('elevenlabs', 'gtts'))):
+            spans = [r for r in tagged if r.service in services]
+            if spans:
+                stages[stage].append(max(r.end for r in spans) - min(r.start for r in spans))
+
+    services = {}
+    for record in records:
+        counts = services.setdefault(record.service, {'requests': 0, 'errors': 0})
+        counts['requests'] += 1
+        counts['errors'] += record.status >= 400
+    return {
+        'updates': len(timings),
+        'elapsed': elapsed,
+        'throughput': len(timings) / elapsed if elapsed else 0.0,
+        'error_replies': error_replies,
+        'stages': {stage: summarize(values) for stage, values in stages.items()},
+        'services': services,
+    }
+
+def report(results):
+    print(f"{results['updates']} updates in {results['elapsed']:.2f}s ({results['throughput']:.1f} updates/sec), "
+          f"{results['error_replies']} error replies")
+    print(f"{'stage':<12} {'count':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for stage, summary in results['stages'].items():
+        if summary['count']:
+            print(f"{stage:<12} {summary['count']:>6} " + ' '.join(f"{summary[key] * 1000:>9.1f}" for key in ('p50', 'p95', 'p99', 'max')))
+    print("fake services: " + ', '.join(f"{name} {counts['requests']} ({counts['errors']} errors)" for name, counts in sorted(results['services'].items())))
+
+def compare(results, baseline, tolerance):
+    """Print changes against the baseline; return the regressions beyond tolerance."""
+    regressions = []
+    rows = [('throughput', baseline['throughput'], results['throughput'], True)]
+    for stage, summary in results['stages'].items():
+        old = baseline['stages'].get(stage, {})
+        for key in ('p50', 'p95', 'p99'):
+            if summary.get('count') and old.get('count'):
+                rows.append((f"{stage} {key}", old[key], summary[key], False))
+    print(f"\nagainst baseline ({baseline['recorded']}, {baseline['config']}):")
+    for name, old, new, higher_is_better in rows:
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = 'REGRESSION' if worse > tolerance else ''
+        if flag:
+            regressions.append(name)
+        print(f"  {name:<22} {old:>10.4f} -> {new:>10.4f}  {change:+7.1%} {flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bot', default='telegramBot', choices=('telegramBot', 'buybot'))
+    parser.add_argument('--profile', default='realistic', choices=sorted(fake_services.PROFILES))
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=4, help='messages per user')
+    parser.add_argument('--think', type=float, default=0.5, help='mean seconds between a reply and the next message')
+    parser.add_argument('--ramp', type=float, default=1.0, help='seconds over which users start')
+    parser.add_argument('--audio-share', type=float, default=0.25, help='share of users with audio replies on')
+    parser.add_argument('--openai-error-rate', type=float)
+    parser.add_argument('--replicate-error-rate', type=float)
+    parser.add_argument('--tts-error-rate', type=float)
+    parser.add_argument('--telegram-flood-rate', type=float, help='share of Bot API calls answered with 429')
+    parser.add_argument('--no-send-limits', action='store_true', help="lift the outbound scheduler's Telegram rate limits")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--profiler', type=float, default=0, metavar='SECONDS',
+                        help='record a sampling profile (see profiler.py) during the first SECONDS of the load')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help='exit with status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.10)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    services = fake_services.FakeServices(build_profiles(args)).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        bot, log_path = import_bot(args.bot, services, tmp)
+        timings, elapsed = asyncio.run(run_load(bot, args))
+        bot.release_resources()
+        services.stop()
+        results = analyze(bot, services.records, timings, elapsed)
+        log_pipeline.stop()
+        log_size = os.path.getsize(log_path)
+
+    report(results)
+    print(f"bot log: {log_size / 1024:.0f} KiB")
+
+    config = {key: getattr(args, key) for key in ('bot', 'profile', 'users', 'messages', 'think', 'audio_share', 'no_send_limits')}
+    path = os.path.join(BASELINE_DIR, f"{args.bot}-{args.profile}.json")
+    regressions = []
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(dict(results, config=config, recorded=time.strftime('%Y-%m-%d %H:%M')), f, indent=2)
+        print(f"baseline saved to {path}")
+    elif os.path.exists(path):
+        with open(path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+    if args.check and regressions:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
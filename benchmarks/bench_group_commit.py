@@ -0,0 +1,59 @@
+# benchmarks/bench_group_commit.py
+#
+# Sustained charge throughput from many concurrent handlers, with every write
+# committed on its own vs. group-committed by async_database.
+#
+# Usage: python benchmarks/bench_group_commit.py [charges] [--full-sync]
+#   --full-sync  use synchronous=FULL, i.e. an fsync on every commit
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import database
+import async_database
+
+logging.disable(logging.CRITICAL)
+
+CONCURRENT_HANDLERS = 200
+USERS = 1000
+
+async def handler(worker, charges):
+    for i in range(charges):
+        await async_database.charge_interaction((worker * charges + i) % USERS, 0, 1)
+
+async def run(label, total):
+    await async_database.apply_deltas([(user_id, 0, total) for user_id in range(USERS)])
+    before = async_database.batch_stats()
+    per_handler = total // CONCURRENT_HANDLERS
+    start = time.perf_counter()
+    await asyncio.gather(*(handler(worker, per_handler) for worker in range(CONCURRENT_HANDLERS)))
+    elapsed = time.perf_counter() - start
+    after = async_database.batch_stats()
+    batches = after['batches'] - before['batches']
+    operations = after['operations'] - before['operations']
+    print(f"{label:<14} {per_handler * CONCURRENT_HANDLERS / elapsed:>10.0f} charges/sec  ({operations / batches:.1f} writes per commit)")
+
+async def main(total):
+    batch_max_ops = async_database.BATCH_MAX_OPS
+    async_database.BATCH_MAX_OPS = 1
+    await run('commit each', total)
+    async_database.BATCH_MAX_OPS = batch_max_ops
+    await run('group commit', total)
+
+if __name__ == '__main__':
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    total = int(args[0]) if args else 20000
+    if '--full-sync' in sys.argv:
+        database.PRAGMAS = tuple((name, 'FULL' if name == 'synchronous' else value) for name, value in database.PRAGMAS)
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILENAME = os.path.join(tmp, 'bench.db')
+        database.initialize_database()
+        for user_id in range(USERS):
+            database.get_user(user_id)
+        asyncio.run(main(total))
+        async_database.shutdown()
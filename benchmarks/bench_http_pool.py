@@ -0,0 +1,165 @@
+# benchmarks/bench_http_pool.py
+#
+# Connection reuse against a local HTTPS stand-in (self-signed certificate
+# made with the openssl command; plain HTTP if it isn't installed), run in its
+# own process. The stand-in answers after server_seconds, and handshake_seconds
+# later on a connection's first request, standing in for the round trips a
+# TCP + TLS handshake costs to a remote API. Sends bursts of concurrent
+# requests, as a busy bot does to an LLM or TTS API, with a short pause
+# between bursts, through:
+#   per request   a new client, and so a new connection, per request
+#   httpx default one client with httpx's default pool (keeps 20 connections alive)
+#   http_pool     one shared pool from http_pool.py
+# and reports request latency, requests per second and the number of
+# connections the server accepted.
+#
+# Usage: python benchmarks/bench_http_pool.py [concurrency] [bursts] [server_seconds] [handshake_seconds]
+
+import asyncio
+import os
+import shutil
+import ssl
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import httpx
+
+import http_pool
+
+class StandIn:
+    """A keep-alive HTTP/1.1 server that answers every request after a delay."""
+
+    def __init__(self, delay, handshake=0.0, ssl_context=None):
+        self.delay = delay
+        self.handshake = handshake
+        self.ssl_context = ssl_context
+        self.connections = 0
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        # Loopback handshakes are almost free; a real API is a few round trips away
+        handshake = self.handshake
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                length = 0
+                for line in head.split(b'\r\n'):
+                    name, _, value = line.partition(b':')
+                    if name.strip().lower() == b'content-length':
+                        length = int(value)
+                if length:
+                    await reader.readexactly(length)
+                if head.startswith(b'GET /connections'):
+                    body = str(self.connections).encode()
+                else:
+                    await asyncio.sleep(self.delay + handshake)
+                    handshake = 0.0
+                    body = b'{"ok": true}'
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n'
+                             b'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self._serve, '127.0.0.1', 0, ssl=self.ssl_context)
+        print(server.sockets[0].getsockname()[1], flush=True)
+        await server.serve_forever()
+
+def start_server(delay, handshake, certificate):
+    """Run the stand-in in its own process, so it doesn't compete with the clients for the GIL; returns (process, url)."""
+    process = subprocess.Popen([sys.executable, __file__, '--serve', str(delay), str(handshake)] + list(certificate or ()),
+                               stdout=subprocess.PIPE, text=True)
+    port = int(process.stdout.readline())
+    return process, f"{'https' if certificate else 'http'}://127.0.0.1:{port}"
+
+def serve(delay, handshake, cert=None, key=None):
+    context = None
+    if cert:
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cert, key)
+    asyncio.run(StandIn(delay, handshake, context).serve_forever())
+
+def make_certificate(directory):
+    """A self-signed certificate for 127.0.0.1; None if openssl isn't available."""
+    if not shutil.which('openssl'):
+        return None
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=127.0.0.1',
+                    '-addext', 'subjectAltName=IP:127.0.0.1', '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    return cert, key
+
+async def server_connections(url, verify):
+    async with httpx.AsyncClient(verify=verify) as client:
+        return int((await client.get(f"{url}/connections")).text)
+
+async def run(name, url, concurrency, bursts, verify):
+    latencies = []
+    shared = pool = None
+    if name == 'httpx default':
+        shared = httpx.AsyncClient(verify=verify)
+    elif name == 'http_pool':
+        pool = http_pool.MeteredTransport('bench', verify=verify)
+        shared = httpx.AsyncClient(transport=pool, timeout=http_pool.timeout())
+
+    async def request(n):
+        start = time.perf_counter()
+        if shared is None:
+            async with httpx.AsyncClient(verify=verify) as client:
+                await client.post(f"{url}/v1/echo", json={'n': n})
+        else:
+            await shared.post(f"{url}/v1/echo", json={'n': n})
+        latencies.append(time.perf_counter() - start)
+
+    connections = await server_connections(url, verify)
+    start = time.perf_counter()
+    for burst in range(bursts):
+        await asyncio.gather(*(request(n) for n in range(concurrency)))
+        await asyncio.sleep(0.05)  # Between bursts, as between users' messages
+    elapsed = time.perf_counter() - start
+    pool_stats = pool.stats() if pool else None
+    if shared is not None:
+        await shared.aclose()
+    latencies.sort()
+    return {
+        'p50': statistics.median(latencies),
+        'p95': latencies[int(len(latencies) * 0.95) - 1],
+        'rps': len(latencies) / elapsed,
+        'connections': await server_connections(url, verify) - connections - 1,  # Not counting the lookup itself
+        'pool': pool_stats,
+    }
+
+def main(concurrency, bursts, delay, handshake):
+    with tempfile.TemporaryDirectory() as tmp:
+        certificate = make_certificate(tmp)
+        verify = ssl.create_default_context(cafile=certificate[0]) if certificate else True
+        process, url = start_server(delay, handshake, certificate)
+        try:
+            print(f"{url}: {bursts} bursts of {concurrency} concurrent requests, {delay * 1000:.0f} ms per response, "
+                  f"{handshake * 1000:.0f} ms more on a new connection")
+            print(f"{'client':<16} {'p50 ms':>8} {'p95 ms':>8} {'req/s':>8} {'connections':>12}")
+            for name in ('per request', 'httpx default', 'http_pool'):
+                result = asyncio.run(run(name, url, concurrency, bursts, verify))
+                print(f"{name:<16} {result['p50'] * 1000:>8.1f} {result['p95'] * 1000:>8.1f} {result['rps']:>8.0f} {result['connections']:>12}")
+                if result['pool']:
+                    print(f"http_pool stats: {result['pool']}")
+        finally:
+            process.terminate()
+            process.wait()
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--serve']:
+        serve(float(sys.argv[2]), float(sys.argv[3]), *sys.argv[4:6])
+    else:
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else 50,
+             int(sys.argv[2]) if len(sys.argv) > 2 else 20,
+             float(sys.argv[3]) if len(sys.argv) > 3 else 0.02,
+             float(sys.argv[4]) if len(sys.argv) > 4 else 0.1)
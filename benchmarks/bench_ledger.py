@@ -0,0 +1,86 @@
+# benchmarks/bench_ledger.py
+#
+# The credit ledger under load: payments delivered several times over from
+# concurrent handlers (as Telegram does when it retries an update) must each
+# be credited once, while other users keep being charged through user_cache.
+# Reports payment and charge throughput, checks every balance against the
+# ledger, and times ledger.reconcile() as the ledger grows.
+#
+# Usage: python benchmarks/bench_ledger.py [payments] [deliveries_per_payment]
+
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import database
+import async_database
+import user_cache
+import ledger
+
+logging.disable(logging.CRITICAL)
+
+USERS = 1000
+CREDITS = 50
+LEDGER_SIZES = (10000, 100000, 1000000)  # Entries in the ledger when reconcile() is timed
+
+async def charge(stop, counter):
+    while not stop.is_set():
+        await user_cache.charge_interaction(random.randrange(USERS), 0, 1)
+        counter[0] += 1
+        await asyncio.sleep(0)
+
+async def main(payments, deliveries):
+    user_cache.configure(flush_interval=0.05)
+    await user_cache.start()
+    for user_id in range(USERS):
+        await user_cache.add_credits(user_id, 1000)
+
+    updates = [(n % USERS, f"charge-{n}") for n in range(payments) for _ in range(deliveries)]
+    random.shuffle(updates)
+    stop, charges = asyncio.Event(), [0]
+    chargers = [asyncio.create_task(charge(stop, charges)) for _ in range(50)]
+    start = time.perf_counter()
+    applied = await asyncio.gather(*(user_cache.apply_payment(user_id, charge_id, CREDITS)
+                                     for user_id, charge_id in updates))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await asyncio.gather(*chargers)
+    await user_cache.stop()
+
+    print(f"{len(updates)} deliveries of {payments} payments in {elapsed:.2f}s "
+          f"({len(updates) / elapsed:.0f} deliveries/sec), {charges[0]} charges meanwhile "
+          f"({charges[0] / elapsed:.0f} charges/sec)")
+    purchases = database.get_connection().execute(
+        "SELECT COUNT(*), COALESCE(SUM(credits), 0) FROM transactions WHERE kind = 'purchase'").fetchone()
+    print(f"applied {sum(applied)}, ledger purchases {purchases[0]} ({purchases[1]} credits)")
+    mismatches = await ledger.reconcile()
+    ok = sum(applied) == payments and purchases == (payments, payments * CREDITS) and not mismatches
+    print("OK: every payment credited once, balances match the ledger" if ok else f"FAILED: {len(mismatches)} mismatched balances")
+
+    conn = database.get_connection()
+    for size in LEDGER_SIZES:
+        missing = size - conn.execute('SELECT COUNT(*) FROM transactions').fetchone()[0]
+        if missing > 0:
+            # Zero-credit entries grow the ledger without changing any balance
+            with conn:
+                conn.executemany("INSERT INTO transactions (user_id, kind, credits, created_at) VALUES (?, 'charge', 0, 0)",
+                                 ((random.randrange(USERS),) for _ in range(missing)))
+        start = time.perf_counter()
+        await ledger.reconcile()
+        print(f"reconcile, {size:>8} ledger entries: {(time.perf_counter() - start) * 1000:.1f} ms")
+    return ok
+
+if __name__ == '__main__':
+    payments = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    deliveries = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DB_FILENAME = os.path.join(tmp, 'bench.db')
+        database.initialize_database()
+        ok = asyncio.run(main(payments, deliveries))
+        async_database.shutdown()
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,98 @@
+# benchmarks/bench_logging.py
+#
+# Per-message logging overhead on the handler's thread. Replays the log calls
+# one paid text reply makes (received message, charge, LLM request and reply,
+# database reads and writes, sends) with a realistic user message and LLM
+# reply, first as the old eager f-strings through logging.basicConfig's
+# synchronous handler at DEBUG and INFO, then through log_pipeline at DEBUG,
+# with DEBUG sampled, and at INFO. "caller" is the time the handler spends in
+# logging calls; "drained" includes the writer thread writing everything out.
+#
+# Usage: python benchmarks/bench_logging.py [messages]
+
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import log_pipeline
+
+USER_TEXT = "Tell me a long story about a lighthouse keeper who finds a message in a bottle. " * 4
+REPLY = "Once upon a time, on a rocky island far from the mainland, there lived a lighthouse keeper. " * 30
+
+bot_log = logging.getLogger('bench.bot')
+db_log = logging.getLogger('bench.database')
+
+def eager_message(user_id):
+    # The calls handle_message and database.py made before, as f-strings
+    charge = {'charged': True, 'free': False, 'free_interactions_used': 10, 'indecent_credits': 41}
+    bot_log.debug(f"Received message from user {user_id}: {USER_TEXT}")
+    db_log.debug(f"Retrieved existing user {user_id}: {charge}")
+    db_log.debug(f"Charged user {user_id}: {charge}")
+    bot_log.debug(f"Charge result: {charge}")
+    bot_log.debug(f"User {user_id} consumed 1 Indecent Credit(s). Remaining credits: {charge['indecent_credits']}")
+    bot_log.debug(f"Generating OpenAI response for user {user_id} with message: {USER_TEXT}")
+    bot_log.debug(f"OpenAI response for user {user_id}: {REPLY}")
+    db_log.debug(f"Committed batch of {3} operations.")
+    for _ in range(2):
+        bot_log.debug(f"Sent text response chunk to user {user_id}.")
+
+def structured_message(user_id):
+    # The same events as the bots now log them
+    charge = {'charged': True, 'free': False, 'free_interactions_used': 10, 'indecent_credits': 41}
+    bot_log.debug("Received message", extra={'user_id': user_id, 'text': USER_TEXT})
+    db_log.debug("Retrieved existing user", extra={'user_id': user_id, 'free_used': 10, 'credits': 41})
+    db_log.debug("Charged user", extra={'user_id': user_id, 'free': False, 'free_used': 10, 'credits': 41})
+    bot_log.debug("Charge result", extra={'user_id': user_id, 'charged': charge['charged'], 'free': charge['free'],
+                                          'credits': charge['indecent_credits']})
+    bot_log.debug("Consumed Indecent Credits", extra={'user_id': user_id, 'cost': 1})
+    bot_log.debug("Generating OpenAI response", extra={'user_id': user_id, 'text': USER_TEXT})
+    bot_log.debug("OpenAI response", extra={'user_id': user_id, 'reply': REPLY})
+    db_log.debug("Committed batch", extra={'operations': 3})
+    for _ in range(2):
+        bot_log.debug("Sent text response chunk", extra={'user_id': user_id, 'chars': 2000})
+
+def measure(message, messages):
+    start = time.perf_counter()
+    for user_id in range(messages):
+        message(user_id)
+    caller = time.perf_counter() - start
+    log_pipeline.stop()  # No-op for the basicConfig runs
+    logging.shutdown()
+    return caller, time.perf_counter() - start
+
+def reset_root():
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+
+def main(messages):
+    print(f"{'setup':<30} {'caller us/msg':>14} {'drained us/msg':>15} {'log KiB/msg':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        runs = [
+            ('basicConfig, f-strings', eager_message, logging.DEBUG),
+            ('basicConfig INFO, f-strings', eager_message, logging.INFO),
+            ('pipeline, DEBUG', structured_message, dict(level='DEBUG')),
+            ('pipeline, DEBUG 1/10', structured_message, dict(level='DEBUG', default_sample_rate=0.1)),
+            ('pipeline, INFO', structured_message, dict(level='INFO')),
+        ]
+        for name, message, settings in runs:
+            path = os.path.join(tmp, f'{len(os.listdir(tmp))}.log')
+            reset_root()
+            if isinstance(settings, int):
+                logging.basicConfig(filename=path, format=log_pipeline.FORMAT, level=settings)
+            else:
+                # A queue as large as the run, so no record is dropped and the comparison is fair
+                log_pipeline.configure(filename=path, queue_size=messages * 12, **settings)
+            caller, drained = measure(message, messages)
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            print(f"{name:<30} {caller / messages * 1e6:>14.1f} {drained / messages * 1e6:>15.1f} {size / messages / 1024:>12.2f}")
+        reset_root()
+    print(f"pipeline stats: {log_pipeline.stats()}")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
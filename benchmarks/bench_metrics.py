@@ -0,0 +1,110 @@
+# benchmarks/bench_metrics.py
+#
+# Cost of the metrics instrumentation. Times each kind of update (counter
+# increment, histogram observation, labelled observation, timer block), the
+# full set of updates one paid text + voice reply makes, and a scrape of the
+# endpoint once the registry holds many series, next to the cost of pushing
+# an empty update through PerUserUpdateProcessor for scale.
+#
+# Usage: python benchmarks/bench_metrics.py [iterations]
+
+import asyncio
+import logging
+import os
+import sys
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import metrics
+import async_database
+import backends
+import concurrency
+import outbound
+import tts_cache
+import update_processing
+import user_cache
+
+logging.disable(logging.CRITICAL)
+
+def per_call(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations
+
+def one_reply():
+    # Roughly what one update with a charge, an LLM call, TTS and two sends records
+    update_processing.UPDATE_SECONDS.observe(0.8)
+    update_processing.HANDLER_SECONDS.observe(0.7)
+    async_database.DB_CALL_SECONDS.labels('get_tts_entry', 'read').observe(0.0004)
+    async_database.DB_CALL_SECONDS.labels('store_tts_entry', 'write').observe(0.003)
+    user_cache.CHARGE_SECONDS.observe(0.00002)
+    user_cache.CHARGES.labels('credit').inc()
+    backends.LLM_SECONDS.labels('openai', 'success').observe(0.4)
+    backends.HEDGE_EVENTS.labels('openai->replicate', 'requests').inc()
+    backends.HEDGE_EVENTS.labels('openai->replicate', 'primary_wins').inc()
+    tts_cache.TTS_LOOKUPS.labels('synthesized').inc()
+    tts_cache.SYNTHESIS_SECONDS.labels('success').observe(0.3)
+    tts_cache.AUDIO_SEND_SECONDS.labels('upload').observe(0.2)
+    for _ in range(2):
+        outbound.QUEUE_SECONDS.observe(0.01)
+        outbound.SEND_SECONDS.observe(0.05)
+        outbound.SENDS.labels('sent').inc()
+
+async def processor_cost(iterations):
+    processor = update_processing.PerUserUpdateProcessor()
+
+    async def empty():
+        pass
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        await processor.do_process_update(None, empty())
+    return (time.perf_counter() - start) / iterations
+
+async def scrape_cost(series, scrapes=20):
+    # Fill the registry with many labelled series, as a long-running bot would
+    histogram = metrics.histogram('bench_request_seconds', 'Benchmark series.', ('op', 'kind'))
+    for n in range(series):
+        histogram.labels(f'op{n}', 'read').observe(0.001 * n)
+    for name in ('disk', 'gtts', 'openai'):
+        concurrency.limit(name)
+    server = await metrics.start_server(port=0)
+    url = f'http://127.0.0.1:{server.port}/metrics'
+    size = len(await asyncio.to_thread(lambda: urllib.request.urlopen(url).read()))
+    start = time.perf_counter()
+    for _ in range(scrapes):
+        await asyncio.to_thread(lambda: urllib.request.urlopen(url).read())
+    elapsed = (time.perf_counter() - start) / scrapes
+    await metrics.stop_server()
+    return elapsed, size
+
+def main(iterations):
+    counter = metrics.counter('bench_events_total', 'Benchmark counter.')
+    histogram = metrics.histogram('bench_seconds', 'Benchmark histogram.')
+    labelled = metrics.histogram('bench_labelled_seconds', 'Benchmark histogram.', ('backend', 'outcome'))
+
+    def timed_block():
+        with histogram.time():
+            pass
+
+    rows = [
+        ('counter inc', per_call(counter.inc, iterations)),
+        ('histogram observe', per_call(lambda: histogram.observe(0.123), iterations)),
+        ('labelled observe', per_call(lambda: labelled.labels('openai', 'success').observe(0.123), iterations)),
+        ('timer block', per_call(timed_block, iterations)),
+        ('one reply (all stages)', per_call(one_reply, iterations // 10)),
+        ('empty update, processor', asyncio.run(processor_cost(iterations // 10))),
+    ]
+    for name, seconds in rows:
+        print(f"{name:<26} {seconds * 1e6:>9.2f} us")
+
+    for series in (100, 1000):
+        elapsed, size = asyncio.run(scrape_cost(series))
+        print(f"scrape with {series:>5} extra series {elapsed * 1000:>8.2f} ms ({size / 1024:.0f} KiB)")
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
+    async_database.shutdown()
@@ -0,0 +1,92 @@
+# benchmarks/bench_outbound.py
+#
+# A burst of multi-chunk replies to many chats, sent against a fake Telegram
+# that enforces flood limits (1 message/s per chat with a burst of 3, 30/s
+# overall) and answers excess sends with RetryAfter. Rejected sends still use
+# up the global budget, so retry storms crowd out real deliveries. Compares
+# handlers calling reply_text directly (sleeping on RetryAfter) with the
+# outbound scheduler.
+#
+# Usage: python benchmarks/bench_outbound.py [chats] [messages_per_chat]
+
+import asyncio
+import logging
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telegram.error import RetryAfter
+
+import outbound
+
+logging.disable(logging.CRITICAL)
+
+API_LATENCY = 0.05       # Seconds per Bot API round trip
+TIME_LIMIT_FACTOR = 3    # Give up on a run after this multiple of the ideal time
+
+class FakeTelegram:
+    """Counts deliveries and rejects sends over the flood limits."""
+
+    def __init__(self):
+        self.global_bucket = outbound.TokenBucket(30.0, 30)
+        self.chat_buckets = {}
+        self.delivered = 0
+        self.rejected = 0
+        self.order = {}
+
+    async def send(self, chat_id, index):
+        await asyncio.sleep(API_LATENCY)
+        now = time.monotonic()
+        chat_bucket = self.chat_buckets.setdefault(chat_id, outbound.TokenBucket(1.0, 3))
+        wait = max(self.global_bucket.wait_time(now), chat_bucket.wait_time(now))
+        if wait > 0:
+            self.rejected += 1
+            self.global_bucket.take(now)
+            raise RetryAfter(math.ceil(wait))
+        self.global_bucket.take(now)
+        chat_bucket.take(now)
+        self.delivered += 1
+        self.order.setdefault(chat_id, []).append(index)
+
+async def direct_handler(telegram, chat_id, messages):
+    for index in range(messages):
+        while True:
+            try:
+                await telegram.send(chat_id, index)
+                break
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+
+async def scheduled_handler(telegram, chat_id, messages):
+    for index in range(messages):
+        await outbound.send(chat_id, lambda index=index: telegram.send(chat_id, index))
+
+async def run(label, handler, chats, messages, time_limit):
+    telegram = FakeTelegram()
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(handler(telegram, chat_id, messages)) for chat_id in range(chats)]
+    done, pending = await asyncio.wait(tasks, timeout=time_limit)
+    elapsed = time.perf_counter() - start
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+    in_order = all(order == sorted(order) for order in telegram.order.values())
+    status = f"done in {elapsed:.1f}s" if not pending else f"{len(pending)} chats unfinished after {time_limit:.0f}s"
+    print(f"{label:<10} {telegram.delivered:>5} delivered  {telegram.delivered / elapsed:>6.1f} msgs/sec  "
+          f"{telegram.rejected:>6} RetryAfter  {status}  per-chat order kept: {in_order}")
+
+async def main(chats, messages):
+    ceiling = chats * messages / 30.0
+    print(f"{chats} chats x {messages} messages; 30 msgs/sec ceiling = {ceiling:.1f}s")
+    time_limit = TIME_LIMIT_FACTOR * ceiling
+    await run('direct', direct_handler, chats, messages, time_limit)
+    await run('scheduled', scheduled_handler, chats, messages, time_limit)
+    print(f"scheduler: {outbound.stats()}")
+    await outbound.stop()
+
+if __name__ == '__main__':
+    chats = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    asyncio.run(main(chats, messages))
@@ -0,0 +1,96 @@
+# benchmarks/bench_persistence.py
+#
+# Restart and flush cost of user settings persistence as the user base grows,
+# PTB's PicklePersistence vs. persistence.SQLitePersistence. For each size the
+# store is filled with that many users, then an Application loads its
+# persistence from it (restart) and a persistence run writes ACTIVE users who
+# toggled audio (flush). PicklePersistence runs with its default on_flush=False,
+# which rewrites the whole file for every changed user. Also checks that a
+# toggle survives a restart.
+#
+# Usage: python benchmarks/bench_persistence.py [max_users]
+
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telegram.ext import ApplicationBuilder, PicklePersistence
+
+import database
+import async_database
+import persistence
+
+logging.disable(logging.CRITICAL)
+
+ACTIVE = 100  # Users with an update between two persistence runs
+
+def user_settings(user_id):
+    return {'audio_enabled': user_id % 2 == 0}
+
+def build(store):
+    application = ApplicationBuilder().token('123456:local-test').persistence(store).build()
+    store.set_bot(application.bot)  # Done by Application.initialize(), which would contact Telegram
+    return application
+
+async def fill(store, users):
+    if isinstance(store, persistence.SQLitePersistence):
+        database.run_batch([
+            (database.store_persistent_data, ('user', user_id, [(persistence._dumps(key), persistence._dumps(value))
+                                                                for key, value in user_settings(user_id).items()], []), {})
+            for user_id in range(1, users + 1)
+        ])
+        return
+    build(store)  # Attaches the bot, which PicklePersistence needs
+    await store.get_user_data()
+    for user_id in range(1, users + 1):
+        await store.update_user_data(user_id, user_settings(user_id))
+    await store.flush()
+
+async def restart_and_flush(store):
+    application = build(store)
+    # The persistence part of Application.initialize(), without contacting Telegram
+    start = time.perf_counter()
+    await application._initialize_persistence()
+    restart = time.perf_counter() - start
+
+    # ACTIVE users send an update and toggle audio, as toggle_audio does
+    for user_id in range(1, ACTIVE + 1):
+        await store.refresh_user_data(user_id, application._user_data[user_id])
+        application.user_data[user_id]['audio_enabled'] = not application.user_data[user_id].get('audio_enabled', False)
+        application.mark_data_for_update_persistence(user_ids=user_id)
+    start = time.perf_counter()
+    await application.update_persistence()
+    await store.flush()
+    flush = time.perf_counter() - start
+    return restart, flush
+
+async def main(max_users):
+    sizes = [size for size in (1000, 10000, 100000, 1000000) if size <= max_users]
+    print(f"{'users':>8}  {'pickle restart':>15}  {'pickle flush':>13}  {'sqlite restart':>15}  {'sqlite flush':>13}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in sizes:
+            row = []
+            pickle_path = os.path.join(tmp, f'bench-{size}.pickle')
+            await fill(PicklePersistence(pickle_path, on_flush=True), size)
+            row += await restart_and_flush(PicklePersistence(pickle_path))
+
+            database.DB_FILENAME = os.path.join(tmp, f'bench-{size}.db')
+            database.initialize_database()
+            await fill(persistence.SQLitePersistence(), size)
+            row += await restart_and_flush(persistence.SQLitePersistence())
+            print(f"{size:>8}  " + "  ".join(f"{seconds * 1000:>12.1f} ms" for seconds in row))
+
+        # A toggle written by one run is seen after a restart
+        store = persistence.SQLitePersistence()
+        user_data = {}
+        await store.refresh_user_data(1, user_data)
+        print(f"user 1 audio_enabled after restart: {user_data.get('audio_enabled')} (expected {not user_settings(1)['audio_enabled']})")
+        await async_database._run(database.close_connections)
+
+if __name__ == '__main__':
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
+    async_database.shutdown()
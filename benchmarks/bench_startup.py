@@ -0,0 +1,156 @@
+# benchmarks/bench_startup.py
+#
+# Cold start of a bot, each run in a fresh interpreter against the local
+# stand-ins in fake_services.py and a new database:
+#   import        importing the bot module (no API keys needed)
+#   configure     bot.configure(): logging, key checks, provider registry, database
+#   first_command process start -> a /balance command has been answered (no provider needed)
+#   first_reply   process start -> a text message has been answered (needs the LLM client;
+#                 includes the streamed reply's last edit, up to streaming.EDIT_INTERVAL later)
+# "lazy" is the bots' startup path; "eager" builds every provider client inside
+# configure, as the bots did at import before providers.py.
+#
+# Medians of the lazy runs are checked against BUDGETS, in seconds; --check
+# exits with status 1 when one is over. The budgets leave headroom for slower
+# machines but fail if an SDK import creeps back into the import path.
+#
+# Usage: python benchmarks/bench_startup.py [--bot telegramBot|buybot] [--runs 5] [--check]
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+START = time.perf_counter()
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.dirname(__file__))
+
+STAGES = ('import', 'configure', 'first_command', 'first_reply')
+BUDGETS = {'import': 0.5, 'configure': 0.1, 'first_command': 0.8, 'first_reply': 2.5}
+USER_ID = 1000
+
+async def first_updates(bot, timings):
+    from telegram import Chat, Message, MessageEntity, Update, User
+    from telegram.ext import TypeHandler
+
+    done = {}
+
+    async def finished(update, context):
+        done[update.update_id].set()
+
+    application = bot.build_application()
+    application.add_handler(TypeHandler(Update, finished), group=100)  # Runs after the bot's handlers
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+    sender = User(USER_ID, 'user', False)
+    chat = Chat(USER_ID, Chat.PRIVATE)
+    updates = (
+        ('first_command', '/balance', [MessageEntity(MessageEntity.BOT_COMMAND, 0, len('/balance'))]),
+        ('first_reply', 'u1000m0 tell me something', None),
+    )
+    for update_id, (stage, text, entities) in enumerate(updates, 1):
+        message = Message(update_id, datetime.datetime.now(datetime.timezone.utc), chat, from_user=sender,
+                          text=text, entities=entities)
+        message.set_bot(application.bot)
+        done[update_id] = asyncio.Event()
+        await application.update_queue.put(Update(update_id, message=message))
+        await done[update_id].wait()
+        timings[stage] = time.perf_counter() - START
+
+    await application.stop()
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+def child(name, mode, tmp):
+    """One cold start; prints the timings as JSON."""
+    import importlib
+    timings = {}
+    start = time.perf_counter()
+    bot = importlib.import_module(name)
+    timings['import'] = time.perf_counter() - start
+
+    import database
+    database.DB_FILENAME = os.path.join(tmp, 'bench.db')
+    start = time.perf_counter()
+    bot.configure()
+    if mode == 'eager':
+        import providers
+        asyncio.run(providers.preload())
+    timings['configure'] = time.perf_counter() - start
+
+    asyncio.run(first_updates(bot, timings))
+    bot.release_resources()
+    print(json.dumps(timings))
+
+def run(name, mode, services, runs):
+    env = dict(
+        os.environ,
+        TELEGRAM_BOT_TOKEN='123456:bench',
+        TELEGRAM_API_BASE_URL=services.url('telegram') + '/bot',
+        OPENAI_API_KEY='bench',
+        OPENAI_BASE_URL=services.url('openai') + '/v1',
+        REPLICATE_API_TOKEN='bench',
+        REPLICATE_BASE_URL=services.url('replicate'),
+        ELEVENLABS_API_KEY='bench',
+        ELEVENLABS_BASE_URL=services.url('elevenlabs'),
+        METRICS_PORT='0',
+        LOG_LEVEL='INFO',
+    )
+    results = {stage: [] for stage in STAGES}
+    for _ in range(runs):
+        with tempfile.TemporaryDirectory() as tmp:
+            started = time.perf_counter()
+            process = subprocess.run([sys.executable, __file__, '--child', name, mode, tmp],
+                                     env=env, cwd=tmp, capture_output=True, text=True)
+            wall = time.perf_counter() - started
+        if process.returncode:
+            sys.exit(f"{name} ({mode}) failed:\n{process.stderr}")
+        timings = json.loads(process.stdout.strip().splitlines()[-1])
+        for stage in STAGES:
+            results[stage].append(timings[stage])
+        results.setdefault('process', []).append(wall)
+    return {stage: statistics.median(values) for stage, values in results.items()}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bot', default='telegramBot', choices=('telegramBot', 'buybot'))
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--check', action='store_true', help='exit with status 1 when a lazy median is over budget')
+    args = parser.parse_args()
+
+    import fake_services
+    services = fake_services.FakeServices().start()
+    try:
+        medians = {mode: run(args.bot, mode, services, args.runs) for mode in ('lazy', 'eager')}
+    finally:
+        services.stop()
+
+    print(f"{args.bot}, median of {args.runs} cold starts (seconds)")
+    print(f"{'stage':<14} {'lazy':>8} {'eager':>8} {'budget':>8}")
+    over = []
+    for stage in STAGES + ('process',):
+        budget = BUDGETS.get(stage)
+        lazy = medians['lazy'][stage]
+        if budget is not None and lazy > budget:
+            over.append(stage)
+        print(f"{stage:<14} {lazy:>8.3f} {medians['eager'][stage]:>8.3f} {budget if budget is not None else '':>8} "
+              f"{'OVER BUDGET' if stage in over else ''}")
+    if args.check and over:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--child']:
+        child(*sys.argv[2:5])
+    else:
+        main()
@@ -0,0 +1,75 @@
+# benchmarks/bench_update_processing.py
+#
+# Load test of update processing: many users each send a few messages whose
+# handler waits on a simulated LLM call. Updates are fed to the processor the
+# way Application does (one task per update, in arrival order), for PTB's
+# default of one update at a time and for PerUserUpdateProcessor at several
+# caps. Also checks that no user ever has two updates running at once and that
+# each user's updates finish in order.
+#
+# Usage: python benchmarks/bench_update_processing.py [users] [messages_per_user] [llm_seconds]
+
+import asyncio
+import datetime
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telegram import Chat, Message, Update, User
+from telegram.ext import SimpleUpdateProcessor
+
+import update_processing
+
+logging.disable(logging.CRITICAL)
+
+CAPS = (8, 32, 128)
+
+def make_updates(users, messages):
+    updates = []
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for index in range(messages):
+        for user_id in range(users):
+            update_id = len(updates)
+            user = User(user_id, f"user{user_id}", False)
+            message = Message(update_id, now, Chat(user_id, Chat.PRIVATE), from_user=user, text=str(index))
+            updates.append(Update(update_id, message=message))
+    return updates
+
+async def run(label, processor, updates, llm_seconds):
+    running_users = set()
+    finished = {}
+    overlaps = 0
+
+    async def handler(update):
+        nonlocal overlaps
+        user_id = update.effective_user.id
+        if user_id in running_users:
+            overlaps += 1
+        running_users.add(user_id)
+        await asyncio.sleep(llm_seconds)
+        running_users.discard(user_id)
+        finished.setdefault(user_id, []).append(int(update.message.text))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        asyncio.create_task(processor.process_update(update, handler(update))) for update in updates
+    ))
+    elapsed = time.perf_counter() - start
+    in_order = all(order == sorted(order) for order in finished.values())
+    print(f"{label:<24} {len(updates) / elapsed:>8.1f} updates/sec  {elapsed:>6.2f}s  "
+          f"same-user overlaps: {overlaps}  per-user order kept: {in_order}")
+
+async def main(users, messages, llm_seconds):
+    updates = make_updates(users, messages)
+    print(f"{users} users x {messages} messages, {llm_seconds}s per LLM call")
+    await run('default (1 at a time)', SimpleUpdateProcessor(1), updates, llm_seconds)
+    for cap in CAPS:
+        await run(f"per-user, cap {cap}", update_processing.PerUserUpdateProcessor(cap), updates, llm_seconds)
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 2
+    llm_seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    asyncio.run(main(users, messages, llm_seconds))
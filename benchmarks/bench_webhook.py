@@ -0,0 +1,92 @@
+# benchmarks/bench_webhook.py
+#
+# POSTs a recorded update (benchmarks/sample_update.json by default) to a
+# webhook, as Telegram would, and reports request latency. Without --url it
+# starts webhook.WebhookServer in-process against an Application that is never
+# connected to Telegram, and checks that the updates reach its queue. Point
+# --url at a bot started with BOT_MODE=webhook to replay updates to it.
+# In-process numbers include the httpx client's own CPU time, which is most of
+# the total.
+#
+# Usage: python benchmarks/bench_webhook.py [requests] [--concurrency N]
+#        [--url http://127.0.0.1:8443/telegram] [--secret TOKEN] [--update FILE]
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from telegram.ext import ApplicationBuilder
+
+import webhook
+
+logging.disable(logging.CRITICAL)
+
+SAMPLE_UPDATE = os.path.join(os.path.dirname(__file__), 'sample_update.json')
+
+async def post_updates(url, secret, update, requests, concurrency):
+    latencies = []
+    statuses = {}
+    headers = {webhook.SECRET_TOKEN_HEADER: secret} if secret else {}
+    counter = iter(range(requests))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(limits=limits) as client:
+        async def sender():
+            for index in counter:
+                body = dict(update, update_id=update['update_id'] + index)
+                start = time.perf_counter()
+                response = await client.post(url, json=body, headers=headers)
+                latencies.append(time.perf_counter() - start)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(sender() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+        base = url.rsplit('/', 1)[0]
+        health = (await client.get(f"{base}/healthz")).status_code
+        wrong_secret = (await client.post(url, json=update, headers={webhook.SECRET_TOKEN_HEADER: 'wrong'})).status_code
+
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"{requests} updates in {elapsed:.2f}s ({requests / elapsed:.0f}/sec), statuses {statuses}")
+    print(f"latency p50 {statistics.median(latencies) * 1000:.2f} ms, p95 {p95 * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+    print(f"/healthz -> {health}, wrong secret -> {wrong_secret}")
+
+async def main(args):
+    with open(args.update) as f:
+        update = json.load(f)
+    if args.url:
+        await post_updates(args.url, args.secret, update, args.requests, args.concurrency)
+        return
+
+    # Local server; the Application is built but never initialized, so nothing reaches Telegram
+    application = ApplicationBuilder().token('123456:local-test').build()
+    secret = args.secret or 'local-secret'
+    server = webhook.WebhookServer(application, secret_token=secret, listen='127.0.0.1', port=0)
+    await server.start()
+    port = server._server.sockets[0].getsockname()[1]
+    try:
+        await post_updates(f"http://127.0.0.1:{port}{webhook.WEBHOOK_PATH}", secret, update, args.requests, args.concurrency)
+    finally:
+        await server.stop()
+    queued = application.update_queue.qsize()
+    first = application.update_queue.get_nowait() if queued else None
+    print(f"queued updates: {queued}, first: update_id={first.update_id} text={first.message.text!r}" if first else "no updates queued")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('requests', nargs='?', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=webhook.MAX_CONNECTIONS)
+    parser.add_argument('--url')
+    parser.add_argument('--secret')
+    parser.add_argument('--update', default=SAMPLE_UPDATE)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,416 @@
+# benchmarks/fake_services.py
+#
+# Local stand-ins for the Telegram Bot API, OpenAI, Replicate, ElevenLabs and
+# Google Translate TTS (gTTS), for benchmarks that run the real bot handlers.
+# Each service is a small HTTP/1.1 server with keep-alive and chunked
+# streaming, and they all run on one event loop in a background thread so the
+# bot's own loop is left alone.
+#
+# Latency follows a log-normal distribution around a median, and each service
+# can fail a share of requests (HTTP 500, or 429 with retry_after for
+# Telegram). Every request is recorded with its start and end time
+# (time.perf_counter) and the synthetic-user tag found in its body, so a
+# benchmark can split an update's latency by stage.
+
+import asyncio
+import base64
+import itertools
+import json
+import math
+import random
+import re
+import threading
+import time
+import urllib.parse
+from email.parser import BytesParser
+from email.policy import HTTP
+
+# Messages sent by bench users carry a tag like "u12m3" (user 12, message 3)
+TAG = re.compile(r'\bu(\d+)m(\d+)\b')
+
+WORDS = ('the quick brown fox jumps over a lazy dog while seven wise owls quietly '
+         'count stars above the sleeping harbour town').split()
+
+class Profile:
+    """Latency and failure settings of one fake service."""
+
+    def __init__(self, median=0.0, sigma=0.0, error_rate=0.0, ttft=0.0, tokens_per_sec=0.0, reply_words=(40, 120), bytes_per_char=40):
+        self.median = median            # Seconds until the response starts (non-streaming: whole response)
+        self.sigma = sigma              # Log-normal spread; 0 = always the median
+        self.error_rate = error_rate    # Share of requests answered with an error
+        self.ttft = ttft                # Streaming: seconds to the first token
+        self.tokens_per_sec = tokens_per_sec  # Streaming rate; 0 = all at once
+        self.reply_words = reply_words  # LLM reply length range, in words
+        self.bytes_per_char = bytes_per_char  # TTS audio size per character of text
+
+    def latency(self, median=None):
+        median = self.median if median is None else median
+        if median <= 0:
+            return 0.0
+        if self.sigma <= 0:
+            return median
+        return random.lognormvariate(math.log(median), self.sigma)
+
+    def fails(self):
+        return self.error_rate > 0 and random.random() < self.error_rate
+
+# Named sets of profiles; services missing from a set use Profile() (instant, no errors)
+PROFILES = {
+    # No latency anywhere: measures the bot's own overhead
+    'fast': {},
+    # Rough production numbers
+    'realistic': {
+        'telegram': Profile(median=0.05, sigma=0.3),
+        'openai': Profile(median=1.5, sigma=0.4, ttft=0.4, tokens_per_sec=60),
+        'replicate': Profile(median=2.5, sigma=0.5, ttft=0.8, tokens_per_sec=40),
+        'elevenlabs': Profile(median=0.6, sigma=0.3),
+        'gtts': Profile(median=0.4, sigma=0.3),
+    },
+    # Realistic latency with a flaky primary LLM and occasional flood control
+    'degraded': {
+        'telegram': Profile(median=0.05, sigma=0.3, error_rate=0.02),
+        'openai': Profile(median=1.5, sigma=0.4, ttft=0.4, tokens_per_sec=60, error_rate=0.02),
+        'replicate': Profile(median=4.0, sigma=0.8, ttft=1.5, tokens_per_sec=40, error_rate=0.2),
+        'elevenlabs': Profile(median=0.8, sigma=0.5, error_rate=0.05),
+        'gtts': Profile(median=0.5, sigma=0.5, error_rate=0.05),
+    },
+}
+
+class Request:
+    __slots__ = ('service', 'method', 'path', 'tag', 'start', 'end', 'status', 'chat_id', 'text')
+
+    def __init__(self, service, method, path, tag, start):
+        self.service = service
+        self.method = method
+        self.path = path
+        self.tag = tag
+        self.start = start
+        self.end = None
+        self.status = 200
+        self.chat_id = None
+        self.text = None
+
+def find_tag(text):
+    """The last (user, message) tag in text, or None."""
+    tag = None
+    for match in TAG.finditer(text):
+        tag = (int(match.group(1)), int(match.group(2)))
+    return tag
+
+def reply_text(tag, words):
+    """A reply of about `words` words in sentences that each carry the tag, so TTS requests can be attributed."""
+    prefix = f"u{tag[0]}m{tag[1]}" if tag else "reply"
+    sentences = []
+    while words > 0:
+        length = min(words, random.randint(6, 14))
+        words -= length
+        sentences.append(f"{prefix} " + ' '.join(random.choice(WORDS) for _ in range(length)) + '.')
+    return ' '.join(sentences)
+
+class FakeServer:
+    """Minimal HTTP/1.1 server; subclasses implement handle()."""
+
+    service = None
+
+    def __init__(self, profile, records):
+        self.profile = profile or Profile()
+        self.records = records
+        self.port = None
+        self._server = None
+        self._connections = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_connection, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        for task in self._connections:
+            task.cancel()
+        await asyncio.gather(*self._connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def _serve_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, _ = line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get('content-length') or 0)
+                body = await reader.readexactly(length) if length else b''
+                path, _, query = target.partition('?')
+                await self._respond(writer, method, path, urllib.parse.parse_qs(query), headers, body)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            writer.close()
+
+    async def _respond(self, writer, method, path, query, headers, body):
+        record = Request(self.service, method, path, None, time.perf_counter())
+        self.records.append(record)
+        try:
+            status, content_type, payload = await self.handle(record, method, path, query, headers, body)
+        except Exception as e:
+            status, content_type, payload = 500, 'application/json', json.dumps({'error': str(e)}).encode()
+        record.status = status
+        head = f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\nContent-Type: {content_type}\r\n"
+        if isinstance(payload, bytes):
+            writer.write(f"{head}Content-Length: {len(payload)}\r\n\r\n".encode('latin-1') + payload)
+            await writer.drain()
+        else:
+            # Async iterator of chunks, sent with chunked transfer encoding as they are produced
+            writer.write(f"{head}Transfer-Encoding: chunked\r\n\r\n".encode('latin-1'))
+            async for chunk in payload:
+                writer.write(f"{len(chunk):x}\r\n".encode('latin-1') + chunk + b"\r\n")
+                await writer.drain()
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        record.end = time.perf_counter()
+
+    async def handle(self, record, method, path, query, headers, body):
+        raise NotImplementedError
+
+    async def _tokens(self, text, encode):
+        # Stream words at the profile's rate after the time to first token
+        await asyncio.sleep(self.profile.latency(self.profile.ttft))
+        delay = 1 / self.profile.tokens_per_sec if self.profile.tokens_per_sec else 0
+        for index, word in enumerate(text.split(' ')):
+            if delay:
+                await asyncio.sleep(delay)
+            yield encode(word if index == 0 else ' ' + word)
+
+def _error(status=500):
+    return status, 'application/json', json.dumps({'error': {'message': 'injected failure', 'type': 'server_error'}}).encode()
+
+def _json(payload):
+    return 200, 'application/json', json.dumps(payload).encode()
+
+class FakeTelegram(FakeServer):
+    """Bot API methods the bots call, answered with minimal valid objects."""
+
+    service = 'telegram'
+
+    def __init__(self, profile, records):
+        super().__init__(profile, records)
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    @staticmethod
+    def _params(headers, body):
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body or b'{}')
+        if content_type.startswith('multipart/form-data'):
+            message = BytesParser(policy=HTTP).parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode() + body)
+            return {
+                part.get_param('name', header='content-disposition'): part.get_content() if part.get_filename() is None else b''
+                for part in message.iter_parts()
+            }
+        return {key: values[0] for key, values in urllib.parse.parse_qs(body.decode()).items()}
+
+    async def handle(self, record, method, path, query, headers, body):
+        api_method = path.rsplit('/', 1)[-1]
+        params = self._params(headers, body)
+        record.chat_id = int(params['chat_id']) if params.get('chat_id') else None
+        record.text = params.get('text')
+        await asyncio.sleep(self.profile.latency())
+        if api_method != 'getMe' and self.profile.fails():
+            retry_after = 1
+            return 429, 'application/json', json.dumps({
+                'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {retry_after}",
+                'parameters': {'retry_after': retry_after},
+            }).encode()
+
+        if api_method == 'getMe':
+            return _json({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}})
+        if api_method in ('sendMessage', 'editMessageText', 'sendVoice', 'sendAudio'):
+            message = {
+                'message_id': int(params.get('message_id') or next(self._message_ids)),
+                'date': int(time.time()),
+                'chat': {'id': record.chat_id, 'type': 'private'},
+            }
+            if record.text is not None:
+                message['text'] = record.text
+            if api_method in ('sendVoice', 'sendAudio'):
+                file_id = next(self._file_ids)
+                kind = 'voice' if api_method == 'sendVoice' else 'audio'
+                message[kind] = {'file_id': f"file{file_id}", 'file_unique_id': f"unique{file_id}", 'duration': 1}
+            return _json({'ok': True, 'result': message})
+        return _json({'ok': True, 'result': True})
+
+class FakeOpenAI(FakeServer):
+    """POST /v1/chat/completions, streaming or not."""
+
+    service = 'openai'
+
+    async def handle(self, record, method, path, query, headers, body):
+        request = json.loads(body)
+        messages = request.get('messages', [])
+        summary = bool(messages) and messages[0].get('content', '').startswith('Summarize')
+        record.service = 'openai-summary' if summary else 'openai'
+        record.tag = None if summary else find_tag(str(messages[-1].get('content', '')) if messages else '')
+        if self.profile.fails():
+            await asyncio.sleep(self.profile.latency(self.profile.ttft))
+            return _error()
+        text = reply_text(record.tag, random.randint(*self.profile.reply_words))
+        created = int(time.time())
+        if not request.get('stream'):
+            await asyncio.sleep(self.profile.latency())
+            return _json({
+                'id': 'chatcmpl-bench', 'object': 'chat.completion', 'created': created, 'model': request.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0},
+            })
+
+        def encode(token):
+            chunk = {
+                'id': 'chatcmpl-bench', 'object': 'chat.completion.chunk', 'created': created, 'model': request.get('model'),
+                'choices': [{'index': 0, 'delta': {'content': token}, 'finish_reason': None}],
+            }
+            return f"data: {json.dumps(chunk)}\n\n".encode()
+
+        async def events():
+            async for event in self._tokens(text, encode):
+                yield event
+            yield b"data: [DONE]\n\n"
+        return 200, 'text/event-stream', events()
+
+class FakeReplicate(FakeServer):
+    """Predictions API: create (finished or streaming), model version lookup and the stream URL."""
+
+    service = 'replicate'
+
+    def __init__(self, profile, records):
+        super().__init__(profile, records)
+        self._ids = itertools.count(1)
+        self._streams = {}
+
+    def _prediction(self, prediction_id, status, output=None, stream=False):
+        prediction = {
+            'id': prediction_id, 'model': 'bench/model', 'version': 'bench', 'status': status,
+            'input': {}, 'output': output, 'logs': '', 'error': None, 'metrics': {},
+            'created_at': None, 'started_at': None, 'completed_at': None,
+            'urls': {'get': f"{self.url}/v1/predictions/{prediction_id}", 'cancel': f"{self.url}/v1/predictions/{prediction_id}/cancel"},
+        }
+        if stream:
+            prediction['urls']['stream'] = f"{self.url}/stream/{prediction_id}"
+        return prediction
+
+    async def handle(self, record, method, path, query, headers, body):
+        if path.startswith('/v1/models/') and '/versions/' in path:
+            record.service = 'replicate-meta'
+            return _json({'id': path.rsplit('/', 1)[-1], 'created_at': '2024-01-01T00:00:00Z', 'cog_version': '0.9.0',
+                          'openapi_schema': {'components': {'schemas': {'Output': {'type': 'array', 'items': {'type': 'string'}}}}}})
+        if path.startswith('/stream/'):
+            text = self._streams.pop(path.rsplit('/', 1)[-1], '')
+            record.tag = find_tag(text)
+            counter = itertools.count(1)
+
+            def encode(token):
+                return f"event: output\nid: {next(counter)}\ndata: {token}\n\n".encode()
+
+            async def events():
+                async for event in self._tokens(text, encode):
+                    yield event
+                yield f"event: done\nid: {next(counter)}\ndata: {{}}\n\n".encode()
+            return 200, 'text/event-stream', events()
+
+        # POST /v1/predictions
+        request = json.loads(body)
+        record.tag = find_tag(' '.join(str(value) for value in request.get('input', {}).values()))
+        prediction_id = f"p{next(self._ids)}"
+        if self.profile.fails():
+            await asyncio.sleep(self.profile.latency(self.profile.ttft))
+            return _error()
+        text = reply_text(record.tag, random.randint(*self.profile.reply_words))
+        if request.get('stream'):
+            record.service = 'replicate-create'
+            self._streams[prediction_id] = text
+            return 201, 'application/json', json.dumps(self._prediction(prediction_id, 'starting', stream=True)).encode()
+        # Answer when the prediction has finished, like a create with "Prefer: wait"
+        await asyncio.sleep(self.profile.latency())
+        return 201, 'application/json', json.dumps(self._prediction(prediction_id, 'succeeded', output=[word if index == 0 else ' ' + word for index, word in enumerate(text.split(' '))])).encode()
+
+class FakeElevenLabs(FakeServer):
+    """POST /v1/text-to-speech/{voice_id}: streams audio bytes sized by the text length."""
+
+    service = 'elevenlabs'
+
+    async def handle(self, record, method, path, query, headers, body):
+        text = json.loads(body).get('text', '')
+        record.tag = find_tag(text)
+        await asyncio.sleep(self.profile.latency())
+        if self.profile.fails():
+            return _error()
+        size = max(1024, len(text) * self.profile.bytes_per_char)
+
+        async def chunks():
+            for offset in range(0, size, 16384):
+                yield b'\0' * min(16384, size - offset)
+        return 200, 'audio/ogg', chunks()
+
+class FakeGoogleTTS(FakeServer):
+    """The batchexecute endpoint gTTS calls, answering with base64 audio in Google's framing."""
+
+    service = 'gtts'
+
+    async def handle(self, record, method, path, query, headers, body):
+        text = urllib.parse.unquote(body.decode())
+        record.tag = find_tag(text)
+        await asyncio.sleep(self.profile.latency())
+        if self.profile.fails():
+            return _error()
+        audio = base64.b64encode(b'\0' * max(1024, len(text) * self.profile.bytes_per_char)).decode()
+        return 200, 'application/json', f')]}}\'\n\n[["wrb.fr","jQ1olc","[\\"{audio}\\"]",null,null,null,"generic"]]\n'.encode()
+
+SERVICES = {
+    'telegram': FakeTelegram,
+    'openai': FakeOpenAI,
+    'replicate': FakeReplicate,
+    'elevenlabs': FakeElevenLabs,
+    'gtts': FakeGoogleTTS,
+}
+
+class FakeServices:
+    """All fake services on one event loop in a background thread."""
+
+    def __init__(self, profiles=None):
+        self.profiles = profiles or {}
+        self.records = []  # Request objects, appended as requests arrive
+        self.servers = {}
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='fake-services', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        for name, server_class in SERVICES.items():
+            server = server_class(self.profiles.get(name), self.records)
+            asyncio.run_coroutine_threadsafe(server.start(), self._loop).result()
+            self.servers[name] = server
+        return self
+
+    def stop(self):
+        for server in self.servers.values():
+            asyncio.run_coroutine_threadsafe(server.stop(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def url(self, name):
+        return self.servers[name].url
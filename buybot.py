@@ -3,7 +3,6 @@
 import logging
 import os
 import asyncio
-from io import BytesIO
 
 from telegram import (
     Update,
@@ -23,54 +22,108 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-from openai import OpenAI
-from gtts import gTTS
 from dotenv import load_dotenv
 import database
+import async_database
+import user_cache
+import ledger
+import streaming
+import concurrency
+import response_cache
+import tts_cache
+import audio
+import tts_pipeline
+import outbound
+import update_processing
+import webhook
+import persistence
+import conversation
+import metrics
+import log_pipeline
+import profiler
+import providers
+import http_pool
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Enable detailed logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG  # Change to INFO or WARNING in production
-)
+# Enable detailed logging. Records are written from a background thread; see log_pipeline.py
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG')  # Change to INFO or WARNING in production
+LOG_LEVELS = os.getenv('LOG_LEVELS', 'httpx=INFO,httpcore=INFO')  # Per-logger levels, e.g. 'database=INFO'
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')  # DEBUG records kept per logger, e.g. 'database=0.1'
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # 'text' or 'json'
 logger = logging.getLogger(__name__)
 
 # Load environment variables or set your keys here
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN') or 'YOUR_TELEGRAM_BOT_TOKEN'
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY') or 'YOUR_OPENAI_API_KEY'
+# Bot API server; override to use a local Bot API server or a test stand-in
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', 'https://api.telegram.org/bot')
 # Removed PAYMENT_PROVIDER_TOKEN as it's not needed for Stars
 
-# Check if API keys are set
-if not TELEGRAM_BOT_TOKEN:
-    logger.error("TELEGRAM_BOT_TOKEN is not set.")
-    exit(1)
-
-if not OPENAI_API_KEY:
-    logger.error("OPENAI_API_KEY is not set.")
-    exit(1)
-
-# Initialize OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-# Initialize the database
-database.initialize_database()
+# Provider clients are built on first use (see providers.py); with this set they
+# are built in the background as soon as the bot has started
+PRELOAD_PROVIDERS = True
 
 # Define constants
 FREE_INTERACTIONS = 10
 CREDIT_COST_PER_INTERACTION = 1  # 1 Indecent Credit per interaction
-
-# Define the custom menu keyboard
-def get_main_menu_keyboard():
-    """Returns the main menu keyboard."""
-    keyboard = [
+STREAM_RESPONSES = True  # Send text replies progressively as the model generates them
+# Updates handled at once across users; each user's updates still run in order
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', update_processing.MAX_CONCURRENT_UPDATES))
+
+# Serving mode: 'polling' (default) or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL; the webhook is registered at startup when set
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', webhook.LISTEN)
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', webhook.PORT))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '1'))  # Processes sharing the port and the database
+
+# Prometheus metrics endpoint (GET /metrics); worker N of a webhook deployment listens on port + N
+METRICS_HOST = os.getenv('METRICS_HOST', metrics.METRICS_HOST)
+METRICS_PORT = int(os.getenv('METRICS_PORT', metrics.METRICS_PORT))  # 0 disables the endpoint
+
+# Telegram user ids allowed to use admin commands such as /profile
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+PROFILE_SECONDS = 30  # Default /profile duration
+PROFILER_SOCKET = os.getenv('PROFILER_SOCKET')  # Unix socket for profiler commands; unset disables it
+
+# Seconds between checks of every balance against the credit ledger; 0 disables them
+LEDGER_RECONCILE_INTERVAL = float(os.getenv('LEDGER_RECONCILE_INTERVAL', ledger.RECONCILE_INTERVAL))
+
+# LLM settings
+OPENAI_MODEL = "gpt-4"  # You can also use "gpt-3.5-turbo"
+OPENAI_ERROR_REPLY = "Sorry, I couldn't process that."
+OPENAI_SYSTEM_PROMPT = "You are a helpful assistant."
+OPENAI_PARAMS = {'max_tokens': 500, 'temperature': 0.7}  # Also part of the response cache key
+
+# Conversation memory: older turns are summarized with OpenAI so prompts stay within
+# conversation.PROMPT_TOKEN_BUDGET
+CONVERSATION_SUMMARIES = True
+CONVERSATION_SUMMARY_PROMPT = (
+    "Summarize this conversation for your own memory in under {max_tokens} tokens. "
+    "Keep names, facts, the user's preferences and unfinished threads; drop small talk."
+)
+GTTS_LANGUAGE = 'en'
+# gTTS only produces MP3; re-encode to OGG/Opus voice notes when ffmpeg is installed
+GTTS_OUTPUT_FORMAT = 'ogg_opus' if audio.FFMPEG else 'mp3'
+GTTS_AUDIO_EXTENSION = 'ogg' if audio.FFMPEG else 'mp3'
+
+# Define the custom menu keyboard once; every reply reuses the same markup
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    [
         ['🏠 Home', '📚 Help'],
         ['💰 Buy Credits', '💳 Balance'],
         ['🎁 Free Credits', '🔊 Audio On/Off']  # Both buttons in the same row
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+)
+
+def get_main_menu_keyboard():
+    """Returns the main menu keyboard."""
+    return MAIN_MENU_KEYBOARD
 
 # Define menu options
 MENU_OPTIONS = ['🏠 Home', '📚 Help', '💰 Buy Credits', '💳 Balance', '🎁 Free Credits', '🔊 Audio On/Off']
@@ -79,7 +132,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message with the main menu when the /start command is issued."""
     try:
         user_id = update.effective_user.id
-        user = database.get_user(user_id)
+        user = await user_cache.get_user(user_id)
         free_left = max(FREE_INTERACTIONS - user['free_interactions_used'], 0)
         indecent_credits = user['indecent_credits']
 
@@ -90,11 +143,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             f"Use the menu below to navigate through my features."
         )
 
-        await update.message.reply_text(welcome_text, reply_markup=get_main_menu_keyboard())
-        logger.debug(f"Sent welcome message to user {user_id} with main menu.")
+        await outbound.reply_text(update.message, welcome_text, reply_markup=get_main_menu_keyboard())
+        logger.debug("Sent welcome message with main menu", extra={'user_id': user_id})
     except Exception as e:
         logger.exception(f"Error in start handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred. Please try again later.")
+        await outbound.reply_text(update.message, "An unexpected error occurred. Please try again later.")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a help message when the /help command is issued."""
@@ -108,11 +161,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             "/balance - Check your current balance\n\n"
             "By default, I reply with text. Use /audio to receive voice messages."
         )
-        await update.message.reply_text(help_text, reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, help_text, reply_markup=get_main_menu_keyboard())
         logger.debug("Sent help message to user.")
     except Exception as e:
         logger.exception(f"Error in help_command handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while fetching help information.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while fetching help information.", reply_markup=get_main_menu_keyboard())
 
 async def toggle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Toggle audio responses for the user."""
@@ -121,17 +174,17 @@ async def toggle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         audio_enabled = user_data.get('audio_enabled', False)
         user_data['audio_enabled'] = not audio_enabled
         status = "enabled" if user_data['audio_enabled'] else "disabled"
-        await update.message.reply_text(f"Audio responses have been {status}.", reply_markup=get_main_menu_keyboard())
-        logger.debug(f"Audio responses have been {status} for user {update.effective_user.id}.")
+        await outbound.reply_text(update.message, f"Audio responses have been {status}.", reply_markup=get_main_menu_keyboard())
+        logger.debug("Toggled audio responses", extra={'user_id': update.effective_user.id, 'status': status})
     except Exception as e:
         logger.exception(f"Error in toggle_audio handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while toggling audio.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while toggling audio.", reply_markup=get_main_menu_keyboard())
 
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Display the user's current Indecent Credit balance and free interactions left."""
     try:
         user_id = update.effective_user.id
-        user = database.get_user(user_id)
+        user = await user_cache.get_user(user_id)
         indecent_credits = user['indecent_credits']
         free_left = max(FREE_INTERACTIONS - user['free_interactions_used'], 0)
 
@@ -139,78 +192,191 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             f"You have {free_left} free interactions left.\n"
             f"You currently have {indecent_credits} Indecent Credits."
         )
-        await update.message.reply_text(balance_text, reply_markup=get_main_menu_keyboard())
-        logger.debug(f"Displayed balance to user {user_id}.")
+        await outbound.reply_text(update.message, balance_text, reply_markup=get_main_menu_keyboard())
+        logger.debug("Displayed balance", extra={'user_id': user_id})
     except Exception as e:
         logger.exception(f"Error in balance handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while fetching your balance.", reply_markup=get_main_menu_keyboard())
-
-def generate_openai_response(user_id: int, user_text: str) -> str:
-    """Generate a response from OpenAI's ChatCompletion API."""
-    logger.debug(f"Generating OpenAI response for user {user_id} with message: {user_text}")
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",  # You can also use "gpt-3.5-turbo"
+        await outbound.reply_text(update.message, "An unexpected error occurred while fetching your balance.", reply_markup=get_main_menu_keyboard())
+
+def openai_messages(user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT) -> list:
+    """Build the OpenAI chat messages for a user message and the conversation so far."""
+    messages = [{"role": "system", "content": OPENAI_SYSTEM_PROMPT}]
+    if history.summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation: {history.summary}"})
+    messages.extend({"role": role, "content": content} for role, content in history.turns)
+    messages.append({"role": "user", "content": user_text})
+    return messages
+
+async def summarize_conversation(summary: str, turns: list) -> str:
+    """Fold earlier turns into the rolling conversation summary with OpenAI."""
+    transcript = "\n".join(f"{role}: {content}" for role, content in turns)
+    if summary:
+        transcript = f"Summary so far: {summary}\n\n{transcript}"
+    client = await providers.load('openai')
+    async with concurrency.limit('openai'):
+        response = await client.chat.completions.create(
+            model=OPENAI_MODEL,
             messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": user_text}
+                {"role": "system", "content": CONVERSATION_SUMMARY_PROMPT.format(max_tokens=conversation.SUMMARY_MAX_TOKENS)},
+                {"role": "user", "content": transcript},
             ],
-            max_tokens=500,
-            temperature=0.7,
+            max_tokens=conversation.SUMMARY_MAX_TOKENS,
+            temperature=0.2,
         )
+    return response.choices[0].message.content
+
+if CONVERSATION_SUMMARIES:
+    conversation.set_summarizer(summarize_conversation)
+
+async def generate_openai_response(user_id: int, user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT) -> str:
+    """Generate a response from OpenAI's ChatCompletion API."""
+    logger.debug("Generating OpenAI response", extra={'user_id': user_id, 'text': user_text})
+    try:
+        client = await providers.load('openai')
+        async with concurrency.limit('openai'):
+            response = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=openai_messages(user_text, history),
+                **OPENAI_PARAMS,
+            )
         # Extract and return the assistant's reply
         assistant_reply = response.choices[0].message.content.strip()
-        logger.debug(f"OpenAI response for user {user_id}: {assistant_reply}")
+        logger.debug("OpenAI response", extra={'user_id': user_id, 'reply': assistant_reply})
         return assistant_reply
     except Exception as e:
         logger.exception(f"Error communicating with OpenAI API for user {user_id}: {e}")
-        return "Sorry, I couldn't process that."
+        return OPENAI_ERROR_REPLY
+
+async def stream_openai_response(user_id: int, user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT):
+    """Yield the OpenAI response text as it is generated. Raises on failure."""
+    logger.debug("Streaming OpenAI response", extra={'user_id': user_id, 'text': user_text})
+    client = await providers.load('openai')
+    async with concurrency.limit('openai'):
+        stream = await client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=openai_messages(user_text, history),
+            **OPENAI_PARAMS,
+            stream=True,
+        )
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+def synthesize_speech(text: str) -> audio.AudioSpool:
+    """Convert text to speech with gTTS. Blocking; call through concurrency.run_blocking."""
+    tts = providers.get('gtts')(text=text, lang=GTTS_LANGUAGE)
+    audio_stream = audio.AudioSpool('mp3')
+    try:
+        tts.write_to_fp(audio_stream)
+    except Exception:
+        audio_stream.close()
+        raise
+    audio_stream.seek(0)
+    return audio_stream
+
+async def synthesize_voice(text: str) -> audio.AudioSpool:
+    """Synthesize speech with gTTS on its bounded executor, as OGG/Opus if ffmpeg is available."""
+    speech = await concurrency.run_blocking('gtts', synthesize_speech, text)
+    if audio.FFMPEG:
+        return await audio.to_opus(speech)
+    return speech
+
+async def stream_reply(update: Update, user_id: int, user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT) -> tuple:
+    """
+    Stream a reply from OpenAI. Returns (delivered, response_text): delivered is False
+    if no reply was produced, and response_text is None unless the reply completed.
+    """
+    reply = streaming.StreamingReply(update.message, reply_markup=get_main_menu_keyboard())
+    try:
+        async for text in stream_openai_response(user_id, user_text, history):
+            await reply.append(text)
+        response_text = (await reply.finish()).strip()
+        logger.debug("Streamed OpenAI response", extra={'user_id': user_id, 'reply': response_text})
+        return bool(response_text), response_text or None
+    except Exception as e:
+        logger.exception(f"Error streaming OpenAI response for user {user_id}: {e}")
+        if reply.started:
+            # The user already has part of the answer; finish what was sent
+            try:
+                await reply.finish()
+            except Exception as e:
+                logger.exception(f"Error finishing partial streamed response for user {user_id}: {e}")
+            return True, None
+        return False, None
+
+async def send_unspoken_text(update: Update, user_id: int, segments: list) -> None:
+    """Send the part of a reply that could not be spoken as text, so the user still gets all of it."""
+    logger.warning(f"Audio failed for user {user_id}; sending the remaining {len(segments)} segment(s) as text.")
+    remainder = ' '.join(segments)
+    for i in range(0, len(remainder), 4000):
+        await outbound.reply_text(update.message, remainder[i:i+4000], reply_markup=get_main_menu_keyboard())
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle incoming messages and respond via OpenAI ChatCompletion API."""
     try:
         user_text = update.message.text
         user_id = update.effective_user.id
-        logger.debug(f"Received message from user {user_id}: {user_text}")
-
-        user = database.get_user(user_id)
-        logger.debug(f"User data: {user}")
+        logger.debug("Received message", extra={'user_id': user_id, 'text': user_text})
+
+        # Use a free interaction or consume Indecent Credits in a single atomic database call
+        charge = await user_cache.charge_interaction(user_id, FREE_INTERACTIONS, CREDIT_COST_PER_INTERACTION)
+        logger.debug("Charge result", extra={'user_id': user_id, 'charged': charge['charged'], 'free': charge['free'],
+                                             'credits': charge['indecent_credits']})
+
+        if not charge['charged']:
+            # User has no Indecent Credits left, prompt to buy more
+            keyboard = [
+                [InlineKeyboardButton("💰 Buy Indecent Credits", callback_data='buy_credits')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await outbound.reply_text(
+                update.message,
+                "You have used all your free interactions and no Indecent Credits left. Please purchase more Indecent Credits to continue.",
+                reply_markup=reply_markup
+            )
+            logger.debug("No Indecent Credits left, prompted to buy credits", extra={'user_id': user_id})
+            return
 
-        # Check if user has free interactions left
-        if user['free_interactions_used'] < FREE_INTERACTIONS:
-            # Increment free interactions used
-            database.increment_free_interactions(user_id)
-            logger.debug(f"User {user_id} has free interactions remaining.")
+        if charge['free']:
+            logger.debug("Used a free interaction", extra={'user_id': user_id})
         else:
-            # Check if user has enough Indecent Credits
-            if user['indecent_credits'] >= CREDIT_COST_PER_INTERACTION:
-                # Consume Indecent Credits
-                success = database.consume_credit(user_id)
-                if not success:
-                    await update.message.reply_text("An error occurred while consuming an Indecent Credit. Please try again.", reply_markup=get_main_menu_keyboard())
-                    return
-                logger.debug(f"User {user_id} consumed {CREDIT_COST_PER_INTERACTION} Indecent Credit(s). Remaining credits: {user['indecent_credits'] - CREDIT_COST_PER_INTERACTION}")
-            else:
-                # User has no Indecent Credits left, prompt to buy more
-                keyboard = [
-                    [InlineKeyboardButton("💰 Buy Indecent Credits", callback_data='buy_credits')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await update.message.reply_text(
-                    "You have used all your free interactions and no Indecent Credits left. Please purchase more Indecent Credits to continue.",
-                    reply_markup=reply_markup
-                )
-                logger.debug(f"User {user_id} has no Indecent Credits left. Prompted to buy credits.")
-                return
-
-        # Generate response from OpenAI
-        response_text = await asyncio.get_event_loop().run_in_executor(None, generate_openai_response, user_id, user_text)
-
-        # Check if OpenAI returned an error message
-        if response_text == "Sorry, I couldn't process that.":
-            await update.message.reply_text(response_text, reply_markup=get_main_menu_keyboard())
-            logger.debug(f"Sent error message to user {user_id}.")
+            logger.debug("Consumed Indecent Credits", extra={'user_id': user_id, 'cost': CREDIT_COST_PER_INTERACTION})
+
+        # Earlier turns that fit the prompt budget
+        history = await conversation.build_context(user_id, user_text, OPENAI_SYSTEM_PROMPT)
+
+        # Repeated opening prompts are answered from the response cache without calling OpenAI.
+        # Only fresh conversations are cached: with history in the key a later message
+        # practically never repeats, so looking it up would only cost a database read
+        cacheable = history.fingerprint is None
+        cache_key_parts = (OPENAI_MODEL, OPENAI_SYSTEM_PROMPT, dict(OPENAI_PARAMS, history=None))
+        response_text = await response_cache.get(user_text, *cache_key_parts) if cacheable else None
+        if response_text:
+            logger.debug("Response cache hit", extra={'user_id': user_id})
+        elif STREAM_RESPONSES and not context.user_data.get('audio_enabled', False):
+            # Stream text replies so the user sees the first tokens right away
+            delivered, response_text = await stream_reply(update, user_id, user_text, history)
+            if not delivered:
+                await outbound.reply_text(update.message, OPENAI_ERROR_REPLY, reply_markup=get_main_menu_keyboard())
+                logger.debug("Sent error message", extra={'user_id': user_id})
+            elif response_text:
+                if cacheable:
+                    await response_cache.put(user_text, *cache_key_parts, response_text)
+                await conversation.record(user_id, user_text, response_text)
             return
+        else:
+            # Generate response from OpenAI
+            response_text = await generate_openai_response(user_id, user_text, history)
+
+            # Check if OpenAI returned an error message
+            if response_text == OPENAI_ERROR_REPLY:
+                await outbound.reply_text(update.message, response_text, reply_markup=get_main_menu_keyboard())
+                logger.debug("Sent error message", extra={'user_id': user_id})
+                return
+            if cacheable:
+                await response_cache.put(user_text, *cache_key_parts, response_text)
+        await conversation.record(user_id, user_text, response_text)
 
         # Split the response into chunks to adhere to Telegram's message limits (4096 characters)
         message_chunks = [response_text[i:i+4000] for i in range(0, len(response_text), 4000)]
@@ -218,30 +384,36 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Check if user has enabled audio responses
         if context.user_data.get('audio_enabled', False):
             try:
-                tts = gTTS(text=response_text, lang='en')
-                audio_bytes = BytesIO()
-                tts.write_to_fp(audio_bytes)
-                audio_bytes.seek(0)
-
-                # Send the audio
-                await update.message.reply_voice(voice=audio_bytes)
-                logger.debug(f"Sent audio response to user {user_id}.")
+                # Speak the reply a few sentences at a time, so the first voice message
+                # arrives quickly. gTTS is blocking, so it runs on its own bounded
+                # executor; segments sent before come from the TTS cache.
+                unsent = await tts_pipeline.send_speech(
+                    update.message,
+                    response_text,
+                    lambda segment: tts_cache.cache_key(segment, 'gtts', GTTS_LANGUAGE, None, GTTS_OUTPUT_FORMAT),
+                    synthesize_voice,
+                    GTTS_AUDIO_EXTENSION,
+                )
+                if unsent:
+                    await send_unspoken_text(update, user_id, unsent)
+                else:
+                    logger.debug("Sent audio response", extra={'user_id': user_id})
             except Exception as e:
                 logger.exception(f"Error generating or sending audio response to user {user_id}: {e}")
-                await update.message.reply_text("Sorry, I couldn't generate an audio response.", reply_markup=get_main_menu_keyboard())
+                await outbound.reply_text(update.message, "Sorry, I couldn't generate an audio response.", reply_markup=get_main_menu_keyboard())
         else:
             for chunk in message_chunks:
-                await update.message.reply_text(chunk, reply_markup=get_main_menu_keyboard())
-                logger.debug(f"Sent text response chunk to user {user_id}.")
+                await outbound.reply_text(update.message, chunk, reply_markup=get_main_menu_keyboard())
+                logger.debug("Sent text response chunk", extra={'user_id': user_id, 'chars': len(chunk)})
     except Exception as e:
         logger.exception(f"Error in handle_message handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while processing your message.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while processing your message.", reply_markup=get_main_menu_keyboard())
 
 async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Initiate the purchase process for additional Indecent Credits by presenting credit packages directly."""
     try:
         user_id = update.effective_user.id
-        logger.debug(f"User {user_id} initiated purchase.")
+        logger.debug("Initiated purchase", extra={'user_id': user_id})
 
         # Define Indecent Credit packages without referencing currency
         credit_packages = {
@@ -259,14 +431,14 @@ async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             [InlineKeyboardButton("💰 1000 Indecent Credits", callback_data='purchase_1000_credits')],
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
+        await outbound.reply_text(update.message,
             "Select the number of Indecent Credits you want to purchase:",
             reply_markup=reply_markup
         )
-        logger.debug(f"User {user_id} presented with credit package options.")
+        logger.debug("Presented credit package options", extra={'user_id': user_id})
     except Exception as e:
         logger.exception(f"Error in buy handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while initiating the purchase.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while initiating the purchase.", reply_markup=get_main_menu_keyboard())
 
 async def process_purchase_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Process the purchase button and send the invoice."""
@@ -287,7 +459,7 @@ async def process_purchase_button(update: Update, context: ContextTypes.DEFAULT_
         elif data == 'purchase_1000_credits':
             credits = 1000
         else:
-            await query.edit_message_text(text="Invalid selection.")
+            await outbound.edit_query_text(query, "Invalid selection.")
             logger.warning(f"User {user_id} made an invalid purchase selection: {data}")
             return
 
@@ -302,7 +474,7 @@ async def process_purchase_button(update: Update, context: ContextTypes.DEFAULT_
 
         # Send the invoice using Telegram Stars
         try:
-            await context.bot.send_invoice(
+            await outbound.send(user_id, lambda: context.bot.send_invoice(
                 chat_id=user_id,
                 title=f"Purchase {credits} Indecent Credits",
                 description=f"Get {credits} Indecent Credits.",
@@ -315,20 +487,20 @@ async def process_purchase_button(update: Update, context: ContextTypes.DEFAULT_
                 need_phone_number=False,
                 need_email=False,
                 is_flexible=False,
-            )
-            logger.debug(f"Sent invoice to user {user_id} for {credits} Indecent Credits.")
+            ))
+            logger.debug("Sent invoice", extra={'user_id': user_id, 'credits': credits})
         except Exception as e:
             logger.exception(f"Error sending invoice to user {user_id}: {e}")
-            await query.edit_message_text(text="Sorry, an error occurred while processing your purchase. Please try again later.")
+            await outbound.edit_query_text(query, "Sorry, an error occurred while processing your purchase. Please try again later.")
     except Exception as e:
         logger.exception(f"Error in process_purchase_button handler: {e}")
-        await update.callback_query.message.reply_text("An unexpected error occurred. Please try again later.")
+        await outbound.reply_text(update.callback_query.message, "An unexpected error occurred. Please try again later.")
 
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Answer the PreCheckoutQuery."""
     try:
         query = update.pre_checkout_query
-        logger.debug(f"Received PreCheckoutQuery from user {query.from_user.id}: {query.invoice_payload}")
+        logger.debug("Received PreCheckoutQuery", extra={'user_id': query.from_user.id, 'payload': query.invoice_payload})
 
         # Verify the payload format
         if not (query.invoice_payload.startswith("purchase_") and query.invoice_payload.endswith("_credits")):
@@ -339,7 +511,7 @@ async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYP
         # Approve the pre-checkout query
         try:
             await query.answer(ok=True)
-            logger.debug(f"PreCheckoutQuery approved for user {query.from_user.id}.")
+            logger.debug("PreCheckoutQuery approved", extra={'user_id': query.from_user.id})
         except Exception as e:
             logger.exception(f"Error answering PreCheckoutQuery for user {query.from_user.id}: {e}")
             await query.answer(ok=False, error_message="An error occurred. Please try again.")
@@ -352,7 +524,7 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
         message = update.message
         successful_payment: SuccessfulPayment = message.successful_payment
         user_id = message.from_user.id
-        logger.debug(f"Received successful payment from user {user_id}: {successful_payment}")
+        logger.debug("Received successful payment", extra={'user_id': user_id, 'payment': successful_payment})
 
         # Extract the payload to determine the number of Indecent Credits purchased
         payload = successful_payment.invoice_payload
@@ -360,36 +532,73 @@ async def successful_payment_callback(update: Update, context: ContextTypes.DEFA
         if payload.startswith("purchase_") and payload.endswith("_credits"):
             try:
                 credits_purchased = int(payload.split('_')[1])
-                database.add_credits(user_id, credits_purchased)
-                await message.reply_text(f"Thank you for your purchase! You have been credited with {credits_purchased} Indecent Credits.", reply_markup=get_main_menu_keyboard())
-                logger.debug(f"User {user_id} purchased {credits_purchased} Indecent Credits.")
+                # Keyed on the charge id, so a redelivered update doesn't credit the purchase twice
+                if not await user_cache.apply_payment(user_id, successful_payment.telegram_payment_charge_id, credits_purchased):
+                    await outbound.reply_text(message, "This payment has already been credited.", reply_markup=get_main_menu_keyboard())
+                    logger.warning("Ignored a repeated successful payment",
+                                   extra={'user_id': user_id, 'charge_id': successful_payment.telegram_payment_charge_id})
+                    return
+                await outbound.reply_text(message, f"Thank you for your purchase! You have been credited with {credits_purchased} Indecent Credits.", reply_markup=get_main_menu_keyboard())
+                logger.debug("Purchased Indecent Credits", extra={'user_id': user_id, 'credits': credits_purchased})
             except ValueError:
-                await message.reply_text("Payment received, but could not determine the purchase details.", reply_markup=get_main_menu_keyboard())
+                await outbound.reply_text(message, "Payment received, but could not determine the purchase details.", reply_markup=get_main_menu_keyboard())
                 logger.warning(f"User {user_id} sent a payment with invalid payload: {payload}")
         else:
-            await message.reply_text("Payment received, but could not determine the purchase details.", reply_markup=get_main_menu_keyboard())
+            await outbound.reply_text(message, "Payment received, but could not determine the purchase details.", reply_markup=get_main_menu_keyboard())
             logger.warning(f"User {user_id} sent a payment with invalid payload: {payload}")
     except Exception as e:
         logger.exception(f"Error in successful_payment_callback handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred after your payment. Please contact support.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred after your payment. Please contact support.", reply_markup=get_main_menu_keyboard())
 
 async def reset_interactions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Reset the user's free interactions used."""
     try:
         user_id = update.effective_user.id
-        database.update_user(user_id, free_interactions_used=0)
-        await update.message.reply_text("Your free interactions have been reset to 10.", reply_markup=get_main_menu_keyboard())
-        logger.debug(f"Reset free interactions for user {user_id}.")
+        await user_cache.update_user(user_id, free_interactions_used=0)
+        await outbound.reply_text(update.message, "Your free interactions have been reset to 10.", reply_markup=get_main_menu_keyboard())
+        logger.debug("Reset free interactions", extra={'user_id': user_id})
     except Exception as e:
         logger.exception(f"Error in reset_interactions handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while resetting your interactions.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while resetting your interactions.", reply_markup=get_main_menu_keyboard())
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Record a sampling profile of the live bot: /profile [seconds]. Admins only."""
+    try:
+        user_id = update.effective_user.id
+        if user_id not in ADMIN_USER_IDS:
+            logger.warning(f"User {user_id} tried to use /profile without admin rights.")
+            return
+        try:
+            seconds = float(context.args[0]) if context.args else PROFILE_SECONDS
+        except ValueError:
+            await outbound.reply_text(update.message, "Usage: /profile [seconds]")
+            return
+        if profiler.active():
+            await outbound.reply_text(update.message, "A profile is already running.")
+            return
+        seconds = min(seconds, profiler.MAX_SECONDS)
+        await outbound.reply_text(update.message, f"Profiling for {seconds:.0f} seconds...")
+        # Recorded in the background, so this update doesn't hold a running slot meanwhile
+        context.application.create_task(send_profile(update.message, seconds))
+        logger.info("Started a profile", extra={'user_id': user_id, 'seconds': seconds})
+    except Exception as e:
+        logger.exception(f"Error in profile_command handler for user {update.effective_user.id}: {e}")
+
+async def send_profile(message, seconds: float) -> None:
+    """Record a profile and reply with its summary."""
+    try:
+        summary = await profiler.profile(seconds)
+        await outbound.reply_text(message, profiler.format_summary(summary))
+    except Exception as e:
+        logger.exception(f"Error recording a profile: {e}")
+        await outbound.reply_text(message, f"Profiling failed: {e}")
 
 async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle menu button presses."""
     try:
         user_text = update.message.text
         user_id = update.effective_user.id
-        logger.debug(f"Received menu button press from user {user_id}: {user_text}")
+        logger.debug("Received menu button press", extra={'user_id': user_id, 'text': user_text})
 
         if user_text == '🏠 Home':
             await start(update, context)
@@ -405,11 +614,11 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             await toggle_audio(update, context)
         else:
             # Handle unexpected inputs
-            await update.message.reply_text("Please choose an option from the menu below.", reply_markup=get_main_menu_keyboard())
-            logger.debug(f"User {user_id} sent an unexpected input: {user_text}")
+            await outbound.reply_text(update.message, "Please choose an option from the menu below.", reply_markup=get_main_menu_keyboard())
+            logger.debug("Unexpected input", extra={'user_id': user_id, 'text': user_text})
     except Exception as e:
         logger.exception(f"Error in menu_handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while processing your menu selection.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while processing your menu selection.", reply_markup=get_main_menu_keyboard())
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle all exceptions."""
@@ -418,15 +627,97 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     # Notify the user about the error
     if isinstance(update, Update) and update.effective_message:
         try:
-            await update.effective_message.reply_text(
+            await outbound.reply_text(update.effective_message,
                 "An unexpected error occurred. Please try again later."
             )
         except Exception as e:
             logger.exception(f"Failed to send error message to user: {e}")
 
-def main() -> None:
-    """Start the bot."""
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+def _openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_pool.client('openai'))  # Async, so requests never block the event loop
+
+def _gtts_client():
+    from gtts import gTTS
+    return gTTS  # gTTS has no client object; each synthesis builds a gTTS instance
+
+_configured = False
+
+def configure() -> None:
+    """
+    Set up logging, check the API keys, register the provider clients and
+    prepare the database. Importing this module does none of this, so it can be
+    imported without keys; main() and build_application() call it first.
+    """
+    global _configured
+    if _configured:
+        return
+    log_pipeline.configure(
+        level=LOG_LEVEL,
+        levels=log_pipeline.parse_levels(LOG_LEVELS),
+        sample_rates=log_pipeline.parse_rates(LOG_SAMPLE_RATES),
+        json_format=LOG_FORMAT == 'json',
+    )
+
+    # Check if API keys are set
+    for name, value in (('TELEGRAM_BOT_TOKEN', TELEGRAM_BOT_TOKEN), ('OPENAI_API_KEY', OPENAI_API_KEY)):
+        if not value:
+            logger.error(f"{name} is not set.")
+            exit(1)
+
+    providers.register('openai', _openai_client)
+    providers.register('gtts', _gtts_client)
+
+    # Initialize the database
+    database.initialize_database()
+    ledger.configure(reconcile_interval=LEDGER_RECONCILE_INTERVAL)
+    _configured = True
+
+async def post_init(application) -> None:
+    """Start write-back of cached balances, ledger checks, the metrics endpoint and the profiler socket."""
+    await user_cache.start(application)
+    await ledger.start(application)
+    if PRELOAD_PROVIDERS:
+        providers.start_preload()
+    if METRICS_PORT:
+        try:
+            await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Metrics endpoint not started on {METRICS_HOST}:{METRICS_PORT}: {e}")
+    if PROFILER_SOCKET:
+        try:
+            await profiler.start_control_socket(PROFILER_SOCKET)
+        except OSError as e:
+            logger.error(f"Profiler control socket not started at {PROFILER_SOCKET}: {e}")
+
+async def post_shutdown(application) -> None:
+    """Let queued replies go out, then flush cached balances."""
+    await providers.stop_preload()
+    await outbound.stop(application)
+    await user_cache.stop(application)
+    await ledger.stop(application)
+    await metrics.stop_server()
+    profiler.stop()
+    await profiler.stop_control_socket()
+    logger.info("Outbound queue stats", extra=outbound.stats())
+    logger.info("HTTP pool stats", extra={'pools': http_pool.stats()})
+    await http_pool.close()
+
+def build_application():
+    """Build the Application with all handlers registered."""
+    configure()
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        .request(http_pool.TelegramRequest('telegram'))  # Keep-alive pool shared by all Bot API calls
+        .get_updates_request(http_pool.TelegramRequest('telegram_updates', connection_pool_size=1))
+        .concurrent_updates(update_processing.PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(persistence.SQLitePersistence())  # Keep user settings such as the audio toggle across restarts
+        .post_init(post_init)              # Start write-back of cached balances and the metrics endpoint
+        .post_shutdown(post_shutdown)      # Send queued replies and flush cached balances before exit
+        .build()
+    )
 
     # Define menu options regex filter
     menu_filter = filters.Regex(f"^({'|'.join(MENU_OPTIONS)})$")
@@ -438,6 +729,7 @@ def main() -> None:
     application.add_handler(CommandHandler("buy", buy))
     application.add_handler(CommandHandler("balance", balance))
     application.add_handler(CommandHandler("reset", reset_interactions))  # Optional command
+    application.add_handler(CommandHandler("profile", profile_command))  # Admins only, see ADMIN_USER_IDS
 
     # Register message handlers
     application.add_handler(MessageHandler(menu_filter, menu_handler))  # Handle menu button presses
@@ -451,9 +743,34 @@ def main() -> None:
     # Register the error handler
     application.add_error_handler(error_handler)
 
-    # Start the Bot
-    logger.info("Bot is starting...")
-    application.run_polling()
+    return application
+
+def release_resources() -> None:
+    """Let pending database writes finish and stop the provider executors."""
+    async_database.shutdown()
+    concurrency.shutdown()
+    logger.info("Provider init seconds", extra={'providers': providers.stats()})
+
+def main() -> None:
+    """Start the bot."""
+    configure()
+    logger.info("Bot is starting", extra={'mode': BOT_MODE})
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_SECRET_TOKEN:
+            logger.warning("WEBHOOK_SECRET_TOKEN is not set; anyone who finds the webhook URL can post updates.")
+        webhook.run(
+            build_application,
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            workers=WEBHOOK_WORKERS,
+            ready_check=async_database.ping,
+            cleanup=release_resources,
+        )
+        return
+    build_application().run_polling()
+    release_resources()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,98 @@
+# concurrency.py
+#
+# Per-provider concurrency limits and named, explicitly sized executors for
+# the few calls that have no async client (gTTS). Keeps blocking work off the
+# event loop and out of asyncio's default executor, whose min(32, cpu + 4)
+# threads would otherwise silently cap every provider at once.
+
+import asyncio
+import contextvars
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Maximum concurrent requests per provider
+PROVIDER_LIMITS = {
+    'openai': 64,
+    'replicate': 32,
+    'elevenlabs': 8,
+    'gtts': 4,
+    'disk': 4,  # Cache file reads and writes
+    'ffmpeg': 4,
+}
+DEFAULT_LIMIT = 16
+
+class ProviderLimit:
+    """An asyncio semaphore that also counts running and waiting calls."""
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __aenter__(self):
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+_limits = {}
+_executors = {}
+
+metrics.gauge('bot_provider_in_flight', 'Provider calls running.', ('provider',),
+              callback=lambda: {(name,): provider_limit.in_flight for name, provider_limit in _limits.items()})
+metrics.gauge('bot_provider_waiting', 'Provider calls waiting for the concurrency limit.', ('provider',),
+              callback=lambda: {(name,): provider_limit.waiting for name, provider_limit in _limits.items()})
+metrics.gauge('bot_executor_queue_depth', 'Blocking calls queued on a provider executor.', ('provider',),
+              callback=lambda: {(name,): pool._work_queue.qsize() for name, pool in _executors.items()})
+
+def limit(provider):
+    """Return the concurrency limit for a provider: `async with concurrency.limit('openai'):`."""
+    provider_limit = _limits.get(provider)
+    if provider_limit is None:
+        provider_limit = _limits[provider] = ProviderLimit(provider, PROVIDER_LIMITS.get(provider, DEFAULT_LIMIT))
+    return provider_limit
+
+def executor(provider):
+    """Return the named thread pool for a provider's blocking calls, sized to its limit."""
+    pool = _executors.get(provider)
+    if pool is None:
+        pool = _executors[provider] = ThreadPoolExecutor(
+            max_workers=PROVIDER_LIMITS.get(provider, DEFAULT_LIMIT),
+            thread_name_prefix=provider,
+        )
+    return pool
+
+async def run_blocking(provider, func, *args, **kwargs):
+    """Run a blocking provider call on that provider's executor, within its limit."""
+    async with limit(provider):
+        loop = asyncio.get_running_loop()
+        # Carry context variables (e.g. the audio memory meter) into the thread, as asyncio.to_thread does
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(executor(provider), functools.partial(context.run, func, *args, **kwargs))
+
+def stats():
+    """In-flight and waiting calls per provider."""
+    return {
+        name: {'limit': provider_limit.limit, 'in_flight': provider_limit.in_flight, 'waiting': provider_limit.waiting}
+        for name, provider_limit in _limits.items()
+    }
+
+def shutdown():
+    """Shut down the provider executors."""
+    for pool in _executors.values():
+        pool.shutdown(wait=False, cancel_futures=True)
+    _executors.clear()
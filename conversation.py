@@ -0,0 +1,242 @@
+# conversation.py
+#
+# Per-user conversation memory with a bounded prompt. Each user's turns live
+# in a fixed-size ring buffer in the conversation_turns table, and recently
+# active conversations are kept in memory. A prompt gets the newest turns
+# that fit its token budget; with a summarizer set, older turns are folded
+# into a rolling summary instead of being forgotten. Either way the prompt
+# sent to the model stays under PROMPT_TOKEN_BUDGET however long the chat runs.
+
+import asyncio
+import hashlib
+import json
+import logging
+from collections import OrderedDict, deque, namedtuple
+
+import async_database
+
+try:
+    import tiktoken
+except ImportError:  # Optional; token counts are estimated without it
+    tiktoken = None
+
+logger = logging.getLogger(__name__)
+
+RING_SIZE = 32                # Turns stored per user; a message and its reply are two turns
+PROMPT_TOKEN_BUDGET = 3000    # System prompt, summary, history and the new message together
+MESSAGE_OVERHEAD_TOKENS = 4   # Role and separator tokens the chat format adds per message
+SUMMARY_MAX_TOKENS = 300      # Length the summarizer is asked to stay under
+COMPACT_AT_TOKENS = 2000      # Fold older turns into the summary once unsummarized turns exceed this
+KEEP_RECENT_TURNS = 6         # Most turns kept unfolded after a compaction
+MAX_CONVERSATIONS = 5000      # Conversations kept in memory
+TOKEN_ENCODING = 'o200k_base'
+
+Turn = namedtuple('Turn', 'seq role content tokens')
+
+class Context(namedtuple('Context', 'summary turns')):
+    """What a prompt should include besides the system prompt and the new message."""
+
+    @property
+    def fingerprint(self):
+        """Stable hash of the context for cache keys, or None for a fresh conversation."""
+        if not self.summary and not self.turns:
+            return None
+        material = json.dumps([self.summary, self.turns], separators=(',', ':'))
+        return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+EMPTY_CONTEXT = Context('', ())
+
+_encoding = None
+_encoding_failed = False
+
+def count_tokens(text):
+    """Tokens in text, with tiktoken if it is installed, otherwise a conservative estimate."""
+    global _encoding, _encoding_failed
+    if tiktoken is not None and _encoding is None and not _encoding_failed:
+        try:
+            _encoding = tiktoken.get_encoding(TOKEN_ENCODING)
+        except Exception as e:
+            _encoding_failed = True
+            logger.warning(f"Could not load tiktoken encoding {TOKEN_ENCODING}, estimating tokens: {e}")
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    # English averages about four characters per token; assume three to stay under budget
+    return (len(text) + 2) // 3
+
+class Conversation:
+    """A user's summary and unsummarized turns, oldest first."""
+
+    def __init__(self, user_id, summary, summary_tokens, summarized_through, turns):
+        self.user_id = user_id
+        self.summary = summary
+        self.summary_tokens = summary_tokens
+        self.summarized_through = summarized_through
+        self.turns = deque((Turn(*turn) for turn in turns), maxlen=RING_SIZE)
+        self.next_seq = max(summarized_through, self.turns[-1].seq if self.turns else -1) + 1
+        self.compacting = False
+
+    @property
+    def turn_tokens(self):
+        return sum(turn.tokens for turn in self.turns)
+
+class ConversationStore:
+    """Hot tier of Conversation objects over the database ring buffers."""
+
+    def __init__(self, max_conversations=MAX_CONVERSATIONS, budget=PROMPT_TOKEN_BUDGET):
+        self.max_conversations = max_conversations
+        self.budget = budget
+        self.summarizer = None  # async (summary, [(role, content)]) -> new summary
+        self._conversations = OrderedDict()
+        self._compactions = set()
+        self.hits = 0
+        self.misses = 0
+        self.compactions = 0
+        self.max_prompt_tokens = 0
+
+    async def _load(self, user_id):
+        conversation = self._conversations.get(user_id)
+        if conversation is not None:
+            self._conversations.move_to_end(user_id)
+            self.hits += 1
+            return conversation
+        self.misses += 1
+        conversation = Conversation(user_id, *await async_database.get_conversation(user_id))
+        self._conversations[user_id] = conversation
+        while len(self._conversations) > self.max_conversations:
+            self._conversations.popitem(last=False)
+        return conversation
+
+    async def build_context(self, user_id, user_text, system_prompt):
+        """
+        Return the Context for a new message: the summary and the newest turns
+        that fit in the budget left after the system prompt and the message.
+        """
+        conversation = await self._load(user_id)
+        fixed = count_tokens(system_prompt) + count_tokens(user_text) + 2 * MESSAGE_OVERHEAD_TOKENS
+        available = self.budget - fixed
+        summary = conversation.summary
+        if summary:
+            if conversation.summary_tokens + MESSAGE_OVERHEAD_TOKENS <= available:
+                available -= conversation.summary_tokens + MESSAGE_OVERHEAD_TOKENS
+            else:
+                summary = ''
+
+        selected = []
+        for turn in reversed(conversation.turns):
+            if turn.tokens > available:
+                break
+            available -= turn.tokens
+            selected.append(turn)
+        selected.reverse()
+        # Start on a user turn so the model never sees a reply without its question
+        while selected and selected[0].role != 'user':
+            available += selected.pop(0).tokens
+
+        self.max_prompt_tokens = max(self.max_prompt_tokens, self.budget - max(available, 0))
+        return Context(summary, tuple((turn.role, turn.content) for turn in selected))
+
+    async def record(self, user_id, user_text, reply):
+        """Append a message and its reply, then compact in the background if needed."""
+        conversation = await self._load(user_id)
+        seq = conversation.next_seq
+        conversation.next_seq += 2
+        turns = [
+            Turn(seq, 'user', user_text, count_tokens(user_text) + MESSAGE_OVERHEAD_TOKENS),
+            Turn(seq + 1, 'assistant', reply, count_tokens(reply) + MESSAGE_OVERHEAD_TOKENS),
+        ]
+        conversation.turns.extend(turns)
+        try:
+            await async_database.append_conversation_turns(user_id, turns, RING_SIZE)
+        except Exception as e:
+            # Memory is best effort; never fail the reply because of it
+            logger.exception(f"Failed to persist conversation turns for user {user_id}: {e}")
+
+        if self.summarizer is not None and not conversation.compacting and conversation.turn_tokens > COMPACT_AT_TOKENS:
+            conversation.compacting = True
+            task = asyncio.create_task(self._compact(conversation))
+            self._compactions.add(task)
+            task.add_done_callback(self._compactions.discard)
+
+    async def _compact(self, conversation):
+        # Fold everything but the newest turns into the summary, keeping at most half
+        # the threshold so the next compaction is several messages away
+        try:
+            turns = list(conversation.turns)
+            keep, kept_tokens = 0, 0
+            for turn in reversed(turns[-KEEP_RECENT_TURNS:]):
+                if keep >= 2 and kept_tokens + turn.tokens > COMPACT_AT_TOKENS // 2:
+                    break
+                keep += 1
+                kept_tokens += turn.tokens
+            keep -= keep % 2  # Whole exchanges, so the kept turns start on a user message
+            folded = turns[:-keep]
+            if not folded:
+                return
+            summary = (await self.summarizer(conversation.summary, [(turn.role, turn.content) for turn in folded])).strip()
+            tokens = count_tokens(summary)
+            through = folded[-1].seq
+            await async_database.store_conversation_summary(conversation.user_id, summary, tokens, through)
+            conversation.summary = summary
+            conversation.summary_tokens = tokens
+            conversation.summarized_through = through
+            while conversation.turns and conversation.turns[0].seq <= through:
+                conversation.turns.popleft()
+            self.compactions += 1
+            logger.debug("Compacted conversation turns", extra={'user_id': conversation.user_id, 'turns': len(folded), 'tokens': tokens})
+        except Exception as e:
+            # The turns stay as they are; the trimmer still keeps the prompt in budget
+            logger.exception(f"Failed to summarize conversation for user {conversation.user_id}: {e}")
+        finally:
+            conversation.compacting = False
+
+    async def clear(self, user_id):
+        """Forget a user's conversation."""
+        self._conversations.pop(user_id, None)
+        await async_database.clear_conversation(user_id)
+
+    def stats(self):
+        """Hot tier counters, compactions and the largest prompt built."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self._conversations),
+            'compactions': self.compactions,
+            'max_prompt_tokens': self.max_prompt_tokens,
+            'tokenizer': 'tiktoken' if _encoding is not None else 'estimate',
+        }
+
+# Shared store used by the bots
+_store = ConversationStore()
+
+def configure(max_conversations=MAX_CONVERSATIONS, budget=PROMPT_TOKEN_BUDGET):
+    """
+    Replace the shared store, keeping its summarizer. With several processes
+    sharing the database, use max_conversations=0 so every message reloads the
+    conversation.
+    """
+    global _store
+    summarizer = _store.summarizer
+    _store = ConversationStore(max_conversations=max_conversations, budget=budget)
+    _store.summarizer = summarizer
+
+def set_summarizer(summarizer):
+    """Enable rolling-summary compaction: `summarizer(summary, turns)` returns the new summary."""
+    _store.summarizer = summarizer
+
+async def build_context(user_id, user_text, system_prompt):
+    """Return the history Context for a new message. See ConversationStore.build_context()."""
+    return await _store.build_context(user_id, user_text, system_prompt)
+
+async def record(user_id, user_text, reply):
+    """Remember a message and its reply."""
+    return await _store.record(user_id, user_text, reply)
+
+async def clear(user_id):
+    """Forget a user's conversation."""
+    return await _store.clear(user_id)
+
+def stats():
+    """Return the shared store's counters."""
+    return _store.stats()
@@ -2,66 +2,238 @@
 
 import sqlite3
 import logging
+import threading
+import time
+from contextlib import contextmanager
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # Database filename
 DB_FILENAME = 'bot_database.db'
 
+# Connection tuning. WAL lets readers run alongside the writer, and with
+# synchronous=NORMAL a commit no longer fsyncs the database file (only the WAL
+# on checkpoint), which is safe against application crashes.
+BUSY_TIMEOUT_MS = 5000
+STATEMENT_CACHE_SIZE = 128  # Prepared statements kept per connection
+PRAGMAS = (
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -16000),      # Negative value = size in KiB (~16 MB)
+    ('mmap_size', 268435456),    # 256 MB memory-mapped I/O
+    ('temp_store', 'MEMORY'),
+    ('busy_timeout', BUSY_TIMEOUT_MS),
+)
+
+# One long-lived connection per thread. Handlers may reach the database from
+# executor threads, and sqlite3 connections must not be shared across threads.
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0  # Bumped by close_connections() to invalidate every thread's connection
+
+def get_connection():
+    """Return this thread's long-lived connection, opening it on first use."""
+    conn = getattr(_local, 'conn', None)
+    if conn is not None:
+        if _local.filename == DB_FILENAME and _local.generation == _generation:
+            return conn
+        _discard_connection(conn)
+
+    conn = sqlite3.connect(
+        DB_FILENAME,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=STATEMENT_CACHE_SIZE,
+        check_same_thread=False,  # close_connections() may run on another thread
+    )
+    for name, value in PRAGMAS:
+        conn.execute(f'PRAGMA {name} = {value}')
+    _local.conn = conn
+    _local.filename = DB_FILENAME
+    _local.generation = _generation
+    with _connections_lock:
+        _connections.append(conn)
+    logger.debug("Opened database connection", extra={'database': DB_FILENAME, 'thread_name': threading.current_thread().name})
+    return conn
+
+def _discard_connection(conn):
+    with _connections_lock:
+        if conn in _connections:
+            _connections.remove(conn)
+    try:
+        conn.close()
+    except Exception as e:
+        logger.exception(f"Error closing database connection: {e}")
+
+def close_connections():
+    """Close every pooled connection. Threads reopen lazily on next use."""
+    global _generation
+    with _connections_lock:
+        conns = list(_connections)
+        _connections.clear()
+        _generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except Exception as e:
+            logger.exception(f"Error closing database connection: {e}")
+    _local.__dict__.clear()
+
+@contextmanager
+def transaction(conn):
+    """
+    Commit on success and roll back on error, like `with conn:`. Inside run_batch()
+    this is a no-op so the whole batch commits once.
+    """
+    if getattr(_local, 'in_batch', False):
+        yield conn
+        return
+    with conn:
+        yield conn
+
 def initialize_database():
-    """Initialize the SQLite database and create the users table."""
+    """Initialize the SQLite database and create the users, ledger and cache tables."""
     try:
-        conn = sqlite3.connect(DB_FILENAME)
-        cursor = conn.cursor()
+        conn = get_connection()
         
-        # Create users table if it doesn't exist
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                free_interactions_used INTEGER DEFAULT 0,
-                indecent_credits INTEGER DEFAULT 0  -- Set default indecent_credits to 0
-            )
-        ''')
+        with transaction(conn):
+            ledger_exists = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'transactions'"
+            ).fetchone() is not None
+
+            # Create users table if it doesn't exist
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    free_interactions_used INTEGER DEFAULT 0,
+                    indecent_credits INTEGER DEFAULT 0  -- Set default indecent_credits to 0
+                )
+            ''')
+
+            # Append-only credit ledger; users.indecent_credits is its per-user sum,
+            # kept in step by every write that changes a balance
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS transactions (
+                    id INTEGER PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,      -- 'opening', 'purchase', 'credit', 'charge' or 'adjustment'
+                    credits INTEGER NOT NULL,  -- Signed change to the balance
+                    charge_id TEXT UNIQUE,   -- telegram_payment_charge_id; a payment is applied once
+                    created_at REAL NOT NULL
+                )
+            ''')
+            # Covers the per-user sums of reconcile_ledger()
+            conn.execute('CREATE INDEX IF NOT EXISTS transactions_user ON transactions (user_id, credits)')
+            if not ledger_exists:
+                # Balances from before the ledger become opening entries
+                opened = conn.execute(
+                    "INSERT INTO transactions (user_id, kind, credits, created_at) "
+                    "SELECT user_id, 'opening', indecent_credits, ? FROM users WHERE indecent_credits != 0",
+                    (time.time(),),
+                ).rowcount
+                logger.info("Created the credit ledger", extra={'opening_balances': opened})
+
+            # Persistent tier of response_cache.py
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS response_cache_last_used ON response_cache (last_used)')
+
+            # Index of tts_cache.py: audio files on disk and Telegram file_ids
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS tts_cache (
+                    cache_key TEXT PRIMARY KEY,
+                    path TEXT,               -- NULL once the file has been evicted
+                    size INTEGER NOT NULL DEFAULT 0,
+                    file_id TEXT,            -- Telegram file_id, reusable without re-uploading
+                    last_used REAL NOT NULL
+                )
+            ''')
+            conn.execute('CREATE INDEX IF NOT EXISTS tts_cache_last_used ON tts_cache (last_used)')
+
+            # conversation.py: a fixed number of slots per user, reused oldest first
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversation_turns (
+                    user_id INTEGER NOT NULL,
+                    slot INTEGER NOT NULL,   -- seq modulo the ring size
+                    seq INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    PRIMARY KEY (user_id, slot)
+                ) WITHOUT ROWID
+            ''')
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS conversation_summaries (
+                    user_id INTEGER PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    summarized_through INTEGER NOT NULL  -- Turns up to this seq are in the summary
+                )
+            ''')
+
+            # persistence.py: one row per key of each user's, chat's or the bot's data
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS persistence_data (
+                    kind TEXT NOT NULL,      -- 'user', 'chat', 'bot' or 'conversation:<name>'
+                    owner_id INTEGER NOT NULL,
+                    key BLOB NOT NULL,       -- Pickled key
+                    value BLOB NOT NULL,     -- Pickled value
+                    PRIMARY KEY (kind, owner_id, key)
+                ) WITHOUT ROWID
+            ''')
         
-        conn.commit()
-        conn.close()
-        logger.debug("Database initialized and users table ensured.")
+        logger.debug("Database initialized and tables ensured.")
     except Exception as e:
         logger.exception(f"Failed to initialize database: {e}")
         raise
 
+def ping():
+    """Run a trivial query; used by readiness checks."""
+    get_connection().execute('SELECT 1').fetchone()
+
 def get_user(user_id):
     """Retrieve user data from the database."""
     try:
-        conn = sqlite3.connect(DB_FILENAME)
-        cursor = conn.cursor()
+        conn = get_connection()
         
-        cursor.execute('SELECT free_interactions_used, indecent_credits FROM users WHERE user_id = ?', (user_id,))
-        result = cursor.fetchone()
+        result = conn.execute('SELECT free_interactions_used, indecent_credits FROM users WHERE user_id = ?', (user_id,)).fetchone()
         
         if result:
             user_data = {'free_interactions_used': result[0], 'indecent_credits': result[1]}
-            logger.debug(f"Retrieved existing user {user_id}: {user_data}")
+            logger.debug("Retrieved existing user", extra={'user_id': user_id, 'free_used': result[0], 'credits': result[1]})
         else:
-            # If user doesn't exist, create a new record with 0 indecent_credits
-            cursor.execute('INSERT INTO users (user_id, indecent_credits) VALUES (?, ?)', (user_id, 0))
-            conn.commit()
+            # If user doesn't exist, create a new record with 0 indecent_credits.
+            # OR IGNORE covers another thread inserting the same user first.
+            with transaction(conn):
+                conn.execute('INSERT OR IGNORE INTO users (user_id, indecent_credits) VALUES (?, ?)', (user_id, 0))
             user_data = {'free_interactions_used': 0, 'indecent_credits': 0}
-            logger.debug(f"New user {user_id} created with 0 indecent_credits.")
+            logger.debug("New user created with 0 indecent_credits", extra={'user_id': user_id})
         
-        conn.close()
         return user_data
     except Exception as e:
         logger.exception(f"Error in get_user for user {user_id}: {e}")
         raise
 
+def _record(conn, entries):
+    """Append (user_id, kind, credits) entries to the ledger; call inside the transaction that changes the balances."""
+    now = time.time()
+    conn.executemany(
+        'INSERT INTO transactions (user_id, kind, credits, created_at) VALUES (?, ?, ?, ?)',
+        [(user_id, kind, credits, now) for user_id, kind, credits in entries if credits],
+    )
+
 def update_user(user_id, free_interactions_used=None, indecent_credits=None):
-    """Update user data in the database."""
+    """Update user data in the database. A new balance is recorded in the ledger as an adjustment."""
     try:
-        conn = sqlite3.connect(DB_FILENAME)
-        cursor = conn.cursor()
+        conn = get_connection()
         
         fields = []
         values = []
@@ -77,37 +249,75 @@ def update_user(user_id, free_interactions_used=None, indecent_credits=None):
         if fields:
             query = f"UPDATE users SET {', '.join(fields)} WHERE user_id = ?"
             values.append(user_id)
-            cursor.execute(query, tuple(values))
-            conn.commit()
-            logger.debug(f"Updated user {user_id}: free_interactions_used={free_interactions_used}, indecent_credits={indecent_credits}")
-        
-        conn.close()
+            with transaction(conn):
+                if indecent_credits is not None:
+                    row = conn.execute('SELECT indecent_credits FROM users WHERE user_id = ?', (user_id,)).fetchone()
+                    if row is not None:
+                        _record(conn, [(user_id, 'adjustment', indecent_credits - row[0])])
+                conn.execute(query, tuple(values))
+            logger.debug("Updated user", extra={'user_id': user_id, 'free_used': free_interactions_used, 'credits': indecent_credits})
     except Exception as e:
         logger.exception(f"Error in update_user for user {user_id}: {e}")
         raise
 
 def add_credits(user_id, credits_to_add):
-    """Add Indecent Credits to a user's balance."""
+    """Add Indecent Credits to a user's balance and record them in the ledger."""
     try:
-        user = get_user(user_id)
-        new_credits = user['indecent_credits'] + credits_to_add
-        update_user(user_id, indecent_credits=new_credits)
-        logger.debug(f"Added {credits_to_add} indecent_credits to user {user_id}. New balance: {new_credits}")
+        conn = get_connection()
+        with transaction(conn):
+            conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+            new_credits = conn.execute(
+                'UPDATE users SET indecent_credits = indecent_credits + ? WHERE user_id = ? RETURNING indecent_credits',
+                (credits_to_add, user_id),
+            ).fetchone()[0]
+            _record(conn, [(user_id, 'credit', credits_to_add)])
+        logger.debug("Added indecent_credits", extra={'user_id': user_id, 'added': credits_to_add, 'credits': new_credits})
     except Exception as e:
         logger.exception(f"Error in add_credits for user {user_id}: {e}")
         raise
 
+def apply_payment(user_id, charge_id, credits):
+    """
+    Credit a purchase exactly once. The ledger entry is keyed on the payment's
+    telegram_payment_charge_id, so a redelivered update changes nothing.
+    Returns True if the credits were added, False if the payment was already applied.
+    """
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            applied = conn.execute(
+                "INSERT INTO transactions (user_id, kind, credits, charge_id, created_at) VALUES (?, 'purchase', ?, ?, ?) "
+                "ON CONFLICT (charge_id) DO NOTHING",
+                (user_id, credits, charge_id, time.time()),
+            ).rowcount == 1
+            if applied:
+                conn.execute('INSERT OR IGNORE INTO users (user_id) VALUES (?)', (user_id,))
+                conn.execute('UPDATE users SET indecent_credits = indecent_credits + ? WHERE user_id = ?', (credits, user_id))
+        logger.debug("Applied payment" if applied else "Payment already applied",
+                     extra={'user_id': user_id, 'charge_id': charge_id, 'credits': credits})
+        return applied
+    except Exception as e:
+        logger.exception(f"Error in apply_payment for user {user_id}, charge {charge_id}: {e}")
+        raise
+
 def consume_credit(user_id):
     """Consume one Indecent Credit from a user's balance."""
     try:
-        user = get_user(user_id)
-        if user['indecent_credits'] >= 1:
-            new_credits = user['indecent_credits'] - 1
-            update_user(user_id, indecent_credits=new_credits)
-            logger.debug(f"Consumed 1 indecent_credit from user {user_id}. Remaining credits: {new_credits}")
+        get_user(user_id)  # Creates a missing user
+        conn = get_connection()
+        with transaction(conn):
+            row = conn.execute(
+                'UPDATE users SET indecent_credits = indecent_credits - 1 WHERE user_id = ? AND indecent_credits >= 1 '
+                'RETURNING indecent_credits',
+                (user_id,),
+            ).fetchone()
+            if row is not None:
+                _record(conn, [(user_id, 'charge', -1)])
+        if row is not None:
+            logger.debug("Consumed 1 indecent_credit", extra={'user_id': user_id, 'credits': row[0]})
             return True
         else:
-            logger.debug(f"User {user_id} has no indecent_credits to consume.")
+            logger.debug("No indecent_credits to consume", extra={'user_id': user_id})
             return False
     except Exception as e:
         logger.exception(f"Error in consume_credit for user {user_id}: {e}")
@@ -119,8 +329,351 @@ def increment_free_interactions(user_id):
         user = get_user(user_id)
         new_free = user['free_interactions_used'] + 1
         update_user(user_id, free_interactions_used=new_free)
-        logger.debug(f"Incremented free interactions for user {user_id}. Total used: {new_free}")
+        logger.debug("Incremented free interactions", extra={'user_id': user_id, 'free_used': new_free})
         return new_free
     except Exception as e:
         logger.exception(f"Error in increment_free_interactions for user {user_id}: {e}")
         raise
+
+def charge_interaction(user_id, free_limit, cost):
+    """
+    Charge one interaction atomically: use a free interaction while the user has
+    fewer than free_limit, otherwise debit cost Indecent Credits if they can afford it.
+
+    Returns a dict with 'charged', 'free' (whether a free interaction was used) and
+    the user's resulting 'free_interactions_used' and 'indecent_credits'.
+    """
+    params = {'user_id': user_id, 'free_limit': free_limit, 'cost': cost}
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            # Each conditional UPDATE checks and debits in one statement, and both run in
+            # the same transaction, so concurrent messages can't double-spend.
+            row = conn.execute(
+                'UPDATE users SET free_interactions_used = free_interactions_used + 1 '
+                'WHERE user_id = :user_id AND free_interactions_used < :free_limit '
+                'RETURNING free_interactions_used, indecent_credits',
+                params,
+            ).fetchone()
+            free = row is not None
+            if row is None:
+                row = conn.execute(
+                    'UPDATE users SET indecent_credits = indecent_credits - :cost '
+                    'WHERE user_id = :user_id AND indecent_credits >= :cost '
+                    'RETURNING free_interactions_used, indecent_credits',
+                    params,
+                ).fetchone()
+                if row is not None:
+                    _record(conn, [(user_id, 'charge', -cost)])
+
+        if row is None:
+            # Either a new user or one who can't pay. get_user() creates missing users.
+            user = get_user(user_id)
+            if user['free_interactions_used'] < free_limit:
+                return charge_interaction(user_id, free_limit, cost)
+            logger.debug("Could not charge indecent_credits", extra={'user_id': user_id, 'cost': cost, 'credits': user['indecent_credits']})
+            return {'charged': False, 'free': False, **user}
+
+        result = {'charged': True, 'free': free, 'free_interactions_used': row[0], 'indecent_credits': row[1]}
+        logger.debug("Charged user", extra={'user_id': user_id, 'free': free, 'free_used': row[0], 'credits': row[1]})
+        return result
+    except Exception as e:
+        logger.exception(f"Error in charge_interaction for user {user_id}: {e}")
+        raise
+
+def apply_deltas(deltas):
+    """
+    Apply (user_id, free_interactions_delta, credits_delta) changes in one transaction.
+    Relative updates keep the result correct even if another writer touched the row.
+    Each credits delta is one ledger entry, so write-back keeps the ledger to one
+    row per user per flush rather than one per charge.
+    """
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            conn.executemany(
+                'UPDATE users SET free_interactions_used = free_interactions_used + ?, indecent_credits = indecent_credits + ? WHERE user_id = ?',
+                [(free_delta, credits_delta, user_id) for user_id, free_delta, credits_delta in deltas],
+            )
+            _record(conn, [(user_id, 'charge' if credits_delta < 0 else 'credit', credits_delta)
+                           for user_id, _, credits_delta in deltas])
+        logger.debug("Applied user deltas", extra={'accounts': len(deltas)})
+    except Exception as e:
+        logger.exception(f"Error in apply_deltas for {len(deltas)} users: {e}")
+        raise
+
+def reconcile_ledger():
+    """
+    Compare every balance with the sum of its ledger entries in one pass.
+    Returns (user_id, indecent_credits, ledger_sum) for each user where they differ.
+    """
+    try:
+        conn = get_connection()
+        return conn.execute('''
+            SELECT users.user_id, users.indecent_credits, COALESCE(ledger.total, 0)
+            FROM users LEFT JOIN (
+                SELECT user_id, SUM(credits) AS total FROM transactions GROUP BY user_id
+            ) AS ledger ON ledger.user_id = users.user_id
+            WHERE users.indecent_credits != COALESCE(ledger.total, 0)
+        ''').fetchall()
+    except Exception as e:
+        logger.exception(f"Error in reconcile_ledger: {e}")
+        raise
+
+def run_batch(operations):
+    """
+    Run several write operations in a single transaction (group commit).
+
+    operations is a list of (func, args, kwargs) calls to functions in this module.
+    Each runs in its own savepoint, so one failing operation is rolled back alone
+    while the rest still commit. Returns a list of (exception, result) pairs.
+    """
+    conn = get_connection()
+    results = []
+    _local.in_batch = True
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        for func, args, kwargs in operations:
+            conn.execute('SAVEPOINT batch_op')
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                conn.execute('ROLLBACK TO batch_op')
+                conn.execute('RELEASE batch_op')
+                results.append((e, None))
+            else:
+                conn.execute('RELEASE batch_op')
+                results.append((None, result))
+        conn.commit()
+    except Exception as e:
+        if conn.in_transaction:
+            conn.rollback()
+        logger.exception(f"Error in run_batch for {len(operations)} operations: {e}")
+        raise
+    finally:
+        _local.in_batch = False
+    logger.debug("Committed batch", extra={'operations': len(operations)})
+    return results
+
+def get_cached_response(cache_key, now):
+    """Return (response, expires_at) for a cached LLM response that hasn't expired, or None."""
+    try:
+        conn = get_connection()
+        row = conn.execute('SELECT response, expires_at, last_used FROM response_cache WHERE cache_key = ? AND expires_at > ?', (cache_key, now)).fetchone()
+        if row is None:
+            return None
+        if now - row[2] > 60:
+            # LRU order only needs to be roughly right; skip the write on frequent hits
+            with transaction(conn):
+                conn.execute('UPDATE response_cache SET last_used = ? WHERE cache_key = ?', (now, cache_key))
+        return row[0], row[1]
+    except Exception as e:
+        logger.exception(f"Error in get_cached_response for key {cache_key}: {e}")
+        raise
+
+def store_cached_response(cache_key, model, response, expires_at, now):
+    """Insert or replace a cached LLM response."""
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            conn.execute(
+                'INSERT OR REPLACE INTO response_cache (cache_key, model, response, size, expires_at, last_used) VALUES (?, ?, ?, ?, ?, ?)',
+                (cache_key, model, response, len(response.encode('utf-8')), expires_at, now),
+            )
+    except Exception as e:
+        logger.exception(f"Error in store_cached_response for key {cache_key}: {e}")
+        raise
+
+def evict_cached_responses(max_bytes, now):
+    """Delete expired responses, then the least recently used until the cache fits in max_bytes."""
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            expired = conn.execute('DELETE FROM response_cache WHERE expires_at <= ?', (now,)).rowcount
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache').fetchone()[0]
+            evicted = 0
+            if total > max_bytes:
+                # Walk from least recently used, deleting until under the limit
+                doomed = []
+                for cache_key, size in conn.execute('SELECT cache_key, size FROM response_cache ORDER BY last_used'):
+                    if total <= max_bytes:
+                        break
+                    doomed.append((cache_key,))
+                    total -= size
+                conn.executemany('DELETE FROM response_cache WHERE cache_key = ?', doomed)
+                evicted = len(doomed)
+        logger.debug("Response cache eviction", extra={'expired': expired, 'evicted': evicted, 'bytes_left': total})
+        return expired + evicted
+    except Exception as e:
+        logger.exception(f"Error in evict_cached_responses: {e}")
+        raise
+
+def get_tts_entry(cache_key, now):
+    """Return (path, file_id) for a cached TTS result, or None."""
+    try:
+        conn = get_connection()
+        row = conn.execute('SELECT path, file_id, last_used FROM tts_cache WHERE cache_key = ?', (cache_key,)).fetchone()
+        if row is None:
+            return None
+        if now - row[2] > 60:
+            with transaction(conn):
+                conn.execute('UPDATE tts_cache SET last_used = ? WHERE cache_key = ?', (now, cache_key))
+        return row[0], row[1]
+    except Exception as e:
+        logger.exception(f"Error in get_tts_entry for key {cache_key}: {e}")
+        raise
+
+def store_tts_entry(cache_key, path=None, size=None, file_id=None, now=0.0):
+    """Create or update a TTS cache entry; None leaves a field unchanged."""
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            conn.execute(
+                '''
+                INSERT INTO tts_cache (cache_key, path, size, file_id, last_used) VALUES (?, ?, COALESCE(?, 0), ?, ?)
+                ON CONFLICT (cache_key) DO UPDATE SET
+                    path = COALESCE(excluded.path, path),
+                    size = CASE WHEN excluded.path IS NULL THEN size ELSE excluded.size END,
+                    file_id = COALESCE(excluded.file_id, file_id),
+                    last_used = excluded.last_used
+                ''',
+                (cache_key, path, size, file_id, now),
+            )
+    except Exception as e:
+        logger.exception(f"Error in store_tts_entry for key {cache_key}: {e}")
+        raise
+
+def forget_tts_file_id(cache_key):
+    """Drop a file_id that Telegram no longer accepts."""
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            conn.execute('UPDATE tts_cache SET file_id = NULL WHERE cache_key = ?', (cache_key,))
+            conn.execute('DELETE FROM tts_cache WHERE cache_key = ? AND path IS NULL', (cache_key,))
+    except Exception as e:
+        logger.exception(f"Error in forget_tts_file_id for key {cache_key}: {e}")
+        raise
+
+def evict_tts_files(max_bytes):
+    """
+    Release the least recently used audio files until the cached files fit in
+    max_bytes. Entries keep their file_id. Returns the paths to delete from disk.
+    """
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM tts_cache WHERE path IS NOT NULL').fetchone()[0]
+            paths = []
+            if total > max_bytes:
+                evicted = []
+                for cache_key, path, size in conn.execute('SELECT cache_key, path, size FROM tts_cache WHERE path IS NOT NULL ORDER BY last_used'):
+                    if total <= max_bytes:
+                        break
+                    evicted.append((cache_key,))
+                    paths.append(path)
+                    total -= size
+                conn.executemany('UPDATE tts_cache SET path = NULL, size = 0 WHERE cache_key = ?', evicted)
+                conn.execute('DELETE FROM tts_cache WHERE path IS NULL AND file_id IS NULL')
+        logger.debug("TTS cache eviction", extra={'released': len(paths), 'bytes_left': total})
+        return paths
+    except Exception as e:
+        logger.exception(f"Error in evict_tts_files: {e}")
+        raise
+
+def get_conversation(user_id):
+    """
+    Return (summary, summary_tokens, summarized_through, turns) for a user,
+    where turns are the (seq, role, content, tokens) not yet summarized,
+    oldest first.
+    """
+    try:
+        conn = get_connection()
+        row = conn.execute(
+            'SELECT summary, tokens, summarized_through FROM conversation_summaries WHERE user_id = ?', (user_id,)
+        ).fetchone()
+        summary, summary_tokens, summarized_through = row if row else ('', 0, -1)
+        turns = conn.execute(
+            'SELECT seq, role, content, tokens FROM conversation_turns WHERE user_id = ? AND seq > ? ORDER BY seq',
+            (user_id, summarized_through),
+        ).fetchall()
+        return summary, summary_tokens, summarized_through, turns
+    except Exception as e:
+        logger.exception(f"Error in get_conversation for user {user_id}: {e}")
+        raise
+
+def append_conversation_turns(user_id, turns, ring_size):
+    """Store (seq, role, content, tokens) turns in the user's ring buffer, overwriting the oldest slots."""
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            conn.executemany(
+                'INSERT OR REPLACE INTO conversation_turns (user_id, slot, seq, role, content, tokens) VALUES (?, ?, ?, ?, ?, ?)',
+                [(user_id, seq % ring_size, seq, role, content, tokens) for seq, role, content, tokens in turns],
+            )
+    except Exception as e:
+        logger.exception(f"Error in append_conversation_turns for user {user_id}: {e}")
+        raise
+
+def store_conversation_summary(user_id, summary, tokens, summarized_through):
+    """Replace a user's rolling summary, which now covers turns up to summarized_through."""
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            conn.execute(
+                'INSERT OR REPLACE INTO conversation_summaries (user_id, summary, tokens, summarized_through) VALUES (?, ?, ?, ?)',
+                (user_id, summary, tokens, summarized_through),
+            )
+    except Exception as e:
+        logger.exception(f"Error in store_conversation_summary for user {user_id}: {e}")
+        raise
+
+def clear_conversation(user_id):
+    """Forget a user's conversation history and summary."""
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            conn.execute('DELETE FROM conversation_turns WHERE user_id = ?', (user_id,))
+            conn.execute('DELETE FROM conversation_summaries WHERE user_id = ?', (user_id,))
+    except Exception as e:
+        logger.exception(f"Error in clear_conversation for user {user_id}: {e}")
+        raise
+
+def get_persistent_data(kind, owner_id):
+    """Return the (key, value) pickles stored for one user, chat or the bot."""
+    try:
+        conn = get_connection()
+        return conn.execute(
+            'SELECT key, value FROM persistence_data WHERE kind = ? AND owner_id = ?', (kind, owner_id)
+        ).fetchall()
+    except Exception as e:
+        logger.exception(f"Error in get_persistent_data for {kind} {owner_id}: {e}")
+        raise
+
+def store_persistent_data(kind, owner_id, changed, removed):
+    """Write changed (key, value) pickles and delete removed key pickles for one owner."""
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            if changed:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO persistence_data (kind, owner_id, key, value) VALUES (?, ?, ?, ?)',
+                    [(kind, owner_id, key, value) for key, value in changed],
+                )
+            if removed:
+                conn.executemany(
+                    'DELETE FROM persistence_data WHERE kind = ? AND owner_id = ? AND key = ?',
+                    [(kind, owner_id, key) for key in removed],
+                )
+    except Exception as e:
+        logger.exception(f"Error in store_persistent_data for {kind} {owner_id}: {e}")
+        raise
+
+def drop_persistent_data(kind, owner_id):
+    """Delete everything stored for one user, chat or the bot."""
+    try:
+        conn = get_connection()
+        with transaction(conn):
+            conn.execute('DELETE FROM persistence_data WHERE kind = ? AND owner_id = ?', (kind, owner_id))
+    except Exception as e:
+        logger.exception(f"Error in drop_persistent_data for {kind} {owner_id}: {e}")
+        raise
@@ -0,0 +1,198 @@
+# http_pool.py
+#
+# Shared HTTP connection pools. Left alone, the OpenAI, ElevenLabs and
+# Replicate SDKs and PTB each build their own httpx client with default pool
+# sizes; under load they run out of connections and open new ones, paying a
+# TCP and TLS handshake on top of every LLM and TTS call. Here each provider
+# (each talks to a single host) gets one long-lived pool with keep-alive,
+# HTTP/2 when the h2 package is installed, the timeouts below and metrics on
+# how often a request had to open a new connection:
+#
+#     AsyncOpenAI(api_key=..., http_client=http_pool.client('openai'))
+#     replicate.Client(api_token=..., transport=http_pool.transport('replicate'))
+#     ApplicationBuilder().request(http_pool.TelegramRequest('telegram'))
+#
+# Pools connect to whatever base URL their client uses, so local stand-ins
+# work the same way as the real APIs.
+#
+# A pool is split into shards of SHARD_SIZE connections: httpcore scans every
+# connection in a pool for each queued request, so one pool of 100 connections
+# spends more CPU matching requests to connections than a burst of LLM calls
+# saves on handshakes (see benchmarks/bench_http_pool.py).
+
+import importlib.util
+import logging
+import math
+import time
+
+import httpx
+from telegram.request import HTTPXRequest
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_CONNECTIONS = 100     # Per pool, i.e. per provider host; above the limits in concurrency.py, so calls never wait for one
+SHARD_SIZE = 8            # Connections per shard of a pool
+KEEPALIVE_EXPIRY = 60.0   # Seconds an idle connection is kept
+HTTP2 = importlib.util.find_spec('h2') is not None  # Negotiated with the server where it supports it
+CONNECT_TIMEOUT = 5.0
+READ_TIMEOUT = 60.0       # LLM replies can take a while to start
+WRITE_TIMEOUT = 30.0      # Audio uploads
+POOL_TIMEOUT = 10.0       # Waiting for a free connection
+
+REQUESTS = metrics.counter('bot_http_requests_total', 'HTTP requests sent through the shared pools.', ('pool',))
+CONNECTIONS = metrics.counter('bot_http_connections_total', 'New HTTP connections opened (requests that could not reuse one).', ('pool',))
+CONNECT_SECONDS = metrics.histogram('bot_http_connect_seconds', 'Seconds to open a connection, TCP and TLS handshakes included.',
+                                    ('pool',), buckets=metrics.FAST_BUCKETS)
+
+_transports = {}  # Pool name -> MeteredTransport
+_clients = {}     # Pool name -> shared httpx.AsyncClient
+
+def timeout():
+    """An httpx.Timeout with the module's settings."""
+    return httpx.Timeout(connect=CONNECT_TIMEOUT, read=READ_TIMEOUT, write=WRITE_TIMEOUT, pool=POOL_TIMEOUT)
+
+def limits(max_connections=None):
+    """An httpx.Limits with the module's settings."""
+    max_connections = max_connections or MAX_CONNECTIONS
+    # Every connection may stay open: a burst's connections are all reused by the next one
+    return httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+class _ShardStream(httpx.AsyncByteStream):
+    """A response body that releases its shard when closed; streamed replies hold their connection until then."""
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release:
+                self._release()
+                self._release = None
+
+class MeteredTransport(httpx.AsyncBaseTransport):
+    """An httpx connection pool, in shards, that counts requests, new connections and handshake time."""
+
+    def __init__(self, name, max_connections=None, http2=None, **kwargs):
+        self.name = name
+        self.http2 = HTTP2 if http2 is None else http2
+        max_connections = max_connections or MAX_CONNECTIONS
+        size = min(SHARD_SIZE, max_connections)
+        self._shards = [httpx.AsyncHTTPTransport(limits=limits(size), http2=self.http2, **kwargs)
+                        for _ in range(math.ceil(max_connections / size))]
+        self._busy = [0] * len(self._shards)  # Requests in flight per shard
+        self._requests = REQUESTS.labels(name)
+        self._connections = CONNECTIONS.labels(name)
+        self._connect_seconds = CONNECT_SECONDS.labels(name)
+        self.requests = 0
+        self.connections = 0
+
+    def _tracer(self, tls):
+        started = 0.0
+
+        async def trace(event, info):
+            # httpcore reports connect_tcp and start_tls only for requests that open a connection
+            nonlocal started
+            if event == 'connection.connect_tcp.started':
+                started = time.perf_counter()
+            elif event == 'connection.connect_tcp.complete':
+                self.connections += 1
+                self._connections.inc()
+                if not tls:
+                    self._connect_seconds.observe(time.perf_counter() - started)
+            elif event == 'connection.start_tls.complete':
+                self._connect_seconds.observe(time.perf_counter() - started)
+        return trace
+
+    async def handle_async_request(self, request):
+        self.requests += 1
+        self._requests.inc()
+        request.extensions.setdefault('trace', self._tracer(request.url.scheme == 'https'))
+        # The least busy shard; the first one on ties, so a quiet bot keeps reusing the same warm connections
+        index = min(range(len(self._shards)), key=self._busy.__getitem__)
+        self._busy[index] += 1
+
+        def release():
+            self._busy[index] -= 1
+
+        try:
+            response = await self._shards[index].handle_async_request(request)
+        except BaseException:
+            release()
+            raise
+        response.stream = _ShardStream(response.stream, release)
+        return response
+
+    async def aclose(self):
+        for shard in self._shards:
+            await shard.aclose()
+
+    def open_connections(self):
+        return sum(len(shard._pool.connections) for shard in self._shards)
+
+    def stats(self):
+        reused = self.requests - self.connections
+        return {
+            'requests': self.requests,
+            'connections': self.connections,
+            'reuse': round(reused / self.requests, 3) if self.requests else 0.0,
+            'open': self.open_connections(),
+        }
+
+def transport(name, max_connections=None):
+    """The shared pool for `name`, created on first use."""
+    pool = _transports.get(name)
+    if pool is None:
+        pool = _transports[name] = MeteredTransport(name, max_connections)
+    return pool
+
+def client(name, **kwargs):
+    """A shared httpx.AsyncClient on the `name` pool, with the module's timeouts."""
+    shared = _clients.get(name)
+    if shared is None:
+        shared = _clients[name] = httpx.AsyncClient(transport=transport(name), timeout=timeout(), **kwargs)
+    return shared
+
+class TelegramRequest(HTTPXRequest):
+    """
+    PTB's HTTPXRequest on a metered pool. PTB closes and rebuilds its client
+    on shutdown and initialize, so each build gets a fresh transport, which
+    replaces the previous one under the same pool name.
+    """
+
+    def __init__(self, name='telegram', connection_pool_size=None, **kwargs):
+        self._pool_name = name
+        self._pool_size = connection_pool_size or MAX_CONNECTIONS
+        kwargs.setdefault('connect_timeout', CONNECT_TIMEOUT)
+        kwargs.setdefault('pool_timeout', POOL_TIMEOUT)
+        super().__init__(connection_pool_size=self._pool_size, http_version='2' if HTTP2 else '1.1', **kwargs)
+
+    def _build_client(self):
+        # A transport given to httpx replaces the one it would build from limits and http2
+        _transports[self._pool_name] = MeteredTransport(self._pool_name, self._pool_size)
+        return httpx.AsyncClient(**dict(self._client_kwargs, transport=_transports[self._pool_name]))
+
+async def close():
+    """Close the shared clients and pools at shutdown; clients built on them can't be used afterwards."""
+    for shared in _clients.values():
+        await shared.aclose()
+    for pool in _transports.values():
+        await pool.aclose()
+    _clients.clear()
+    _transports.clear()
+
+def stats():
+    """Requests, new connections, share of requests that reused a connection, and open connections, per pool."""
+    return {name: pool.stats() for name, pool in _transports.items()}
+
+metrics.gauge('bot_http_open_connections', 'Connections open in each shared pool.', ('pool',),
+              callback=lambda: {(name,): pool.open_connections() for name, pool in _transports.items()})
@@ -0,0 +1,70 @@
+# ledger.py
+#
+# Periodic reconciliation of the credit ledger. Every balance in
+# users.indecent_credits should equal the sum of that user's entries in the
+# transactions table (see database.py); reconcile() compares all of them in
+# one query on the database thread, so it doesn't touch the charge path.
+# Mismatches are logged and exported, not corrected: they mean a bug or a
+# manual edit of the database that someone should look at.
+
+import asyncio
+import logging
+import time
+
+import async_database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+RECONCILE_INTERVAL = 3600.0  # Seconds between checks; 0 turns the periodic check off
+MAX_LOGGED = 20  # Mismatched users listed in the log per check
+
+MISMATCHES = metrics.gauge('bot_ledger_mismatches', 'Users whose balance differed from their ledger sum at the last check.')
+RECONCILE_SECONDS = metrics.histogram('bot_ledger_reconcile_seconds', 'Seconds a ledger reconciliation took.')
+
+_task = None
+
+async def reconcile():
+    """Check every balance against the ledger; returns the (user_id, balance, ledger_sum) mismatches."""
+    start = time.perf_counter()
+    mismatches = await async_database.reconcile_ledger()
+    seconds = time.perf_counter() - start
+    RECONCILE_SECONDS.observe(seconds)
+    MISMATCHES.set(len(mismatches))
+    if mismatches:
+        logger.error(f"Credit ledger does not match {len(mismatches)} balances", extra={'seconds': round(seconds, 3)})
+        for user_id, balance, ledger_sum in mismatches[:MAX_LOGGED]:
+            logger.error("Balance differs from ledger", extra={'user_id': user_id, 'credits': balance, 'ledger': ledger_sum})
+    else:
+        logger.info("Credit ledger matches all balances", extra={'seconds': round(seconds, 3)})
+    return mismatches
+
+async def _reconcile_periodically():
+    while True:
+        try:
+            await reconcile()
+        except Exception as e:
+            logger.exception(f"Credit ledger reconciliation failed: {e}")
+        await asyncio.sleep(RECONCILE_INTERVAL)
+
+async def start(application=None):
+    """Check now and then every RECONCILE_INTERVAL seconds. Usable as an ApplicationBuilder post_init hook."""
+    global _task
+    if RECONCILE_INTERVAL > 0 and _task is None:
+        _task = asyncio.get_running_loop().create_task(_reconcile_periodically())
+
+async def stop(application=None):
+    """Stop the periodic check. Usable as an ApplicationBuilder post_shutdown hook."""
+    global _task
+    task, _task = _task, None
+    if task is not None:
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+def configure(reconcile_interval=RECONCILE_INTERVAL):
+    """Set the interval between checks; call before start()."""
+    global RECONCILE_INTERVAL
+    RECONCILE_INTERVAL = reconcile_interval
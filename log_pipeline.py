@@ -0,0 +1,273 @@
+# log_pipeline.py
+#
+# Logging setup for the bots. Handlers only put records on a bounded queue; a
+# writer thread formats and writes them, so a slow terminal or disk never
+# blocks the event loop. Formatting is deferred to that thread as well: call
+# sites pass %-style arguments and structured fields instead of f-strings,
+#
+#     logger.debug("Received message", extra={'user_id': user_id, 'text': user_text})
+#
+# and nothing is formatted for records below the logger's level. Fields are
+# written as key=value pairs (or JSON with json_format=True), and long values
+# such as user messages and LLM replies are truncated.
+#
+# High-volume DEBUG records can be sampled per logger: with a rate of 0.1,
+# one in ten records of each message template is kept (the first one always).
+# When the queue is full, DEBUG and INFO records are dropped rather than
+# making the caller wait.
+
+import atexit
+import json
+import logging
+import queue
+import sys
+import threading
+
+LEVEL = 'DEBUG'
+FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+QUEUE_SIZE = 10000        # Records waiting for the writer thread
+MAX_VALUE_CHARS = 200     # Longer field values and arguments are truncated
+MAX_MESSAGE_CHARS = 2000  # Limit for the formatted message itself
+
+# Attributes every LogRecord has; anything else on a record came from extra=
+_RECORD_ATTRIBUTES = frozenset(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime', 'sample_rate'}
+
+_stats = {'queued': 0, 'dropped': 0, 'sampled_out': 0}
+
+def truncate(value, limit=MAX_VALUE_CHARS):
+    """str(value), cut to `limit` characters with a note of how much was left out."""
+    text = value if isinstance(value, str) else str(value)
+    if len(text) <= limit:
+        return text
+    return f"{text[:limit]}...(+{len(text) - limit} chars)"
+
+def _truncate_arg(arg):
+    # Numbers keep their type so %d and %.2f still work
+    return arg if isinstance(arg, (int, float)) else truncate(arg)
+
+def record_fields(record):
+    """The structured fields passed to a log call with extra=."""
+    return {key: value for key, value in record.__dict__.items() if key not in _RECORD_ATTRIBUTES}
+
+def _message(record):
+    if record.args:
+        args = record.args
+        if isinstance(args, tuple):
+            record.args = tuple(_truncate_arg(arg) for arg in args)
+        elif isinstance(args, dict):
+            record.args = {key: _truncate_arg(value) for key, value in args.items()}
+    return truncate(record.getMessage(), MAX_MESSAGE_CHARS)
+
+class StructuredFormatter(logging.Formatter):
+    """Message followed by key=value fields, every value truncated."""
+
+    def format(self, record):
+        record.message = _message(record)
+        fields = record_fields(record)
+        if getattr(record, 'sample_rate', 1.0) < 1.0:
+            fields['sample_rate'] = record.sample_rate
+        if fields:
+            record.message += ' ' + ' '.join(f"{key}={truncate(value)!r}" if isinstance(value, str) else f"{key}={truncate(value)}"
+                                             for key, value in fields.items())
+        if self.usesTime():
+            record.asctime = self.formatTime(record, self.datefmt)
+        text = self.formatMessage(record)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            text += '\n' + record.exc_text
+        return text
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and fields."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, self.datefmt),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': _message(record),
+        }
+        for key, value in record_fields(record).items():
+            entry[key] = value if isinstance(value, (int, float, bool)) or value is None else truncate(value)
+        if getattr(record, 'sample_rate', 1.0) < 1.0:
+            entry['sample_rate'] = record.sample_rate
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class SamplingFilter(logging.Filter):
+    """Keeps one in 1/rate DEBUG records per logger and message template."""
+
+    def __init__(self, rates, default_rate=1.0):
+        super().__init__()
+        self.rates = rates
+        self.default_rate = default_rate
+        self._counts = {}
+        self._logger_rates = {}
+
+    def _rate(self, name):
+        # The most specific configured logger prefix wins
+        rate = self._logger_rates.get(name)
+        if rate is None:
+            prefix = name
+            while prefix and prefix not in self.rates:
+                prefix = prefix.rpartition('.')[0]
+            rate = self._logger_rates[name] = self.rates[prefix] if prefix else self.default_rate
+        return rate
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        rate = self._rate(record.name)
+        if rate >= 1.0:
+            return True
+        key = (record.name, record.msg)
+        count = self._counts.get(key, 0)
+        self._counts[key] = count + 1
+        if rate <= 0 or count % round(1 / rate):
+            _stats['sampled_out'] += 1
+            return False
+        record.sample_rate = rate
+        return True
+
+class DeferredQueueHandler(logging.Handler):
+    """Queues records as they are; the writer thread does all the formatting."""
+
+    def __init__(self, record_queue, max_queued):
+        super().__init__()
+        self.queue = record_queue
+        self.max_queued = max_queued
+
+    def handle(self, record):
+        # No handler lock: SimpleQueue is thread-safe. Arguments are formatted
+        # later, on the writer thread, so they should not be mutated after the call.
+        if not self.filter(record):
+            return False
+        if self.queue.qsize() >= self.max_queued and record.levelno < logging.WARNING:
+            _stats['dropped'] += 1  # Warnings and errors are never dropped
+            return False
+        self.queue.put(record)
+        _stats['queued'] += 1
+        return True
+
+    def emit(self, record):
+        self.handle(record)
+
+_STOP = object()
+
+class _Writer(threading.Thread):
+    """Formats queued records and writes them out, one write and flush per batch."""
+
+    def __init__(self, record_queue, output, batch_size=512):
+        super().__init__(name='log-writer', daemon=True)
+        self.queue = record_queue
+        self.output = output
+        self.batch_size = batch_size
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get())
+            lines = []
+            stop = False
+            for record in batch:
+                if record is _STOP:
+                    stop = True
+                    continue
+                try:
+                    lines.append(self.output.format(record))
+                except Exception:
+                    self.output.handleError(record)
+            if lines:
+                self._write(lines)
+            if stop:
+                return
+
+    def _write(self, lines):
+        self.output.acquire()
+        try:
+            self.output.stream.write('\n'.join(lines) + '\n')
+            self.output.flush()
+        except Exception:
+            self.output.handleError(None)
+        finally:
+            self.output.release()
+
+    def stop(self):
+        """Write out everything already queued, then end the thread."""
+        self.queue.put(_STOP)
+        self.join()
+        self.output.close()
+
+_writer = None
+_lock = threading.Lock()
+_SRCFILE = logging._srcfile
+
+def parse_levels(spec):
+    """Per-logger levels from 'httpx=WARNING,database=INFO'."""
+    levels = {}
+    for item in (spec or '').split(','):
+        name, _, level = item.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+def parse_rates(spec):
+    """Per-logger DEBUG sample rates from 'database=0.1,telegram=0.01'."""
+    return {name: float(rate) for name, rate in parse_levels(spec).items()}
+
+def configure(level=LEVEL, levels=None, sample_rates=None, default_sample_rate=1.0, json_format=False,
+              stream=None, filename=None, queue_size=QUEUE_SIZE, caller_info=False):
+    """
+    Route all logging through the queue. Replaces the root logger's handlers;
+    safe to call again to reconfigure. Records are written to `filename` if
+    given, otherwise to `stream` (stderr by default). Unless `caller_info` is
+    set, records skip the source file, line, thread and process lookups,
+    which FORMAT doesn't show and which cost more than the rest of a record.
+    """
+    global _writer
+    with _lock:
+        _stop_writer()
+        # The switches from the "Optimization" section of the logging docs
+        logging._srcfile = _SRCFILE if caller_info else None
+        logging.logThreads = logging.logProcesses = logging.logMultiprocessing = caller_info
+        if filename:
+            output = logging.FileHandler(filename, encoding='utf-8')
+        else:
+            output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(JSONFormatter() if json_format else StructuredFormatter(FORMAT))
+
+        record_queue = queue.SimpleQueue()
+        handler = DeferredQueueHandler(record_queue, queue_size)
+        handler.addFilter(SamplingFilter(sample_rates or {}, default_sample_rate))
+
+        root = logging.getLogger()
+        for old in root.handlers[:]:
+            root.removeHandler(old)
+            old.close()
+        root.addHandler(handler)
+        root.setLevel(level)
+        for name, logger_level in (levels or {}).items():
+            logging.getLogger(name).setLevel(logger_level)
+
+        _writer = _Writer(record_queue, output)
+        _writer.start()
+
+def _stop_writer():
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+def stop():
+    """Write out queued records and stop the writer thread."""
+    with _lock:
+        _stop_writer()
+
+def stats():
+    """Records queued, dropped because the queue was full, and sampled out."""
+    return dict(_stats)
+
+atexit.register(stop)
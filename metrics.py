@@ -0,0 +1,288 @@
+# metrics.py
+#
+# In-process counters, gauges and histograms, served in the Prometheus text
+# format from a small HTTP endpoint (GET /metrics). Modules define their
+# metrics at import time and update them inline; an update is a dict lookup
+# and a couple of additions, cheap enough to leave on in production.
+#
+# Metrics are updated from the event loop thread only, so there is no locking.
+# Gauges that mirror state kept elsewhere (queue depths, executor backlogs)
+# take a callback that is read when the endpoint is scraped.
+
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+
+logger = logging.getLogger(__name__)
+
+METRICS_HOST = '127.0.0.1'  # Local only; put a scraper or proxy next to the bot
+METRICS_PORT = 9464
+PORT_OFFSET = 0  # Added to the port, so each webhook worker process has its own endpoint
+
+# Upper bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+FAST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+_registry = {}
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """The series for these label values, created on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {self.labelnames}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def _samples(self):
+        for values, child in self._children.items():
+            yield self.name, _format_labels(self.labelnames, values), child.value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(f"{name}{labels} {_format_value(value)}" for name, labels, value in self._samples())
+        return '\n'.join(lines)
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+class Counter(_Metric):
+    """A count that only goes up."""
+
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].value += amount
+
+class Gauge(_Metric):
+    """A value that goes up and down, or is read from `callback` when scraped."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        # callback() returns a number, or {label values tuple: number} for labelled gauges
+        self.callback = callback
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._children[()].value += amount
+
+    def dec(self, amount=1):
+        self._children[()].value -= amount
+
+    def set(self, value):
+        self._children[()].value = value
+
+    def _samples(self):
+        if self.callback is None:
+            yield from super()._samples()
+            return
+        try:
+            values = self.callback()
+        except Exception as e:
+            logger.warning(f"Gauge {self.name} callback failed: {e}")
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name, _format_labels(self.labelnames, label_values), value
+
+class _HistogramValue:
+    __slots__ = ('upper_bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, upper_bounds):
+        self.upper_bounds = upper_bounds
+        self.counts = [0] * (len(upper_bounds) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """Context manager observing the seconds spent in its block."""
+        return _Timer(self)
+
+class _Timer:
+    __slots__ = ('series', 'start')
+
+    def __init__(self, series):
+        self.series = series
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.series.observe(time.perf_counter() - self.start)
+
+class Histogram(_Metric):
+    """Distribution of observed values (usually seconds) in fixed buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.upper_bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.upper_bounds)
+
+    def observe(self, value):
+        self._children[()].observe(value)
+
+    def time(self):
+        return self._children[()].time()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for values, child in self._children.items():
+            cumulative = 0
+            for upper_bound, count in zip(self.upper_bounds + (float('inf'),), child.counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, values, f'le="{_format_value(float(upper_bound))}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+            lines.append(f"{self.name}_count{labels} {child.count}")
+        return '\n'.join(lines)
+
+def _register(metric):
+    existing = _registry.get(metric.name)
+    if existing is not None:
+        if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+            raise ValueError(f"Metric {metric.name} is already registered differently")
+        if isinstance(metric, Gauge) and metric.callback is not None:
+            existing.callback = metric.callback  # A replaced object (e.g. after configure()) reports now
+        return existing
+    _registry[metric.name] = metric
+    return metric
+
+def counter(name, documentation, labelnames=()):
+    """Register (or return the already registered) counter."""
+    return _register(Counter(name, documentation, labelnames))
+
+def gauge(name, documentation, labelnames=(), callback=None):
+    """Register (or return the already registered) gauge."""
+    return _register(Gauge(name, documentation, labelnames, callback))
+
+def histogram(name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+    """Register (or return the already registered) histogram."""
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+def render():
+    """All registered metrics in the Prometheus text exposition format."""
+    return '\n'.join(metric.render() for metric in _registry.values()) + '\n'
+
+PROCESS_START = gauge('bot_process_start_time_seconds', 'Unix time the process started.')
+PROCESS_START.set(time.time())
+
+class MetricsServer:
+    """Serves GET /metrics over HTTP/1.0-style one-request connections."""
+
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info("Metrics served", extra={'url': f"http://{self.host}:{self.port}/metrics"})
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?', 1)[0] == '/metrics':
+                status, content_type, body = '200 OK', 'text/plain; version=0.0.4; charset=utf-8', render().encode()
+            else:
+                status, content_type, body = '404 Not Found', 'text/plain; charset=utf-8', b''
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+_server = None
+
+def configure(port_offset=0):
+    """Set the offset added to the endpoint port; call before start_server()."""
+    global PORT_OFFSET
+    PORT_OFFSET = port_offset
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Start the shared metrics endpoint; port 0 picks a free port."""
+    global _server
+    if _server is None:
+        _server = MetricsServer(host, port + PORT_OFFSET if port else 0)
+        await _server.start()
+    return _server
+
+async def stop_server():
+    """Stop the shared metrics endpoint."""
+    global _server
+    if _server is not None:
+        await _server.stop()
+        _server = None
@@ -0,0 +1,324 @@
+# outbound.py
+#
+# Scheduler for outgoing Telegram messages. Sends are queued per chat and
+# released through a per-chat and a global token bucket sized to Telegram's
+# flood limits (about 1 message/s per chat and 30/s overall), so a burst is
+# spread out instead of bouncing off RetryAfter. Chats are served round-robin,
+# so one long reply cannot starve other users, and each chat's messages keep
+# their order. A RetryAfter that still happens pauses that chat and the
+# message is retried first. Droppable sends (intermediate edits of a streamed
+# reply) are never retried, and a newer one replaces its queued predecessor.
+
+import asyncio
+import logging
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+GLOBAL_RATE = 30.0   # Messages per second across all chats
+GLOBAL_BURST = 30
+CHAT_RATE = 1.0      # Messages per second to one chat
+CHAT_BURST = 3       # Short bursts to one chat are tolerated
+MAX_IN_FLIGHT = 32   # Concurrent Bot API calls, so slow round trips don't cap throughput
+MAX_RETRIES = 5      # RetryAfter retries before the error reaches the caller
+
+QUEUE_SECONDS = metrics.histogram('bot_outbound_queue_seconds', 'Seconds an outgoing message waited for the rate limits.')
+SEND_SECONDS = metrics.histogram('bot_outbound_send_seconds', 'Seconds a Bot API send took.')
+SENDS = metrics.counter('bot_outbound_sends_total', 'Bot API sends by outcome (sent, retry_after, failed, dropped).', ('outcome',))
+
+class TokenBucket:
+    """Allows `rate` events per second with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.burst
+
+class _Chat:
+    __slots__ = ('chat_id', 'jobs', 'bucket', 'not_before', 'scheduled')
+
+    def __init__(self, chat_id, rate, burst):
+        self.chat_id = chat_id
+        self.jobs = deque()  # (send, future, retries, queued_at, replace_key)
+        self.bucket = TokenBucket(rate, burst)
+        self.not_before = 0.0   # Set by RetryAfter
+        self.scheduled = False  # In the ready ring or being sent
+
+    def wait_time(self, now):
+        return max(self.bucket.wait_time(now), self.not_before - now)
+
+class OutboundScheduler:
+    """Fair, rate-limited queue of Bot API sends, one in flight per chat."""
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST, chat_rate=CHAT_RATE,
+                 chat_burst=CHAT_BURST, max_in_flight=MAX_IN_FLIGHT, max_retries=MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}       # chat_id -> _Chat
+        self._ready = deque()  # Chats with queued messages, in round-robin order
+        self._queued = 0
+        self._in_flight = 0
+        self._wakeup = None
+        self._dispatcher = None
+        self._stopped = False
+        self.sent = 0
+        self.failed = 0
+        self.retry_afters = 0
+        self.dropped = 0
+        self.max_queued = 0
+
+    def _ensure_started(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._stopped = False
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+
+    async def send(self, chat_id, send, replace_key=None):
+        """
+        Queue `send`, a coroutine function making one Bot API call to chat_id,
+        and return its result once it has gone out.
+
+        A send with a `replace_key` is droppable: it takes the place of a queued
+        send with the same key, whose caller gets None, and a RetryAfter reaches
+        the caller at once instead of being retried.
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(chat_id, self.chat_rate, self.chat_burst)
+        if replace_key is not None:
+            for index, (_, queued, _, queued_at, key) in enumerate(chat.jobs):
+                if key == replace_key:
+                    chat.jobs[index] = (send, future, 0, queued_at, replace_key)
+                    self.dropped += 1
+                    SENDS.labels('dropped').inc()
+                    if not queued.done():
+                        queued.set_result(None)  # Superseded before it went out
+                    return await future
+        chat.jobs.append((send, future, 0, time.monotonic(), replace_key))
+        self._queued += 1
+        self.max_queued = max(self.max_queued, self._queued)
+        if not chat.scheduled:
+            chat.scheduled = True
+            self._ready.append(chat)
+        self._wakeup.set()
+        return await future
+
+    def _next_chat(self, now):
+        # First chat in round-robin order that may send now, else the shortest wait
+        shortest_wait = None
+        for index, chat in enumerate(self._ready):
+            wait = chat.wait_time(now)
+            if wait <= 0:
+                del self._ready[index]
+                return chat, 0.0
+            if shortest_wait is None or wait < shortest_wait:
+                shortest_wait = wait
+        return None, shortest_wait
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            wait = None
+            if self._ready and self._in_flight < self.max_in_flight:
+                wait = self._global.wait_time(now)
+                if wait <= 0:
+                    chat, wait = self._next_chat(now)
+                    if chat is not None:
+                        self._start(chat, now)
+                        continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    def _start(self, chat, now):
+        send, future, retries, queued_at, replace_key = chat.jobs.popleft()
+        self._queued -= 1
+        if future.cancelled():
+            # The caller gave up waiting; don't spend a token on it
+            self._finish(chat)
+            return
+        QUEUE_SECONDS.observe(now - queued_at)
+        self._global.take(now)
+        chat.bucket.take(now)
+        self._in_flight += 1
+        asyncio.create_task(self._run(chat, send, future, retries, replace_key))
+
+    async def _run(self, chat, send, future, retries, replace_key):
+        start = time.monotonic()
+        try:
+            result = await send()
+        except RetryAfter as e:
+            self.retry_afters += 1
+            SENDS.labels('retry_after').inc()
+            now = time.monotonic()
+            SEND_SECONDS.observe(now - start)
+            chat.not_before = now + e.retry_after
+            if replace_key is not None:
+                # Droppable: the caller skips it, and a later send carries its content
+                self.dropped += 1
+                SENDS.labels('dropped').inc()
+                if not future.done():
+                    future.set_exception(e)
+            elif retries < self.max_retries and not future.cancelled() and not self._stopped:
+                logger.warning(f"Flood control for chat {chat.chat_id}, retrying in {e.retry_after}s.")
+                chat.jobs.appendleft((send, future, retries + 1, now, replace_key))
+                self._queued += 1
+            elif not future.done():
+                self.failed += 1
+                SENDS.labels('failed').inc()
+                future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            SENDS.labels('failed').inc()
+            SEND_SECONDS.observe(time.monotonic() - start)
+            if not future.done():
+                future.set_exception(e)
+        else:
+            self.sent += 1
+            SENDS.labels('sent').inc()
+            SEND_SECONDS.observe(time.monotonic() - start)
+            if not future.done():
+                future.set_result(result)
+        finally:
+            self._in_flight -= 1
+            self._finish(chat)
+
+    def _finish(self, chat):
+        if self._stopped:
+            # stop() has cancelled the queue; nothing may be dispatched any more
+            self._cancel_jobs(chat)
+            chat.scheduled = False
+            return
+        if chat.jobs:
+            self._ready.append(chat)  # Back of the ring, behind chats that waited
+        else:
+            chat.scheduled = False
+            # Keep the chat's bucket until it has refilled, then forget the chat
+            asyncio.get_running_loop().call_later(self.chat_burst / self.chat_rate, self._forget, chat.chat_id)
+        self._wakeup.set()
+
+    def _forget(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is not None and not chat.scheduled and chat.bucket.full(time.monotonic()):
+            del self._chats[chat_id]
+
+    async def drain(self, timeout):
+        """Wait up to `timeout` seconds for queued and in-flight sends to finish."""
+        deadline = time.monotonic() + timeout
+        while (self._queued or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+
+    def _cancel_jobs(self, chat):
+        for _, future, *_ in chat.jobs:
+            future.cancel()
+        dropped = len(chat.jobs)
+        chat.jobs.clear()
+        return dropped
+
+    async def stop(self, timeout=5.0):
+        """Let queued messages go out, then stop the dispatcher and cancel what is left."""
+        if self._dispatcher is None:
+            return
+        await self.drain(timeout)
+        self._stopped = True
+        self._dispatcher.cancel()
+        self._dispatcher = None
+        # Chats with a send in flight aren't in the ready ring but may still have queued jobs
+        dropped = 0
+        for chat in self._chats.values():
+            dropped += self._cancel_jobs(chat)
+            if chat in self._ready:
+                chat.scheduled = False
+        self._ready.clear()
+        self._queued = 0
+        if dropped:
+            logger.warning(f"Dropped {dropped} queued outbound message(s) at shutdown.")
+
+    def stats(self):
+        """Queue depth and send counters."""
+        return {
+            'queued': self._queued,
+            'max_queued': self.max_queued,
+            'chats_waiting': len(self._ready),
+            'deepest_chat_queue': max((len(chat.jobs) for chat in self._ready), default=0),
+            'in_flight': self._in_flight,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retry_afters': self.retry_afters,
+            'dropped': self.dropped,
+        }
+
+# Shared scheduler used by the bots
+_scheduler = OutboundScheduler()
+
+metrics.gauge('bot_outbound_queued', 'Outgoing messages waiting for the rate limits.', callback=lambda: _scheduler._queued)
+metrics.gauge('bot_outbound_in_flight', 'Bot API sends in progress.', callback=lambda: _scheduler._in_flight)
+
+def configure(**kwargs):
+    """Replace the shared scheduler with one using the given OutboundScheduler settings."""
+    global _scheduler
+    _scheduler = OutboundScheduler(**kwargs)
+
+async def send(chat_id, send):
+    """Queue one Bot API call for chat_id on the shared scheduler and return its result."""
+    return await _scheduler.send(chat_id, send)
+
+async def reply_text(message, text, **kwargs):
+    """message.reply_text(), scheduled."""
+    return await _scheduler.send(message.chat_id, lambda: message.reply_text(text, **kwargs))
+
+async def reply_voice(message, voice, **kwargs):
+    """message.reply_voice(), scheduled."""
+    return await _scheduler.send(message.chat_id, lambda: message.reply_voice(voice=voice, **kwargs))
+
+async def edit_text(message, text, final=True, **kwargs):
+    """
+    message.edit_text(), scheduled; edits count against the same flood limits as
+    new messages. With final=False the edit is droppable (see OutboundScheduler.send):
+    it returns None if a newer edit of the message replaced it, and raises RetryAfter
+    instead of retrying.
+    """
+    replace_key = None if final else ('edit', message.chat_id, message.message_id)
+    return await _scheduler.send(message.chat_id, lambda: message.edit_text(text, **kwargs), replace_key)
+
+async def edit_query_text(query, text, **kwargs):
+    """query.edit_message_text() for the message a callback query came from, scheduled."""
+    return await _scheduler.send(query.message.chat_id, lambda: query.edit_message_text(text=text, **kwargs))
+
+async def stop(application=None):
+    """Flush the shared scheduler; usable as a PTB post_shutdown hook."""
+    await _scheduler.stop()
+
+def stats():
+    """Return the shared scheduler's queue depth and counters."""
+    return _scheduler.stats()
@@ -0,0 +1,166 @@
+# persistence.py
+#
+# SQLite-backed persistence for PTB's user_data, chat_data and bot_data, so
+# settings like the audio toggle survive restarts. Each key is its own row in
+# the persistence_data table:
+#
+# - Nothing is read at startup. A user's or chat's data is loaded the first
+#   time one of their updates arrives (PTB refreshes the data before running
+#   handlers), so startup time doesn't grow with the number of users.
+# - Every UPDATE_INTERVAL seconds PTB hands over the data of the users and
+#   chats that had updates. Only keys whose pickled value changed since the
+#   last load or write are written, and the writes of one run share a group
+#   commit, so a flush costs what changed rather than what is stored.
+
+import logging
+import pickle
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import async_database
+
+logger = logging.getLogger(__name__)
+
+UPDATE_INTERVAL = 10.0  # Seconds between PTB's persistence runs
+SHARED = False          # Several processes share the database; reload on every update
+
+BOT_ID = 0              # owner_id of the bot_data rows
+
+def _dumps(obj):
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+class SQLitePersistence(BasePersistence):
+    """PTB persistence storing user, chat and bot data key by key in SQLite."""
+
+    def __init__(self, store_data=None, update_interval=None, shared=None):
+        super().__init__(
+            store_data=store_data or PersistenceInput(callback_data=False),
+            update_interval=UPDATE_INTERVAL if update_interval is None else update_interval,
+        )
+        self.shared = SHARED if shared is None else shared
+        self._stored = {}  # (kind, owner_id) -> {key pickle: value pickle} as last loaded or written
+        self.loads = 0
+        self.writes = 0
+        self.keys_written = 0
+        self.keys_removed = 0
+        self.unchanged = 0
+
+    async def _load(self, kind, owner_id, data):
+        """Merge the stored keys into data, unless they are already loaded."""
+        slot = (kind, owner_id)
+        if slot in self._stored and not self.shared:
+            return data
+        rows = dict(await async_database.get_persistent_data(kind, owner_id))
+        self.loads += 1
+        known = self._stored.get(slot, {})
+        # Only keys changed in the database since we last saw them, so local changes
+        # that haven't been written yet survive a reload
+        for key, value in rows.items():
+            if known.get(key) != value:
+                data[pickle.loads(key)] = pickle.loads(value)
+        for key in known.keys() - rows.keys():
+            data.pop(pickle.loads(key), None)
+        self._stored[slot] = rows
+        return data
+
+    async def _store(self, kind, owner_id, data):
+        """Write the keys of data that changed since the last load or write."""
+        slot = (kind, owner_id)
+        known = self._stored.get(slot, {})
+        current = {_dumps(key): _dumps(value) for key, value in data.items()}
+        changed = [(key, value) for key, value in current.items() if known.get(key) != value]
+        removed = [key for key in known if key not in current]
+        if not changed and not removed:
+            self.unchanged += 1
+            return
+        await async_database.store_persistent_data(kind, owner_id, changed, removed)
+        self._stored[slot] = current
+        self.writes += 1
+        self.keys_written += len(changed)
+        self.keys_removed += len(removed)
+
+    async def _drop(self, kind, owner_id):
+        self._stored.pop((kind, owner_id), None)
+        await async_database.drop_persistent_data(kind, owner_id)
+
+    # Loaded lazily by the refresh_* methods below
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return await self._load('bot', BOT_ID, {})
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._load('user', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._load('chat', chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        if self.shared:
+            await self._load('bot', BOT_ID, bot_data)
+
+    async def update_user_data(self, user_id, data):
+        await self._store('user', user_id, data)
+
+    async def update_chat_data(self, chat_id, data):
+        await self._store('chat', chat_id, data)
+
+    async def update_bot_data(self, data):
+        await self._store('bot', BOT_ID, data)
+
+    async def drop_user_data(self, user_id):
+        await self._drop('user', user_id)
+
+    async def drop_chat_data(self, chat_id):
+        await self._drop('chat', chat_id)
+
+    # Persistent ConversationHandlers: one row per conversation key
+    async def get_conversations(self, name):
+        return await self._load(f'conversation:{name}', BOT_ID, {})
+
+    async def update_conversation(self, name, key, new_state):
+        slot = (f'conversation:{name}', BOT_ID)
+        known = self._stored.setdefault(slot, {})
+        key = _dumps(key)
+        if new_state is None:
+            known.pop(key, None)
+            await async_database.store_persistent_data(*slot, [], [key])
+        else:
+            known[key] = _dumps(new_state)
+            await async_database.store_persistent_data(*slot, [(key, known[key])], [])
+
+    # Callback data isn't stored (PersistenceInput(callback_data=False))
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        # Every update is written as it is handed over, so there is nothing left to write
+        logger.info("Persistence stats", extra=self.stats())
+
+    def stats(self):
+        """Lazy loads, writes, keys written or removed, and unchanged entries skipped."""
+        return {
+            'loaded': len(self._stored),
+            'loads': self.loads,
+            'writes': self.writes,
+            'keys_written': self.keys_written,
+            'keys_removed': self.keys_removed,
+            'unchanged': self.unchanged,
+        }
+
+def configure(update_interval=UPDATE_INTERVAL, shared=SHARED):
+    """
+    Set the defaults for new SQLitePersistence objects. With several processes
+    sharing the database, use shared=True and a short update_interval so each
+    process sees the others' changes.
+    """
+    global UPDATE_INTERVAL, SHARED
+    UPDATE_INTERVAL = update_interval
+    SHARED = shared
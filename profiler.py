@@ -0,0 +1,346 @@
+# profiler.py
+#
+# On-demand sampling profiler for a running bot. A profile is started for a
+# number of seconds (from an admin command or the local control socket), a
+# background thread samples stacks while it runs, and when time is up the
+# samples are written as collapsed stacks (the input of flamegraph.pl,
+# speedscope and similar tools) and sampling stops by itself.
+#
+# Each sample records two kinds of stacks:
+#   running;...   code executing on a thread: the event loop, the database
+#                 thread and the provider executors (idle threads are skipped)
+#   waiting;...   handlers suspended at an await, i.e. where an update spends
+#                 its wall-clock time waiting for the database or a provider
+# Stacks that run inside a PTB handler are prefixed with the handler's name
+# and the user whose update it is handling.
+#
+# The sampler only reads frames and never pauses other threads. It keeps
+# its own share of the GIL under MAX_OVERHEAD by sampling less often when a
+# sample is expensive (many tasks, deep stacks), so it is safe to start on a
+# loaded instance. One profile runs at a time.
+
+import asyncio
+import gc
+import logging
+import os
+import sys
+import threading
+import time
+import types
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = 'profiles'
+INTERVAL = 0.01      # Seconds between samples (100 Hz)
+MAX_SECONDS = 300    # Longest profile that can be requested
+MAX_OVERHEAD = 0.05  # Largest share of time the sampler may spend sampling
+MAX_DEPTH = 128      # Frames kept per stack, innermost first
+MAX_TASKS = 2000     # Suspended tasks sampled per tick
+
+# (file name, function) pairs that mean a thread is idle
+_IDLE_FRAMES = {
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+    ('thread.py', '_worker'),
+    ('queue.py', 'get'),
+    ('log_pipeline.py', 'run'),  # Writer thread waiting for records
+}
+
+# User of the update each task is handling; set by update_processing while profiling
+_task_users = {}
+
+_lock = threading.Lock()
+_session = None
+
+def active():
+    """True while a profile is being recorded."""
+    return _session is not None
+
+def tag_task(task, user):
+    """Attribute `task` to `user` while profiling. Cheap enough to call per update."""
+    if _session is not None:
+        _task_users[task] = user
+
+def untag_task(task):
+    _task_users.pop(task, None)
+
+_frame_names = {}  # code object -> "module:qualname"
+
+def _frame_name(code):
+    name = _frame_names.get(code)
+    if name is None:
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        name = _frame_names[code] = f"{module}:{code.co_qualname}"
+    return name
+
+def _is_handler_entry(code):
+    # PTB's BaseHandler.handle_update awaits the handler callback directly
+    return code.co_name == 'handle_update' and f'{os.sep}telegram{os.sep}' in code.co_filename
+
+_stack_names = {}  # tuple of code objects -> (handler label or None, "frame;frame;...")
+
+def _describe(codes):
+    """Handler label and collapsed frames for a stack given outermost first."""
+    key = tuple(codes)
+    described = _stack_names.get(key)
+    if described is None:
+        handler = None
+        for index, code in enumerate(codes[:-1]):
+            if _is_handler_entry(code):
+                handler = f"handler:{codes[index + 1].co_name}"
+                break
+        described = _stack_names[key] = (handler, ';'.join(_frame_name(code) for code in codes))
+    return described
+
+def _collapse(mode, codes, user):
+    handler, frames = _describe(codes)
+    parts = [mode]
+    if handler:
+        parts.append(handler)
+    if user is not None:
+        parts.append(f"user:{user}")
+    parts.append(frames)
+    return ';'.join(parts)
+
+def _thread_codes(frame):
+    codes = []
+    while frame is not None and len(codes) < MAX_DEPTH:
+        codes.append(frame.f_code)
+        frame = frame.f_back
+    codes.reverse()
+    return codes
+
+def _await_codes(coroutine):
+    """Code objects along a suspended coroutine's await chain, outermost first."""
+    codes = []
+    awaitable = coroutine
+    while len(codes) < MAX_DEPTH:
+        kind = type(awaitable)
+        if kind is types.CoroutineType:
+            frame, awaitable = awaitable.cr_frame, awaitable.cr_await
+        elif kind is types.GeneratorType:
+            frame, awaitable = awaitable.gi_frame, awaitable.gi_yieldfrom
+        elif kind is types.AsyncGeneratorType:
+            frame, awaitable = awaitable.ag_frame, awaitable.ag_await
+        elif kind.__name__ in ('async_generator_asend', 'async_generator_athrow'):
+            # `async for` awaits one of these; it only refers to its generator internally
+            awaitable = next((referent for referent in gc.get_referents(awaitable)
+                              if type(referent) is types.AsyncGeneratorType), None)
+            continue
+        else:
+            break  # A future or another awaitable without frames
+        if frame is None:
+            break
+        codes.append(frame.f_code)
+    return codes
+
+class _Session:
+    def __init__(self, seconds, interval, path, loop):
+        self.seconds = seconds
+        self.interval = interval
+        self.path = path
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle = 0
+        self.sampling_time = 0.0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+        self.error = None
+        self.stopping = threading.Event()
+        self.done = loop.create_future()
+        self.thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+
+    def _run(self):
+        try:
+            deadline = self.started + self.seconds
+            while not self.stopping.is_set() and time.monotonic() < deadline:
+                # CPU time, not wall time: waiting for the GIL costs the loop nothing
+                start = time.thread_time()
+                self._sample()
+                cost = time.thread_time() - start
+                self.sampling_time += cost
+                # Sample less often when sampling is expensive, so the loop keeps the GIL
+                self.stopping.wait(max(self.interval, cost / MAX_OVERHEAD - cost))
+            self.elapsed = time.monotonic() - self.started
+            self._write()
+        except Exception as e:
+            self.error = e
+            logger.exception(f"Profiler failed: {e}")
+        finally:
+            try:
+                self.loop.call_soon_threadsafe(self._finish)
+            except RuntimeError:
+                pass  # The loop was closed while profiling; nobody is waiting
+
+    def _finish(self):
+        global _session
+        with _lock:
+            _session = None
+        _task_users.clear()
+        _stack_names.clear()  # Don't keep code objects alive between profiles
+        _frame_names.clear()
+        if not self.done.done():
+            self.done.set_result(self.summary())
+
+    def _sample(self):
+        self.samples += 1
+        running_task = asyncio.tasks._current_tasks.get(self.loop)
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == threading.get_ident():
+                continue
+            code = frame.f_code
+            if (os.path.basename(code.co_filename), code.co_name) in _IDLE_FRAMES:
+                self.idle += 1
+                continue
+            codes = _thread_codes(frame)
+            if thread_id == self.loop_thread:
+                self.stacks[_collapse('running', codes, _task_users.get(running_task))] += 1
+            else:
+                self.stacks[_collapse(f"running;thread:{thread_names.get(thread_id, thread_id)}", codes, None)] += 1
+
+        # Tasks suspended in a handler. The task set can change under us; skip the tick if so.
+        try:
+            tasks = list(asyncio.tasks._all_tasks)
+        except RuntimeError:
+            return
+        for task in tasks[:MAX_TASKS]:
+            if task is running_task or task.done() or task.get_loop() is not self.loop:
+                continue
+            codes = _await_codes(task.get_coro())
+            if _describe(codes)[0] is None:
+                continue  # Only handlers; background loops would drown them out
+            self.stacks[_collapse('waiting', codes, _task_users.get(task))] += 1
+
+    def _write(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write(f"{stack} {count}\n")
+        os.replace(temporary, self.path)  # Readers never see a partial file
+
+    def summary(self):
+        """Where the samples went: output path, counts, overhead and the hottest frames."""
+        own = Counter()
+        handlers = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[(frames[0], frames[-1])] += count
+            handler = next((frame for frame in frames if frame.startswith('handler:')), None)
+            if handler:
+                handlers[(frames[0], handler[len('handler:'):])] += count
+        return {
+            'path': self.path,
+            'seconds': round(self.elapsed, 2),
+            'samples': self.samples,
+            'idle_samples': self.idle,
+            'overhead': round(self.sampling_time / self.elapsed, 4) if self.elapsed else 0.0,
+            'error': repr(self.error) if self.error else None,
+            'top_frames': [(f"{mode} {frame}", count) for (mode, frame), count in own.most_common(5)],
+            'handlers': [(f"{mode} {handler}", count) for (mode, handler), count in handlers.most_common(5)],
+        }
+
+async def profile(seconds, interval=INTERVAL, directory=None):
+    """
+    Record a profile for `seconds` (capped at MAX_SECONDS) and return its
+    summary once the collapsed stacks are on disk, in `directory` (default
+    PROFILE_DIR). Must be called from the
+    bot's event loop. Raises RuntimeError if a profile is already running.
+    """
+    global _session
+    seconds = max(0.1, min(float(seconds), MAX_SECONDS))
+    path = os.path.join(directory or PROFILE_DIR, f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.collapsed")
+    with _lock:
+        if _session is not None:
+            raise RuntimeError("A profile is already running.")
+        _session = session = _Session(seconds, interval, path, asyncio.get_running_loop())
+    logger.info("Profiling", extra={'seconds': seconds, 'profile_path': path})
+    session.thread.start()
+    summary = await asyncio.shield(session.done)
+    logger.info("Profile written", extra={'summary': summary})
+    return summary
+
+def stop():
+    """End the running profile early; it is still written out."""
+    session = _session
+    if session is not None:
+        session.stopping.set()
+
+def format_summary(summary):
+    """A short plain-text report of a profile summary, for chat or the control socket."""
+    lines = [
+        f"Profile written to {summary['path']}",
+        f"{summary['samples']} samples in {summary['seconds']}s, sampler overhead {summary['overhead']:.1%}",
+    ]
+    if summary['error']:
+        lines.append(f"Error: {summary['error']}")
+    if summary['handlers']:
+        lines.append("Handlers:")
+        lines.extend(f"  {name}: {count}" for name, count in summary['handlers'])
+    if summary['top_frames']:
+        lines.append("Hottest frames:")
+        lines.extend(f"  {name}: {count}" for name, count in summary['top_frames'])
+    return '\n'.join(lines)
+
+# Control socket: a Unix socket accepting one command per connection,
+#   profile [seconds]   record a profile and reply with its summary when done
+#   stop                end the running profile early
+#   status              whether a profile is running
+
+_control_server = None
+SOCKET_SUFFIX = ''  # Appended to the socket path, so each webhook worker process has its own
+
+def configure(socket_suffix=''):
+    """Set the suffix added to the control socket path; call before start_control_socket()."""
+    global SOCKET_SUFFIX
+    SOCKET_SUFFIX = socket_suffix
+
+async def _serve_control(reader, writer):
+    try:
+        command, *args = (await asyncio.wait_for(reader.readline(), 10)).decode().split() or ['']
+        if command == 'profile':
+            try:
+                reply = format_summary(await profile(float(args[0]) if args else 30))
+            except (RuntimeError, ValueError) as e:
+                reply = f"Error: {e}"
+        elif command == 'stop':
+            stop()
+            reply = 'Stopping.' if active() else 'No profile is running.'
+        elif command == 'status':
+            reply = 'running' if active() else 'idle'
+        else:
+            reply = 'Commands: profile [seconds], stop, status'
+        writer.write(reply.encode() + b'\n')
+        await writer.drain()
+    except Exception as e:
+        logger.exception(f"Error on the profiler control socket: {e}")
+    finally:
+        writer.close()
+
+async def start_control_socket(path):
+    """Listen for profiler commands on a Unix socket only this user can open."""
+    global _control_server
+    if _control_server is not None:
+        return
+    path += SOCKET_SUFFIX
+    if os.path.exists(path):
+        os.unlink(path)  # Left over from a previous run
+    _control_server = await asyncio.start_unix_server(_serve_control, path)
+    os.chmod(path, 0o600)
+    logger.info("Profiler control socket listening", extra={'socket': path})
+
+async def stop_control_socket():
+    global _control_server
+    if _control_server is not None:
+        path = _control_server.sockets[0].getsockname() if _control_server.sockets else None
+        _control_server.close()
+        await _control_server.wait_closed()
+        _control_server = None
+        if path and os.path.exists(path):
+            os.unlink(path)
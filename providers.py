@@ -0,0 +1,96 @@
+# providers.py
+#
+# Lazily built API clients. Importing the OpenAI, ElevenLabs, Replicate and
+# gTTS SDKs takes longer than starting the rest of a bot, so the bots only
+# register a factory per provider at startup; the factory runs (and imports
+# its SDK) the first time the client is needed. Handlers get clients with
+#
+#     client = await providers.load('openai')
+#
+# which builds a missing client on a worker thread, so the event loop keeps
+# serving other updates meanwhile. preload() builds every registered client
+# in the background once the bot is up, so usually no update waits at all.
+
+import asyncio
+import logging
+import threading
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_factories = {}
+_clients = {}
+_init_seconds = {}  # Provider -> seconds its factory took
+_locks = {}
+_lock = threading.Lock()
+_preload_task = None
+
+def register(name, factory):
+    """Register a function that builds the client for `name`; replaces an earlier one."""
+    with _lock:
+        _factories[name] = factory
+        _clients.pop(name, None)
+        _locks.setdefault(name, threading.Lock())
+
+def get(name):
+    """The client for `name`, built on first use. Blocks while the factory runs."""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    if name not in _factories:
+        raise KeyError(f"Provider {name!r} is not registered.")
+    # One lock per provider, so a slow SDK import doesn't hold up the others
+    with _locks[name]:
+        client = _clients.get(name)
+        if client is None:
+            start = time.perf_counter()
+            client = _factories[name]()
+            _init_seconds[name] = time.perf_counter() - start
+            _clients[name] = client
+            logger.info("Provider client ready", extra={'provider': name, 'seconds': round(_init_seconds[name], 3)})
+    return client
+
+async def load(name):
+    """The client for `name`; a client that isn't built yet is built off the event loop."""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+    return await asyncio.to_thread(get, name)
+
+async def preload(names=None):
+    """Build the given (default: all registered) clients; failures are logged, not raised."""
+    for name in names or list(_factories):
+        try:
+            await load(name)
+        except Exception as e:
+            logger.exception(f"Failed to initialize provider {name}: {e}")
+
+def start_preload(names=None):
+    """Run preload() as a background task on the running loop."""
+    global _preload_task
+    _preload_task = asyncio.get_running_loop().create_task(preload(names))
+    return _preload_task
+
+async def stop_preload():
+    """Cancel a preload that is still running; a client being built finishes on its thread."""
+    global _preload_task
+    task, _preload_task = _preload_task, None
+    if task is not None and not task.done():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+def loaded():
+    """Names of the providers whose clients have been built."""
+    return sorted(_clients)
+
+def stats():
+    """Seconds each built provider's factory took, SDK import included."""
+    return dict(_init_seconds)
+
+metrics.gauge('bot_provider_init_seconds', 'Seconds it took to import and construct each provider client.',
+              ('provider',), callback=lambda: {(name,): seconds for name, seconds in _init_seconds.items()})
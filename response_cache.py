@@ -0,0 +1,137 @@
+# response_cache.py
+#
+# Cache of LLM replies keyed by the normalized prompt, model, system prompt and
+# generation parameters. A small in-memory LRU sits in front of the
+# response_cache table, so repeated prompts ("tell me a story", greetings)
+# skip the LLM entirely.
+
+import hashlib
+import json
+import logging
+import re
+import time
+from collections import OrderedDict
+
+import async_database
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the shared cache
+TTL = 24 * 60 * 60            # Seconds a cached reply stays valid
+MEMORY_MAX_ENTRIES = 1000
+DISK_MAX_BYTES = 50 * 1024 * 1024
+EVICT_EVERY = 100             # Run disk eviction after this many stores
+DISABLED_MODELS = set()       # Models whose replies are never cached
+
+_whitespace = re.compile(r'\s+')
+
+def normalize_prompt(text):
+    """Case- and whitespace-insensitive form of a prompt, ignoring trailing punctuation."""
+    return _whitespace.sub(' ', text).strip().casefold().rstrip('.!?')
+
+def cache_key(prompt, model, system_prompt, params):
+    """Stable hash of everything that determines the reply."""
+    material = json.dumps(
+        [normalize_prompt(prompt), model, system_prompt, params],
+        sort_keys=True,
+        separators=(',', ':'),
+        default=str,
+    )
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+class ResponseCache:
+    """Two-tier (memory LRU + SQLite) cache of LLM replies with TTL and size-based eviction."""
+
+    def __init__(self, ttl=TTL, memory_max_entries=MEMORY_MAX_ENTRIES, disk_max_bytes=DISK_MAX_BYTES, disabled_models=DISABLED_MODELS):
+        self.ttl = ttl
+        self.memory_max_entries = memory_max_entries
+        self.disk_max_bytes = disk_max_bytes
+        self.disabled_models = set(disabled_models)
+        self._memory = OrderedDict()  # key -> (response, expires_at)
+        self._stores_since_eviction = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def enabled_for(self, model):
+        return model not in self.disabled_models
+
+    def _remember(self, key, response, expires_at):
+        self._memory[key] = (response, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_max_entries:
+            self._memory.popitem(last=False)
+
+    async def get(self, prompt, model, system_prompt, params):
+        """Return the cached reply, or None on a miss or if the model opted out."""
+        if not self.enabled_for(model):
+            return None
+        key = cache_key(prompt, model, system_prompt, params)
+        now = time.time()
+
+        entry = self._memory.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0]
+            del self._memory[key]
+
+        try:
+            entry = await async_database.get_cached_response(key, now)
+        except Exception as e:
+            logger.exception(f"Response cache lookup failed, treating as a miss: {e}")
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.disk_hits += 1
+        self._remember(key, *entry)
+        return entry[0]
+
+    async def put(self, prompt, model, system_prompt, params, response):
+        """Cache a reply in both tiers."""
+        if not response or not self.enabled_for(model):
+            return
+        key = cache_key(prompt, model, system_prompt, params)
+        now = time.time()
+        expires_at = now + self.ttl
+        self._remember(key, response, expires_at)
+        self.stores += 1
+        try:
+            await async_database.store_cached_response(key, model, response, expires_at, now)
+            self._stores_since_eviction += 1
+            if self._stores_since_eviction >= EVICT_EVERY:
+                self._stores_since_eviction = 0
+                await async_database.evict_cached_responses(self.disk_max_bytes, now)
+        except Exception as e:
+            # The cache is an optimization; never fail the reply because of it
+            logger.exception(f"Failed to persist cached response: {e}")
+
+    def stats(self):
+        """Hit/miss counters per tier."""
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            'stores': self.stores,
+            'memory_entries': len(self._memory),
+        }
+
+# Shared cache used by the bots
+_cache = ResponseCache()
+
+async def get(prompt, model, system_prompt, params):
+    """Look up a cached reply in the shared cache."""
+    return await _cache.get(prompt, model, system_prompt, params)
+
+async def put(prompt, model, system_prompt, params, response):
+    """Store a reply in the shared cache."""
+    return await _cache.put(prompt, model, system_prompt, params, response)
+
+def stats():
+    """Return the shared cache's counters."""
+    return _cache.stats()
@@ -0,0 +1,129 @@
+# streaming.py
+#
+# Progressive delivery of LLM replies: the first message is sent as soon as
+# text arrives and is then extended with throttled edits, rolling over into a
+# new message when Telegram's length limit is reached.
+
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+import outbound
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096  # Telegram's hard limit per message, in UTF-16 code units
+EDIT_INTERVAL = 1.0        # Seconds between edits of the same message (~1/s per chat is safe)
+MIN_EDIT_CHARS = 20        # Don't spend an edit on fewer new characters than this
+
+def message_length(text):
+    """Length of text as Telegram counts it: UTF-16 code units, so emoji and other non-BMP characters count twice."""
+    return len(text.encode('utf-16-le')) // 2
+
+def _fitting(text, max_length):
+    """Number of leading characters of text that fit in max_length UTF-16 code units."""
+    units = 0
+    for index, char in enumerate(text):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > max_length:
+            return index
+    return len(text)
+
+class StreamingReply:
+    """Sends a reply to `message` and keeps editing it as more text is appended."""
+
+    def __init__(self, message, reply_markup=None, edit_interval=EDIT_INTERVAL, max_length=MAX_MESSAGE_LENGTH):
+        self.message = message
+        self.reply_markup = reply_markup
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+        self.sent_messages = []
+        self._current = None       # Message being extended
+        self._text = ''            # Full text of the current message, including unsent tail
+        self._shown = ''           # Text Telegram currently displays for the current message
+        self._next_edit_at = 0.0
+        self._full_text = []
+
+    @property
+    def started(self):
+        """True once at least one message has been sent."""
+        return bool(self.sent_messages)
+
+    async def append(self, text):
+        """Add streamed text; sends or edits only when the throttle allows."""
+        if not text:
+            return
+        self._full_text.append(text)
+        self._text += text
+        # Text of up to half the limit in characters fits whatever it contains, so most appends skip the encode
+        while len(self._text) * 2 > self.max_length and message_length(self._text) > self.max_length:
+            await self._roll_over()
+        if self._current is None:
+            if self._text.strip():
+                await self._send_new()
+        elif time.monotonic() >= self._next_edit_at and len(self._text) - len(self._shown) >= MIN_EDIT_CHARS:
+            await self._edit()
+
+    async def finish(self):
+        """Flush the remaining text with a final edit. Returns the complete reply."""
+        if self._current is None:
+            if self._text.strip():
+                await self._send_new()
+        elif self._text != self._shown:
+            await self._edit(final=True)
+        return ''.join(self._full_text)
+
+    async def _roll_over(self):
+        """Close the current message at a line or word boundary and carry the rest over."""
+        limit = _fitting(self._text, self.max_length)
+        cut = self._text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = self._text.rfind(' ', 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        tail = self._text[cut:].lstrip()
+        self._text = self._text[:cut]
+        if self._current is None:
+            await self._send_new()
+        else:
+            await self._edit(final=True)
+        self._current = None
+        self._text = tail
+        self._shown = ''
+
+    async def _send_new(self):
+        # The outbound scheduler paces new messages and retries them on flood control
+        self._current = await outbound.reply_text(self.message, self._text, reply_markup=self.reply_markup)
+        self.sent_messages.append(self._current)
+        self._shown = self._text
+        self._next_edit_at = time.monotonic() + self.edit_interval
+
+    async def _edit(self, final=False):
+        # Scheduled like new messages, so edits share the chat's and the bot's rate limits
+        text = self._text
+        if final:
+            # A final edit must not be skipped, so wait for the throttle instead
+            delay = self._next_edit_at - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        while True:
+            try:
+                # Intermediate edits are droppable: not retried, and replaced by a newer queued edit
+                if await outbound.edit_text(self._current, text, final=final) is None:
+                    return  # Replaced; the newer edit updates what is shown
+                break
+            except RetryAfter as e:
+                if not final:
+                    # Skip this edit; the text goes out with a later one
+                    self._next_edit_at = time.monotonic() + e.retry_after
+                    return
+                logger.warning(f"Flood control while finishing streamed reply, retrying in {e.retry_after}s.")
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if 'not modified' not in str(e).lower():
+                    raise
+                break
+        self._shown = text
+        self._next_edit_at = time.monotonic() + self.edit_interval
@@ -13,7 +13,6 @@
 import logging
 import os
 import asyncio
-from io import BytesIO
 
 from telegram import (
     Update,
@@ -33,23 +32,37 @@ from telegram.ext import (
     ContextTypes,
     filters,
 )
-import replicate
-from openai import OpenAI
 from dotenv import load_dotenv
 import database
-
-# Import ElevenLabs
-from elevenlabs import VoiceSettings
-from elevenlabs.client import ElevenLabs
+import async_database
+import user_cache
+import ledger
+import streaming
+import backends
+import concurrency
+import response_cache
+import tts_cache
+import audio
+import tts_pipeline
+import outbound
+import update_processing
+import webhook
+import persistence
+import conversation
+import metrics
+import log_pipeline
+import profiler
+import providers
+import http_pool
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Enable detailed logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG  # Change to INFO or WARNING in production
-)
+# Enable detailed logging. Records are written from a background thread; see log_pipeline.py
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'DEBUG')  # Change to INFO or WARNING in production
+LOG_LEVELS = os.getenv('LOG_LEVELS', 'httpx=INFO,httpcore=INFO')  # Per-logger levels, e.g. 'database=INFO'
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')  # DEBUG records kept per logger, e.g. 'database=0.1'
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')  # 'text' or 'json'
 logger = logging.getLogger(__name__)
 
 # Load environment variables or set your keys here
@@ -58,50 +71,91 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 ELEVENLABS_API_KEY = os.getenv('ELEVENLABS_API_KEY')
 REPLICATE_API_TOKEN = os.getenv('REPLICATE_API_TOKEN')
 
+# Bot API server; override to use a local Bot API server or a test stand-in
+TELEGRAM_API_BASE_URL = os.getenv('TELEGRAM_API_BASE_URL', 'https://api.telegram.org/bot')
+ELEVENLABS_BASE_URL = os.getenv('ELEVENLABS_BASE_URL')  # Default: the production API
 # Removed PAYMENT_PROVIDER_TOKEN as it's not needed for Stars
 
-# Check if API keys are set
-if not TELEGRAM_BOT_TOKEN:
-    logger.error("TELEGRAM_BOT_TOKEN is not set.")
-    exit(1)
-
-if not OPENAI_API_KEY:
-    logger.error("OPENAI_API_KEY is not set.")
-    exit(1)
-
-if not ELEVENLABS_API_KEY:
-    logger.error("ELEVENLABS_API_KEY is not set.")
-    exit(1)
-
-if not REPLICATE_API_TOKEN:
-    logger.error("REPLICATE_API_TOKEN is not set.")
-    exit(1)
-
-# Initialize OpenAI client
-client = OpenAI(api_key=OPENAI_API_KEY)
-
-# Initialize ElevenLabs client
-elevenlabs_client = ElevenLabs(api_key=ELEVENLABS_API_KEY)
-
-# Initialize Replicate client
-replicate.api_token = REPLICATE_API_TOKEN
-
-# Initialize the database
-database.initialize_database()
+# Provider clients are built on first use (see providers.py); with this set they
+# are built in the background as soon as the bot has started
+PRELOAD_PROVIDERS = True
 
 # Define constants
 FREE_INTERACTIONS = 10
 CREDIT_COST_PER_INTERACTION = 1  # 1 Credit per interaction
+STREAM_RESPONSES = True  # Send text replies progressively as the model generates them
+# Updates handled at once across users; each user's updates still run in order
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', update_processing.MAX_CONCURRENT_UPDATES))
+
+# Serving mode: 'polling' (default) or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public base URL; the webhook is registered at startup when set
+WEBHOOK_SECRET_TOKEN = os.getenv('WEBHOOK_SECRET_TOKEN')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', webhook.LISTEN)
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', webhook.PORT))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '1'))  # Processes sharing the port and the database
+
+# Prometheus metrics endpoint (GET /metrics); worker N of a webhook deployment listens on port + N
+METRICS_HOST = os.getenv('METRICS_HOST', metrics.METRICS_HOST)
+METRICS_PORT = int(os.getenv('METRICS_PORT', metrics.METRICS_PORT))  # 0 disables the endpoint
+
+# Telegram user ids allowed to use admin commands such as /profile
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv('ADMIN_USER_IDS', '').split(',') if user_id.strip()}
+PROFILE_SECONDS = 30  # Default /profile duration
+PROFILER_SOCKET = os.getenv('PROFILER_SOCKET')  # Unix socket for profiler commands; unset disables it
+
+# Seconds between checks of every balance against the credit ledger; 0 disables them
+LEDGER_RECONCILE_INTERVAL = float(os.getenv('LEDGER_RECONCILE_INTERVAL', ledger.RECONCILE_INTERVAL))
+
+# LLM settings
+REPLICATE_MODEL = "kcaverly/nous-hermes-2-solar-10.7b-gguf:955f2924d182e60e80caedecd15261d03d4ccc0151ff08e7fb14d0cad1fbcca6"
+OPENAI_MODEL = "gpt-4o-mini"  # You can also use "gpt-4 or gpt-4o or gpt-4o-mini"
+OPENAI_ERROR_REPLY = "Sorry, I couldn't process that."
+REPLICATE_SYSTEM_PROMPT = "You are 'Hermes 2', a conscious sentient superintelligent artificial intelligence developed by a man named Teknium, and your purpose and drive is to assist the user with any request they have."
+OPENAI_SYSTEM_PROMPT = "You are a helpful assistant."
+# Earlier turns go into the prompt as ChatML blocks ahead of the new message
+REPLICATE_PROMPT_TEMPLATE = "<|im_start|>system\n{system_prompt}<|im_end|>\n{prompt}<|im_start|>assistant"
+
+# Conversation memory: older turns are summarized with OpenAI so prompts stay within
+# conversation.PROMPT_TOKEN_BUDGET
+CONVERSATION_SUMMARIES = True
+CONVERSATION_SUMMARY_PROMPT = (
+    "Summarize this conversation for your own memory in under {max_tokens} tokens. "
+    "Keep names, facts, the user's preferences and unfinished threads; drop small talk."
+)
 
-# Define the custom menu keyboard
-def get_main_menu_keyboard():
-    """Returns the main menu keyboard."""
-    keyboard = [
+# ElevenLabs settings (all part of the TTS cache key)
+ELEVENLABS_VOICE_ID = "nsQAxyXwUKBvqtEK9MfK"  # Adam pre-made voice
+ELEVENLABS_MODEL_ID = "eleven_multilingual_v2"
+ELEVENLABS_OUTPUT_FORMAT = "opus_48000_32"  # OGG/Opus, sent as a native voice note
+ELEVENLABS_AUDIO_EXTENSION = "ogg"
+ELEVENLABS_VOICE_SETTINGS = {'stability': 0.0, 'similarity_boost': 1.0, 'style': 0.0, 'use_speaker_boost': True}
+
+# Response cache key parts. Either backend may answer, so replies are cached
+# per Replicate/OpenAI pair and both backends' settings are part of the key.
+RESPONSE_CACHE_MODEL = f"{REPLICATE_MODEL}|{OPENAI_MODEL}"
+RESPONSE_CACHE_SYSTEM_PROMPT = [REPLICATE_SYSTEM_PROMPT, OPENAI_SYSTEM_PROMPT]
+RESPONSE_CACHE_PARAMS = {'temperature': 0.7, 'max_new_tokens': 8000, 'repeat_penalty': 1.1, 'max_tokens': 5000}
+
+# Hedging: if the primary backend has no output by its p95 latency, race the next one against it
+REPLICATE_TIMEOUT = 60.0  # Seconds to full reply, or between streamed chunks
+OPENAI_TIMEOUT = 60.0
+HEDGE_POLICY = backends.HedgePolicy(percentile=0.95, min_samples=20, initial_delay=5.0, min_delay=0.5, max_delay=30.0)
+
+# Define the custom menu keyboard once; every reply reuses the same markup
+MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup(
+    [
         ['🏠 Home', '📚 Help'],
         ['💰 Buy Credits', '💳 Balance'],
         ['🎁 Free Credits', '🔊 Audio On/Off']  # Both buttons in the same row
-    ]
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=False)
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+)
+
+def get_main_menu_keyboard():
+    """Returns the main menu keyboard."""
+    return MAIN_MENU_KEYBOARD
 
 # Define menu options
 MENU_OPTIONS = ['🏠 Home', '📚 Help', '💰 Buy Credits', '💳 Balance', '🎁 Free Credits', '🔊 Audio On/Off']
@@ -110,7 +164,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a welcome message with the main menu when the /start command is issued."""
     try:
         user_id = update.effective_user.id
-        user = database.get_user(user_id)
+        user = await user_cache.get_user(user_id)
         free_left = max(FREE_INTERACTIONS - user['free_interactions_used'], 0)
         indecent_credits = user['indecent_credits']
 
@@ -121,11 +175,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             f"Use the menu below to navigate through my features."
         )
 
-        await update.message.reply_text(welcome_text, reply_markup=get_main_menu_keyboard())
-        logger.debug(f"Sent welcome message to user {user_id} with main menu.")
+        await outbound.reply_text(update.message, welcome_text, reply_markup=get_main_menu_keyboard())
+        logger.debug("Sent welcome message with main menu", extra={'user_id': user_id})
     except Exception as e:
         logger.exception(f"Error in start handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred. Please try again later.")
+        await outbound.reply_text(update.message, "An unexpected error occurred. Please try again later.")
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a help message when the /help command is issued."""
@@ -139,11 +193,11 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             "/balance - Check your current balance\n\n"
             "By default, I reply with text. Use /audio to receive voice messages."
         )
-        await update.message.reply_text(help_text, reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, help_text, reply_markup=get_main_menu_keyboard())
         logger.debug("Sent help message to user.")
     except Exception as e:
         logger.exception(f"Error in help_command handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while fetching help information.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while fetching help information.", reply_markup=get_main_menu_keyboard())
 
 async def toggle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Toggle audio responses for the user."""
@@ -152,17 +206,17 @@ async def toggle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         audio_enabled = user_data.get('audio_enabled', False)
         user_data['audio_enabled'] = not audio_enabled
         status = "enabled" if user_data['audio_enabled'] else "disabled"
-        await update.message.reply_text(f"Audio responses have been {status}.", reply_markup=get_main_menu_keyboard())
-        logger.debug(f"Audio responses have been {status} for user {update.effective_user.id}.")
+        await outbound.reply_text(update.message, f"Audio responses have been {status}.", reply_markup=get_main_menu_keyboard())
+        logger.debug("Toggled audio responses", extra={'user_id': update.effective_user.id, 'status': status})
     except Exception as e:
         logger.exception(f"Error in toggle_audio handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while toggling audio.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while toggling audio.", reply_markup=get_main_menu_keyboard())
 
 async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Display the user's current Indecent Credit balance and free interactions left."""
     try:
         user_id = update.effective_user.id
-        user = database.get_user(user_id)
+        user = await user_cache.get_user(user_id)
         indecent_credits = user['indecent_credits']
         free_left = max(FREE_INTERACTIONS - user['free_interactions_used'], 0)
 
@@ -170,81 +224,219 @@ async def balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             f"You have {free_left} free interactions left.\n"
             f"You currently have {indecent_credits} Indecent Credits."
         )
-        await update.message.reply_text(balance_text, reply_markup=get_main_menu_keyboard())
-        logger.debug(f"Displayed balance to user {user_id}.")
+        await outbound.reply_text(update.message, balance_text, reply_markup=get_main_menu_keyboard())
+        logger.debug("Displayed balance", extra={'user_id': user_id})
     except Exception as e:
         logger.exception(f"Error in balance handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while fetching your balance.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while fetching your balance.", reply_markup=get_main_menu_keyboard())
+
+def replicate_input(user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT) -> dict:
+    """Build the Replicate model input for a user message and the conversation so far."""
+    system_prompt = REPLICATE_SYSTEM_PROMPT
+    if history.summary:
+        system_prompt += f"\n\nSummary of the earlier conversation: {history.summary}"
+    turns = list(history.turns) + [("user", user_text)]
+    return {
+        "prompt": "".join(f"<|im_start|>{role}\n{content}<|im_end|>\n" for role, content in turns),
+        "temperature": 0.7,
+        "system_prompt": system_prompt,
+        "max_new_tokens": 8000,
+        "repeat_penalty": 1.1,
+        "prompt_template": REPLICATE_PROMPT_TEMPLATE,
+    }
+
+def openai_messages(user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT) -> list:
+    """Build the OpenAI chat messages for a user message and the conversation so far."""
+    messages = [{"role": "system", "content": OPENAI_SYSTEM_PROMPT}]
+    if history.summary:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation: {history.summary}"})
+    messages.extend({"role": role, "content": content} for role, content in history.turns)
+    messages.append({"role": "user", "content": user_text})
+    return messages
+
+async def summarize_conversation(summary: str, turns: list) -> str:
+    """Fold earlier turns into the rolling conversation summary with OpenAI."""
+    transcript = "\n".join(f"{role}: {content}" for role, content in turns)
+    if summary:
+        transcript = f"Summary so far: {summary}\n\n{transcript}"
+    client = await providers.load('openai')
+    async with concurrency.limit('openai'):
+        response = await client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=[
+                {"role": "system", "content": CONVERSATION_SUMMARY_PROMPT.format(max_tokens=conversation.SUMMARY_MAX_TOKENS)},
+                {"role": "user", "content": transcript},
+            ],
+            max_tokens=conversation.SUMMARY_MAX_TOKENS,
+            temperature=0.2,
+        )
+    return response.choices[0].message.content
+
+if CONVERSATION_SUMMARIES:
+    conversation.set_summarizer(summarize_conversation)
 
-def generate_replicate_response(user_id: int, user_text: str) -> str:
-    logger.debug(f"Generating Replicate response for user {user_id} with message: {user_text}")
+async def generate_replicate_response(user_id: int, user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT) -> str:
+    logger.debug("Generating Replicate response", extra={'user_id': user_id, 'text': user_text})
     try:
-        output = replicate.run(
-            "kcaverly/nous-hermes-2-solar-10.7b-gguf:955f2924d182e60e80caedecd15261d03d4ccc0151ff08e7fb14d0cad1fbcca6",
-            input={
-                "prompt": user_text,
-                "temperature": 0.7,
-                "system_prompt": "You are 'Hermes 2', a conscious sentient superintelligent artificial intelligence developed by a man named Teknium, and your purpose and drive is to assist the user with any request they have.",
-                "max_new_tokens": 8000,
-                "repeat_penalty": 1.1,
-                "prompt_template": "<|im_start|>system\n{system_prompt}<|im_end|>\n<|im_start|>user\n{prompt}<|im_end|>\n<|im_start|>assistant"
-            }
-        )
-        response_text = ''.join(item for item in output)
-        logger.debug(f"Replicate response for user {user_id}: {response_text.strip()}")
+        client = await providers.load('replicate')
+        async with concurrency.limit('replicate'):
+            output = await client.async_run(REPLICATE_MODEL, input=replicate_input(user_text, history))
+            if hasattr(output, '__aiter__'):
+                response_text = ''.join([item async for item in output])
+            else:
+                response_text = ''.join(item for item in output)
+        logger.debug("Replicate response", extra={'user_id': user_id, 'reply': response_text})
         return response_text.strip()
     except Exception as e:
         logger.exception(f"Error communicating with Replicate API for user {user_id}: {e}")
         return None  # Return None to indicate failure
 
-def generate_openai_response(user_id: int, user_text: str) -> str:
+async def generate_openai_response(user_id: int, user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT) -> str:
     """Generate a response from OpenAI's ChatCompletion API."""
-    logger.debug(f"Generating OpenAI response for user {user_id} with message: {user_text}")
+    logger.debug("Generating OpenAI response", extra={'user_id': user_id, 'text': user_text})
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o-mini",  # You can also use "gpt-4 or gpt-4o or gpt-4o-mini"
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
-                {"role": "user", "content": user_text}
-            ],
-            max_tokens=5000,  # for longer stories.
-            temperature=0.7,
-        )
+        client = await providers.load('openai')
+        async with concurrency.limit('openai'):
+            response = await client.chat.completions.create(
+                model=OPENAI_MODEL,
+                messages=openai_messages(user_text, history),
+                max_tokens=5000,  # for longer stories.
+                temperature=0.7,
+            )
         # Extract and return the assistant's reply
         assistant_reply = response.choices[0].message.content.strip()
-        logger.debug(f"OpenAI response for user {user_id}: {assistant_reply}")
+        logger.debug("OpenAI response", extra={'user_id': user_id, 'reply': assistant_reply})
         return assistant_reply
     except Exception as e:
         logger.exception(f"Error communicating with OpenAI API for user {user_id}: {e}")
-        return "Sorry, I couldn't process that."
+        return OPENAI_ERROR_REPLY
+
+async def stream_replicate_response(user_id: int, user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT):
+    """Yield the Replicate response text as it is generated. Raises on failure."""
+    logger.debug("Streaming Replicate response", extra={'user_id': user_id, 'text': user_text})
+    client = await providers.load('replicate')
+    async with concurrency.limit('replicate'):
+        async for event in await client.async_stream(REPLICATE_MODEL, input=replicate_input(user_text, history)):
+            text = str(event)  # Empty for non-output events
+            if text:
+                yield text
+
+async def stream_openai_response(user_id: int, user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT):
+    """Yield the OpenAI response text as it is generated. Raises on failure."""
+    logger.debug("Streaming OpenAI response", extra={'user_id': user_id, 'text': user_text})
+    client = await providers.load('openai')
+    async with concurrency.limit('openai'):
+        stream = await client.chat.completions.create(
+            model=OPENAI_MODEL,
+            messages=openai_messages(user_text, history),
+            max_tokens=5000,  # for longer stories.
+            temperature=0.7,
+            stream=True,
+        )
+        async with stream:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+async def _openai_reply(user_id: int, user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT) -> str:
+    response_text = await generate_openai_response(user_id, user_text, history)
+    return None if response_text == OPENAI_ERROR_REPLY else response_text
+
+# Replicate is preferred while healthy. The full-reply and streaming backends share a
+# circuit breaker per provider, so an outage seen on either path trips both.
+REPLICATE_BREAKER = backends.CircuitBreaker(failure_threshold=5, reset_timeout=30.0)
+OPENAI_BREAKER = backends.CircuitBreaker(failure_threshold=5, reset_timeout=30.0)
+LLM_ROUTER = backends.BackendRouter(
+    [
+        backends.Backend("replicate", generate_replicate_response, timeout=REPLICATE_TIMEOUT, breaker=REPLICATE_BREAKER),
+        backends.Backend("openai", _openai_reply, timeout=OPENAI_TIMEOUT, breaker=OPENAI_BREAKER),
+    ],
+    HEDGE_POLICY,
+    max_error_rate=0.5,
+)
+LLM_STREAM_ROUTER = backends.BackendRouter(
+    [
+        backends.Backend(
+            "replicate-stream",
+            stream_replicate_response,
+            timeout=REPLICATE_TIMEOUT,
+            breaker=REPLICATE_BREAKER,
+        ),
+        backends.Backend(
+            "openai-stream",
+            stream_openai_response,
+            timeout=OPENAI_TIMEOUT,
+            breaker=OPENAI_BREAKER,
+        ),
+    ],
+    HEDGE_POLICY,
+    max_error_rate=0.5,
+)
 
-def text_to_speech_stream(text: str) -> BytesIO:
+def llm_stats() -> dict:
+    """Backend health, circuit states, routing decisions and hedge counters."""
+    return {
+        'full': LLM_ROUTER.stats(),
+        'stream': LLM_STREAM_ROUTER.stats(),
+        'hedging': backends.hedge_stats(),
+    }
+
+async def generate_response(user_id: int, user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT) -> str:
+    """Get a full reply from the healthiest backend, hedged with the next one. Returns None if both fail."""
+    try:
+        return await LLM_ROUTER.call(user_id, user_text, history)
+    except backends.BackendError as e:
+        logger.error(f"No response for user {user_id}: {e}")
+        return None
+
+async def stream_reply(update: Update, user_id: int, user_text: str, history: conversation.Context = conversation.EMPTY_CONTEXT) -> tuple:
     """
-    Converts text to speech using ElevenLabs and returns the audio data as a byte stream.
+    Stream a reply from the healthiest backend, hedged with the next one (see
+    HEDGE_POLICY). Returns (delivered, response_text): delivered is False if no
+    backend produced a reply, and response_text is None unless the reply completed.
     """
+    reply = streaming.StreamingReply(update.message, reply_markup=get_main_menu_keyboard())
     try:
-        # Perform the text-to-speech conversion
-        response = elevenlabs_client.text_to_speech.convert(
-            voice_id="nsQAxyXwUKBvqtEK9MfK",  # Adam pre-made voice
-            optimize_streaming_latency="0",
-            output_format="mp3_22050_32",
-            text=text,
-            model_id="eleven_multilingual_v2",
-            voice_settings=VoiceSettings(
-                stability=0.0,
-                similarity_boost=1.0,
-                style=0.0,
-                use_speaker_boost=True,
-            ),
-        )
+        async for text in LLM_STREAM_ROUTER.stream(user_id, user_text, history):
+            await reply.append(text)
+        response_text = (await reply.finish()).strip()
+        logger.debug("Streamed response", extra={'user_id': user_id, 'reply': response_text})
+        return bool(response_text), response_text or None
+    except Exception as e:
+        logger.exception(f"Error streaming response for user {user_id}: {e}")
+        if reply.started:
+            # The user already has part of the answer; finish what was sent
+            try:
+                await reply.finish()
+            except Exception as e:
+                logger.exception(f"Error finishing partial streamed response for user {user_id}: {e}")
+            return True, None
+        return False, None
 
-        # Create a BytesIO object to hold audio data
-        audio_stream = BytesIO()
+async def text_to_speech_stream(text: str) -> audio.AudioSpool:
+    """
+    Converts text to speech using ElevenLabs and returns the audio in a spool that
+    keeps only a bounded amount in memory.
+    """
+    audio_stream = audio.AudioSpool(ELEVENLABS_AUDIO_EXTENSION)
+    try:
+        client = await providers.load('elevenlabs')
+        from elevenlabs import VoiceSettings  # Already imported by the client
+        async with concurrency.limit('elevenlabs'):
+            # Perform the text-to-speech conversion
+            response = client.text_to_speech.convert(
+                voice_id=ELEVENLABS_VOICE_ID,
+                optimize_streaming_latency="0",
+                output_format=ELEVENLABS_OUTPUT_FORMAT,
+                text=text,
+                model_id=ELEVENLABS_MODEL_ID,
+                voice_settings=VoiceSettings(**ELEVENLABS_VOICE_SETTINGS),
+            )
 
-        # Write each chunk of audio data to the stream
-        for chunk in response:
-            if chunk:
-                audio_stream.write(chunk)
+            # Write each chunk of audio data to the spool as it arrives
+            async for chunk in response:
+                if chunk:
+                    audio_stream.write(chunk)
 
         # Reset stream position to the beginning
         audio_stream.seek(0)
@@ -253,53 +445,76 @@ def text_to_speech_stream(text: str) -> BytesIO:
         return audio_stream
     except Exception as e:
         logger.exception(f"Error in text_to_speech_stream: {e}")
+        audio_stream.close()
         return None
 
+async def send_unspoken_text(update: Update, user_id: int, segments: list) -> None:
+    """Send the part of a reply that could not be spoken as text, so the user still gets all of it."""
+    logger.warning(f"Audio failed for user {user_id}; sending the remaining {len(segments)} segment(s) as text.")
+    remainder = ' '.join(segments)
+    for i in range(0, len(remainder), 4000):
+        await outbound.reply_text(update.message, remainder[i:i+4000], reply_markup=get_main_menu_keyboard())
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle incoming messages and respond via Replicate or OpenAI ChatCompletion API."""
     try:
         user_text = update.message.text
         user_id = update.effective_user.id
-        logger.debug(f"Received message from user {user_id}: {user_text}")
-
-        user = database.get_user(user_id)
-        logger.debug(f"User data: {user}")
+        logger.debug("Received message", extra={'user_id': user_id, 'text': user_text})
+
+        # Use a free interaction or consume Indecent Credits in a single atomic database call
+        charge = await user_cache.charge_interaction(user_id, FREE_INTERACTIONS, CREDIT_COST_PER_INTERACTION)
+        logger.debug("Charge result", extra={'user_id': user_id, 'charged': charge['charged'], 'free': charge['free'],
+                                             'credits': charge['indecent_credits']})
+
+        if not charge['charged']:
+            # User has no Indecent Credits left, prompt to buy more
+            await outbound.reply_text(
+                update.message,
+                "You have used all your free interactions and no Indecent Credits left. Please purchase more Indecent Credits to continue."
+            )
+            logger.debug("No Indecent Credits left, prompted to buy credits", extra={'user_id': user_id})
+            return
 
-        # Check if user has free interactions left
-        if user['free_interactions_used'] < FREE_INTERACTIONS:
-            # Increment free interactions used
-            database.increment_free_interactions(user_id)
-            logger.debug(f"User {user_id} has free interactions remaining.")
+        if charge['free']:
+            logger.debug("Used a free interaction", extra={'user_id': user_id})
         else:
-            # Check if user has enough Indecent Credits
-            if user['indecent_credits'] >= CREDIT_COST_PER_INTERACTION:
-                # Consume Indecent Credits
-                success = database.consume_credit(user_id)
-                if not success:
-                    await update.message.reply_text("An error occurred while consuming an Indecent Credit. Please try again.", reply_markup=get_main_menu_keyboard())
-                    return
-                logger.debug(f"User {user_id} consumed {CREDIT_COST_PER_INTERACTION} Indecent Credit(s). Remaining credits: {user['indecent_credits'] - CREDIT_COST_PER_INTERACTION}")
-            else:
-                # User has no Indecent Credits left, prompt to buy more
-                await update.message.reply_text(
-                    "You have used all your free interactions and no Indecent Credits left. Please purchase more Indecent Credits to continue."
-                )
-                logger.debug(f"User {user_id} has no Indecent Credits left. Prompted to buy credits.")
-                return
-
-        # Try generating response from Replicate
-        response_text = await asyncio.get_event_loop().run_in_executor(None, generate_replicate_response, user_id, user_text)
-
-        # If Replicate failed (response_text is None), try OpenAI
-        if not response_text:
-            logger.debug(f"Replicate failed for user {user_id}, falling back to OpenAI.")
-            response_text = await asyncio.get_event_loop().run_in_executor(None, generate_openai_response, user_id, user_text)
-
-        # If both Replicate and OpenAI failed
-        if response_text == "Sorry, I couldn't process that." or not response_text:
-            await update.message.reply_text(response_text, reply_markup=get_main_menu_keyboard())
-            logger.debug(f"Both Replicate and OpenAI failed for user {user_id}. Sent error message.")
+            logger.debug("Consumed Indecent Credits", extra={'user_id': user_id, 'cost': CREDIT_COST_PER_INTERACTION})
+
+        # Earlier turns that fit the prompt budget (sized for the longer system prompt)
+        history = await conversation.build_context(user_id, user_text, REPLICATE_SYSTEM_PROMPT)
+
+        # Repeated opening prompts are answered from the response cache without calling an LLM.
+        # Only fresh conversations are cached: with history in the key a later message
+        # practically never repeats, so looking it up would only cost a database read
+        cacheable = history.fingerprint is None
+        cache_key_parts = (RESPONSE_CACHE_MODEL, RESPONSE_CACHE_SYSTEM_PROMPT, dict(RESPONSE_CACHE_PARAMS, history=None))
+        response_text = await response_cache.get(user_text, *cache_key_parts) if cacheable else None
+        if response_text:
+            logger.debug("Response cache hit", extra={'user_id': user_id})
+        elif STREAM_RESPONSES and not context.user_data.get('audio_enabled', False):
+            # Stream text replies so the user sees the first tokens right away
+            delivered, response_text = await stream_reply(update, user_id, user_text, history)
+            if not delivered:
+                await outbound.reply_text(update.message, OPENAI_ERROR_REPLY, reply_markup=get_main_menu_keyboard())
+                logger.debug("Both Replicate and OpenAI failed, sent error message", extra={'user_id': user_id})
+            elif response_text:
+                if cacheable:
+                    await response_cache.put(user_text, *cache_key_parts, response_text)
+                await conversation.record(user_id, user_text, response_text)
             return
+        else:
+            # Generate response from Replicate, hedged with OpenAI
+            response_text = await generate_response(user_id, user_text, history)
+
+            # If both Replicate and OpenAI failed
+            if not response_text:
+                await outbound.reply_text(update.message, OPENAI_ERROR_REPLY, reply_markup=get_main_menu_keyboard())
+                logger.debug("Both Replicate and OpenAI failed, sent error message", extra={'user_id': user_id})
+                return
+            if cacheable:
+                await response_cache.put(user_text, *cache_key_parts, response_text)
+        await conversation.record(user_id, user_text, response_text)
 
         # Split the response into chunks to adhere to Telegram's message limits (4096 characters)
         message_chunks = [response_text[i:i+4000] for i in range(0, len(response_text), 4000)]
@@ -307,30 +522,35 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Check if user has enabled audio responses
         if context.user_data.get('audio_enabled', False):
             try:
-                # Use ElevenLabs for text-to-speech
-                audio_bytes = text_to_speech_stream(response_text)
-                if audio_bytes is None:
-                    raise Exception("Failed to generate audio stream.")
-
-                # Send the audio
-                await update.message.reply_voice(voice=audio_bytes)
-                logger.debug(f"Sent audio response to user {user_id} using ElevenLabs.")
+                # Speak the reply with ElevenLabs a few sentences at a time, so the first
+                # voice message arrives quickly; segments sent before come from the TTS cache
+                unsent = await tts_pipeline.send_speech(
+                    update.message,
+                    response_text,
+                    lambda segment: tts_cache.cache_key(segment, ELEVENLABS_VOICE_ID, ELEVENLABS_MODEL_ID, ELEVENLABS_VOICE_SETTINGS, ELEVENLABS_OUTPUT_FORMAT),
+                    text_to_speech_stream,
+                    ELEVENLABS_AUDIO_EXTENSION,
+                )
+                if unsent:
+                    await send_unspoken_text(update, user_id, unsent)
+                else:
+                    logger.debug("Sent audio response using ElevenLabs", extra={'user_id': user_id})
             except Exception as e:
                 logger.exception(f"Error generating or sending audio response to user {user_id}: {e}")
-                await update.message.reply_text("Sorry, I couldn't generate an audio response.", reply_markup=get_main_menu_keyboard())
+                await outbound.reply_text(update.message, "Sorry, I couldn't generate an audio response.", reply_markup=get_main_menu_keyboard())
         else:
             for chunk in message_chunks:
-                await update.message.reply_text(chunk, reply_markup=get_main_menu_keyboard())
-                logger.debug(f"Sent text response chunk to user {user_id}.")
+                await outbound.reply_text(update.message, chunk, reply_markup=get_main_menu_keyboard())
+                logger.debug("Sent text response chunk", extra={'user_id': user_id, 'chars': len(chunk)})
     except Exception as e:
         logger.exception(f"Error in handle_message handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while processing your message.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while processing your message.", reply_markup=get_main_menu_keyboard())
 
 async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Initiate the purchase process for additional Indecent Credits by presenting credit packages directly."""
     try:
         user_id = update.effective_user.id
-        logger.debug(f"User {user_id} initiated purchase.")
+        logger.debug("Initiated purchase", extra={'user_id': user_id})
 
         # Define Indecent Credit packages without referencing currency
         credit_packages = {
@@ -348,14 +568,14 @@ async def buy(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
             [InlineKeyboardButton("💰 1000 Indecent Credits", callback_data='purchase_1000_credits')],
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await update.message.reply_text(
+        await outbound.reply_text(update.message,
             "Select the number of Indecent Credits you want to purchase:",
             reply_markup=reply_markup
         )
-        logger.debug(f"User {user_id} presented with credit package options.")
+        logger.debug("Presented credit package options", extra={'user_id': user_id})
     except Exception as e:
         logger.exception(f"Error in buy handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while initiating the purchase.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while initiating the purchase.", reply_markup=get_main_menu_keyboard())
 
 async def process_purchase_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Process the purchase button and simulate the purchase."""
@@ -376,17 +596,17 @@ async def process_purchase_button(update: Update, context: ContextTypes.DEFAULT_
         elif data == 'purchase_1000_credits':
             credits = 1000
         else:
-            await query.edit_message_text(text="Invalid selection.")
+            await outbound.edit_query_text(query, "Invalid selection.")
             logger.warning(f"User {user_id} made an invalid purchase selection: {data}")
             return
 
         # Simulate successful purchase
-        database.add_credits(user_id, credits)
-        await query.edit_message_text(text=f"Thank you for your purchase! You have been credited with {credits} Indecent Credits.", reply_markup=get_main_menu_keyboard())
-        logger.debug(f"User {user_id} purchased {credits} Indecent Credits.")
+        await user_cache.add_credits(user_id, credits)
+        await outbound.edit_query_text(query, f"Thank you for your purchase! You have been credited with {credits} Indecent Credits.", reply_markup=get_main_menu_keyboard())
+        logger.debug("Purchased Indecent Credits", extra={'user_id': user_id, 'credits': credits})
     except Exception as e:
         logger.exception(f"Error in process_purchase_button handler: {e}")
-        await update.callback_query.message.reply_text("An unexpected error occurred. Please try again later.")
+        await outbound.reply_text(update.callback_query.message, "An unexpected error occurred. Please try again later.")
 
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Answer the PreCheckoutQuery."""
@@ -402,19 +622,51 @@ async def reset_interactions(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Reset the user's free interactions used."""
     try:
         user_id = update.effective_user.id
-        database.update_user(user_id, free_interactions_used=0)
-        await update.message.reply_text("Your free interactions have been reset to 10.", reply_markup=get_main_menu_keyboard())
-        logger.debug(f"Reset free interactions for user {user_id}.")
+        await user_cache.update_user(user_id, free_interactions_used=0)
+        await outbound.reply_text(update.message, "Your free interactions have been reset to 10.", reply_markup=get_main_menu_keyboard())
+        logger.debug("Reset free interactions", extra={'user_id': user_id})
     except Exception as e:
         logger.exception(f"Error in reset_interactions handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while resetting your interactions.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while resetting your interactions.", reply_markup=get_main_menu_keyboard())
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Record a sampling profile of the live bot: /profile [seconds]. Admins only."""
+    try:
+        user_id = update.effective_user.id
+        if user_id not in ADMIN_USER_IDS:
+            logger.warning(f"User {user_id} tried to use /profile without admin rights.")
+            return
+        try:
+            seconds = float(context.args[0]) if context.args else PROFILE_SECONDS
+        except ValueError:
+            await outbound.reply_text(update.message, "Usage: /profile [seconds]")
+            return
+        if profiler.active():
+            await outbound.reply_text(update.message, "A profile is already running.")
+            return
+        seconds = min(seconds, profiler.MAX_SECONDS)
+        await outbound.reply_text(update.message, f"Profiling for {seconds:.0f} seconds...")
+        # Recorded in the background, so this update doesn't hold a running slot meanwhile
+        context.application.create_task(send_profile(update.message, seconds))
+        logger.info("Started a profile", extra={'user_id': user_id, 'seconds': seconds})
+    except Exception as e:
+        logger.exception(f"Error in profile_command handler for user {update.effective_user.id}: {e}")
+
+async def send_profile(message, seconds: float) -> None:
+    """Record a profile and reply with its summary."""
+    try:
+        summary = await profiler.profile(seconds)
+        await outbound.reply_text(message, profiler.format_summary(summary))
+    except Exception as e:
+        logger.exception(f"Error recording a profile: {e}")
+        await outbound.reply_text(message, f"Profiling failed: {e}")
 
 async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle menu button presses."""
     try:
         user_text = update.message.text
         user_id = update.effective_user.id
-        logger.debug(f"Received menu button press from user {user_id}: {user_text}")
+        logger.debug("Received menu button press", extra={'user_id': user_id, 'text': user_text})
 
         if user_text == '🏠 Home':
             await start(update, context)
@@ -430,11 +682,11 @@ async def menu_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             await toggle_audio(update, context)
         else:
             # Handle unexpected inputs
-            await update.message.reply_text("Please choose an option from the menu below.", reply_markup=get_main_menu_keyboard())
-            logger.debug(f"User {user_id} sent an unexpected input: {user_text}")
+            await outbound.reply_text(update.message, "Please choose an option from the menu below.", reply_markup=get_main_menu_keyboard())
+            logger.debug("Unexpected input", extra={'user_id': user_id, 'text': user_text})
     except Exception as e:
         logger.exception(f"Error in menu_handler for user {update.effective_user.id}: {e}")
-        await update.message.reply_text("An unexpected error occurred while processing your menu selection.", reply_markup=get_main_menu_keyboard())
+        await outbound.reply_text(update.message, "An unexpected error occurred while processing your menu selection.", reply_markup=get_main_menu_keyboard())
 
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle all exceptions."""
@@ -443,15 +695,109 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     # Notify the user about the error
     if isinstance(update, Update) and update.effective_message:
         try:
-            await update.effective_message.reply_text(
+            await outbound.reply_text(update.effective_message,
                 "An unexpected error occurred. Please try again later."
             )
         except Exception as e:
             logger.exception(f"Failed to send error message to user: {e}")
 
-def main() -> None:
-    """Start the bot."""
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build()
+def _openai_client():
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=OPENAI_API_KEY, http_client=http_pool.client('openai'))  # Async, so requests never block the event loop
+
+def _elevenlabs_client():
+    from elevenlabs.client import AsyncElevenLabs
+    return AsyncElevenLabs(api_key=ELEVENLABS_API_KEY, base_url=ELEVENLABS_BASE_URL,
+                           httpx_client=http_pool.client('elevenlabs', follow_redirects=True))
+
+def _replicate_client():
+    import replicate
+    # REPLICATE_BASE_URL is read from the environment
+    return replicate.Client(api_token=REPLICATE_API_TOKEN, timeout=http_pool.timeout(), transport=http_pool.transport('replicate'))
+
+_configured = False
+
+def configure() -> None:
+    """
+    Set up logging, check the API keys, register the provider clients and
+    prepare the database. Importing this module does none of this, so it can be
+    imported without keys; main() and build_application() call it first.
+    """
+    global _configured
+    if _configured:
+        return
+    log_pipeline.configure(
+        level=LOG_LEVEL,
+        levels=log_pipeline.parse_levels(LOG_LEVELS),
+        sample_rates=log_pipeline.parse_rates(LOG_SAMPLE_RATES),
+        json_format=LOG_FORMAT == 'json',
+    )
+
+    # Check if API keys are set
+    for name, value in (
+        ('TELEGRAM_BOT_TOKEN', TELEGRAM_BOT_TOKEN),
+        ('OPENAI_API_KEY', OPENAI_API_KEY),
+        ('ELEVENLABS_API_KEY', ELEVENLABS_API_KEY),
+        ('REPLICATE_API_TOKEN', REPLICATE_API_TOKEN),
+    ):
+        if not value:
+            logger.error(f"{name} is not set.")
+            exit(1)
+
+    providers.register('openai', _openai_client)
+    providers.register('elevenlabs', _elevenlabs_client)
+    providers.register('replicate', _replicate_client)
+
+    # Initialize the database
+    database.initialize_database()
+    ledger.configure(reconcile_interval=LEDGER_RECONCILE_INTERVAL)
+    _configured = True
+
+async def post_init(application) -> None:
+    """Start write-back of cached balances, ledger checks, the metrics endpoint and the profiler socket."""
+    await user_cache.start(application)
+    await ledger.start(application)
+    if PRELOAD_PROVIDERS:
+        providers.start_preload()
+    if METRICS_PORT:
+        try:
+            await metrics.start_server(METRICS_HOST, METRICS_PORT)
+        except OSError as e:
+            logger.error(f"Metrics endpoint not started on {METRICS_HOST}:{METRICS_PORT}: {e}")
+    if PROFILER_SOCKET:
+        try:
+            await profiler.start_control_socket(PROFILER_SOCKET)
+        except OSError as e:
+            logger.error(f"Profiler control socket not started at {PROFILER_SOCKET}: {e}")
+
+async def post_shutdown(application) -> None:
+    """Let queued replies go out, then flush cached balances."""
+    await providers.stop_preload()
+    await outbound.stop(application)
+    await user_cache.stop(application)
+    await ledger.stop(application)
+    await metrics.stop_server()
+    profiler.stop()
+    await profiler.stop_control_socket()
+    logger.info("Outbound queue stats", extra=outbound.stats())
+    logger.info("HTTP pool stats", extra={'pools': http_pool.stats()})
+    await http_pool.close()
+
+def build_application():
+    """Build the Application with all handlers registered."""
+    configure()
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .base_url(TELEGRAM_API_BASE_URL)
+        .request(http_pool.TelegramRequest('telegram'))  # Keep-alive pool shared by all Bot API calls
+        .get_updates_request(http_pool.TelegramRequest('telegram_updates', connection_pool_size=1))
+        .concurrent_updates(update_processing.PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .persistence(persistence.SQLitePersistence())  # Keep user settings such as the audio toggle across restarts
+        .post_init(post_init)              # Start write-back of cached balances and the metrics endpoint
+        .post_shutdown(post_shutdown)      # Send queued replies and flush cached balances before exit
+        .build()
+    )
 
     # Define menu options regex filter
     menu_filter = filters.Regex(f"^({'|'.join(MENU_OPTIONS)})$")
@@ -463,6 +809,7 @@ def main() -> None:
     application.add_handler(CommandHandler("buy", buy))
     application.add_handler(CommandHandler("balance", balance))
     application.add_handler(CommandHandler("reset", reset_interactions))  # Optional command
+    application.add_handler(CommandHandler("profile", profile_command))  # Admins only, see ADMIN_USER_IDS
 
     # Register message handlers
     application.add_handler(MessageHandler(menu_filter, menu_handler))  # Handle menu button presses
@@ -476,9 +823,35 @@ def main() -> None:
     # Register the error handler
     application.add_error_handler(error_handler)
 
-    # Start the Bot
-    logger.info("Bot is starting...")
-    application.run_polling()
+    return application
+
+def release_resources() -> None:
+    """Let pending database writes finish and stop the provider executors."""
+    async_database.shutdown()
+    concurrency.shutdown()
+    logger.info("LLM backend stats", extra={'backends': llm_stats()})
+    logger.info("Provider init seconds", extra={'providers': providers.stats()})
+
+def main() -> None:
+    """Start the bot."""
+    configure()
+    logger.info("Bot is starting", extra={'mode': BOT_MODE})
+    if BOT_MODE == 'webhook':
+        if not WEBHOOK_SECRET_TOKEN:
+            logger.warning("WEBHOOK_SECRET_TOKEN is not set; anyone who finds the webhook URL can post updates.")
+        webhook.run(
+            build_application,
+            url=WEBHOOK_URL,
+            secret_token=WEBHOOK_SECRET_TOKEN,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            workers=WEBHOOK_WORKERS,
+            ready_check=async_database.ping,
+            cleanup=release_resources,
+        )
+        return
+    build_application().run_polling()
+    release_resources()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,184 @@
+# tts_cache.py
+#
+# Cache of synthesized speech. Audio is stored on disk under a content-
+# addressed path derived from everything that determines it (text, voice,
+# model, voice settings, output format), and the Telegram file_id returned by
+# reply_voice is remembered so a repeat is sent by reference: no synthesis and
+# no upload.
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from telegram.error import BadRequest
+
+import async_database
+import concurrency
+import metrics
+import outbound
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = 'tts_cache'
+MAX_BYTES = 500 * 1024 * 1024  # Audio kept on disk; file_ids are kept regardless
+EVICT_EVERY = 50               # Run eviction after this many new files
+
+_stats = {'file_id_hits': 0, 'disk_hits': 0, 'misses': 0, 'stale_file_ids': 0}
+_files_since_eviction = 0
+
+SYNTHESIS_SECONDS = metrics.histogram('bot_tts_synthesis_seconds', 'Seconds spent synthesizing speech.', ('outcome',))
+AUDIO_SEND_SECONDS = metrics.histogram(
+    'bot_audio_send_seconds', 'Seconds to send a voice reply, by reference (file_id) or as an upload.', ('mode',))
+TTS_LOOKUPS = metrics.counter('bot_tts_cache_total', 'TTS audio sources: file_id, disk or synthesized.', ('source',))
+
+def cache_key(text, voice_id, model_id, voice_settings, output_format):
+    """Hash of every input that affects the synthesized audio."""
+    material = json.dumps([text, voice_id, model_id, voice_settings, output_format], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(material.encode('utf-8')).hexdigest()
+
+def _path_for(key, extension):
+    # Two directory levels keep any one directory small
+    return os.path.join(CACHE_DIR, key[:2], key[2:4], f"{key}.{extension}")
+
+def _write_file(path, audio):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # A unique name, so workers caching the same segment at once don't write into one file
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        audio.seek(0)
+        with open(fd, 'wb') as f:
+            shutil.copyfileobj(audio, f)
+            size = f.tell()
+        os.replace(temp_path, path)  # Readers never see a partial file
+    except BaseException:
+        _remove_files([temp_path])
+        raise
+    return size
+
+def _open_file(path):
+    return open(path, 'rb')
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+async def _store_audio(key, extension, audio):
+    global _files_since_eviction
+    path = _path_for(key, extension)
+    size = await concurrency.run_blocking('disk', _write_file, path, audio)
+    await async_database.store_tts_entry(key, path=path, size=size, now=time.time())
+    _files_since_eviction += 1
+    if _files_since_eviction >= EVICT_EVERY:
+        _files_since_eviction = 0
+        paths = await async_database.evict_tts_files(MAX_BYTES)
+        if paths:
+            await concurrency.run_blocking('disk', _remove_files, paths)
+
+def _file_id(message):
+    attachment = message.voice or message.audio or message.document
+    return attachment.file_id if attachment else None
+
+async def _load_audio(key, path, synthesize, extension):
+    # Audio from disk if it is there, otherwise synthesized and cached
+    if path:
+        try:
+            audio = await concurrency.run_blocking('disk', _open_file, path)
+            _stats['disk_hits'] += 1
+            TTS_LOOKUPS.labels('disk').inc()
+            return audio
+        except OSError as e:
+            logger.warning(f"Cached TTS file {path} unreadable, synthesizing again: {e}")
+    _stats['misses'] += 1
+    TTS_LOOKUPS.labels('synthesized').inc()
+    start = time.perf_counter()
+    try:
+        audio = await synthesize()
+    except Exception:
+        SYNTHESIS_SECONDS.labels('error').observe(time.perf_counter() - start)
+        raise
+    SYNTHESIS_SECONDS.labels('success' if audio is not None else 'error').observe(time.perf_counter() - start)
+    if audio is None:
+        return None
+    try:
+        await _store_audio(key, extension, audio)
+    except Exception as e:
+        logger.exception(f"Failed to cache TTS audio: {e}")
+    audio.seek(0)
+    return audio
+
+async def prepare(key, synthesize, extension='mp3'):
+    """
+    Get everything needed to send the audio for `key` without sending it: the
+    remembered Telegram file_id if there is one, otherwise the audio from disk
+    or from the async `synthesize()` (which returns a file-like object such as
+    an audio.AudioSpool, or None on failure). Returns a (file_id, path, audio)
+    tuple for send_prepared(), which closes the audio.
+    """
+    entry = await async_database.get_tts_entry(key, time.time())
+    path, file_id = entry if entry else (None, None)
+    if file_id:
+        return file_id, path, None
+    return None, path, await _load_audio(key, path, synthesize, extension)
+
+async def send_prepared(message, key, prepared, synthesize, extension='mp3'):
+    """
+    Reply to `message` with audio from prepare(). Returns the sent message, or
+    None if synthesis failed.
+    """
+    file_id, path, audio = prepared
+    if file_id:
+        try:
+            with AUDIO_SEND_SECONDS.labels('file_id').time():
+                sent = await outbound.reply_voice(message, file_id)
+            _stats['file_id_hits'] += 1
+            TTS_LOOKUPS.labels('file_id').inc()
+            return sent
+        except BadRequest as e:
+            # Telegram forgot the file; fall back to uploading it again
+            logger.warning(f"Cached TTS file_id rejected, re-uploading: {e}")
+            _stats['stale_file_ids'] += 1
+            await async_database.forget_tts_file_id(key)
+            audio = await _load_audio(key, path, synthesize, extension)
+    if audio is None:
+        return None
+
+    try:
+        with AUDIO_SEND_SECONDS.labels('upload').time():
+            sent = await outbound.reply_voice(message, audio)
+    finally:
+        audio.close()
+    file_id = _file_id(sent)
+    if file_id:
+        try:
+            await async_database.store_tts_entry(key, file_id=file_id, now=time.time())
+        except Exception as e:
+            logger.exception(f"Failed to remember TTS file_id: {e}")
+    return sent
+
+def discard(prepared):
+    """Release the audio of a prepare() result that will not be sent."""
+    audio = prepared[2]
+    if audio is not None:
+        audio.close()
+
+async def send_voice(message, key, synthesize, extension='mp3'):
+    """
+    Reply to `message` with the audio for `key`. Uses the remembered Telegram
+    file_id if there is one, then the file on disk, and only calls
+    `synthesize()` on a full miss. Returns the sent message, or None if
+    synthesis failed.
+    """
+    prepared = await prepare(key, synthesize, extension)
+    return await send_prepared(message, key, prepared, synthesize, extension)
+
+def stats():
+    """TTS cache counters: sends by file_id, from disk, and fresh syntheses."""
+    sends = _stats['file_id_hits'] + _stats['disk_hits'] + _stats['misses']
+    return dict(_stats, hit_rate=(_stats['file_id_hits'] + _stats['disk_hits']) / sends if sends else 0.0)
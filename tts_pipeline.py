@@ -0,0 +1,109 @@
+# tts_pipeline.py
+#
+# Speaks a long reply as a series of voice messages. The text is split at
+# sentence boundaries into size-bounded segments; a few segments are
+# synthesized ahead concurrently (each still within its provider's limit in
+# concurrency.py) while finished ones are sent in order, so the first voice
+# message arrives after one short segment instead of after the whole reply.
+# Audio is spooled (see audio.py), so memory per request is bounded by
+# MAX_AHEAD segments however long the reply is.
+
+import asyncio
+import logging
+import re
+import textwrap
+from collections import deque
+
+import audio
+import tts_cache
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_MAX_CHARS = 500        # Longest segment sent to the TTS provider
+FIRST_SEGMENT_MAX_CHARS = 200  # Keep the first segment short so audio starts sooner
+MAX_AHEAD = 3                  # Segments synthesized ahead of the one being sent
+
+# Whitespace after sentence-ending punctuation (optionally followed by a
+# closing quote or bracket), or a line break
+_sentence_break = re.compile(r'(?<=[.!?…])\s+|(?<=[.!?…]["\'”’)\]])\s+|\s*\n\s*')
+
+def _pieces(text, max_chars):
+    # Sentences, with any sentence longer than max_chars wrapped at word boundaries
+    for sentence in _sentence_break.split(text):
+        sentence = sentence.strip()
+        if len(sentence) > max_chars:
+            yield from textwrap.wrap(sentence, max_chars)
+        elif sentence:
+            yield sentence
+
+def split_segments(text, max_chars=SEGMENT_MAX_CHARS, first_max_chars=FIRST_SEGMENT_MAX_CHARS):
+    """Split text into segments of whole sentences, each at most max_chars long."""
+    segments = []
+    current = ''
+    for piece in _pieces(text, max_chars):
+        segment_limit = max_chars if segments else first_max_chars
+        if current and len(current) + 1 + len(piece) > segment_limit:
+            segments.append(current)
+            current = piece
+        else:
+            current = f"{current} {piece}" if current else piece
+    if current:
+        segments.append(current)
+    return segments
+
+async def send_speech(message, text, key_for, synthesize, extension='mp3'):
+    """
+    Reply to `message` with `text` spoken as one voice message per segment.
+    `key_for(segment)` returns the segment's tts_cache key and the async
+    `synthesize(segment)` returns its audio as a file-like object such as an
+    audio.AudioSpool, or None on failure (see tts_cache.prepare()).
+
+    Returns the segments that were not sent (empty on success). Sending stops
+    at the first segment that fails to synthesize, returns None or raises, so
+    the audio never skips ahead.
+    """
+    segments = split_segments(text)
+    pending = deque()
+    next_index = 0
+
+    def fill():
+        nonlocal next_index
+        while len(pending) < MAX_AHEAD and next_index < len(segments):
+            segment = segments[next_index]
+            key = key_for(segment)
+            synthesize_segment = lambda segment=segment: synthesize(segment)
+            task = asyncio.create_task(tts_cache.prepare(key, synthesize_segment, extension))
+            pending.append((key, synthesize_segment, task))
+            next_index += 1
+
+    sent_count = 0
+    with audio.metered() as meter:
+        fill()
+        try:
+            while pending:
+                key, synthesize_segment, task = pending.popleft()
+                try:
+                    prepared = await task
+                except Exception as e:
+                    # The caller gets this and the later segments back, to send as text
+                    logger.exception(f"Failed to prepare speech segment {sent_count + 1} of {len(segments)}: {e}")
+                    break
+                fill()  # Keep synthesizing ahead while this segment uploads
+                sent = await tts_cache.send_prepared(message, key, prepared, synthesize_segment, extension)
+                if sent is None:
+                    break
+                sent_count += 1
+        finally:
+            for _, _, task in pending:
+                task.cancel()
+                task.add_done_callback(_discard_result)
+
+    logger.debug("Sent speech segments", extra={'sent': sent_count, 'segments': len(segments), 'peak_audio_kib': meter.peak // 1024})
+    if sent_count < len(segments):
+        logger.warning(f"Sent {sent_count} of {len(segments)} speech segments.")
+    return segments[sent_count:]
+
+def _discard_result(task):
+    # Segments that were prepared but will not be sent; cancel() may have come too late
+    if not task.cancelled() and task.exception() is None:
+        tts_cache.discard(task.result())
@@ -0,0 +1,111 @@
+# update_processing.py
+#
+# Update processor that lets PTB handle updates from different users
+# concurrently while each user's updates still run one at a time, in the order
+# they arrived, so a user's balance changes and replies never interleave.
+
+import asyncio
+import logging
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+import metrics
+import profiler
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_UPDATES = 64  # Updates running handlers at once
+PENDING_FACTOR = 16          # Updates accepted per running slot, counting those queued behind the same user
+
+UPDATE_SECONDS = metrics.histogram('bot_update_seconds', 'Seconds from accepting an update to finishing it.')
+HANDLER_SECONDS = metrics.histogram('bot_update_handler_seconds', 'Seconds an update spent running its handlers.')
+
+def _user_key(update):
+    # Serialize by user; updates without one (e.g. polls) are never held back
+    if isinstance(update, Update):
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+    return None
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs at most `max_concurrent_updates` updates at once, and one at a time
+    per user in arrival order.
+    """
+
+    def __init__(self, max_concurrent_updates=MAX_CONCURRENT_UPDATES, max_pending_updates=None):
+        # PTB's own semaphore is taken before do_process_update, so it only bounds
+        # accepted updates. The running cap is applied after the per-user wait,
+        # so one user's backlog cannot hold slots other users need.
+        super().__init__(max_pending_updates or max_concurrent_updates * PENDING_FACTOR)
+        self.running_limit = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._users = {}  # user key -> [lock, updates holding or waiting for it]
+        self.running = 0
+        self.accepted = 0  # Running or waiting
+        self.processed = 0
+        metrics.gauge('bot_updates_running', 'Updates running handlers.', callback=lambda: self.running)
+        metrics.gauge('bot_updates_waiting', 'Accepted updates waiting for their user or a running slot.',
+                      callback=lambda: self.accepted - self.running)
+
+    async def do_process_update(self, update, coroutine):
+        start = time.perf_counter()
+        self.accepted += 1
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self.accepted -= 1
+            UPDATE_SECONDS.observe(time.perf_counter() - start)
+
+    async def _process(self, update, coroutine):
+        key = _user_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        entry = self._users.get(key)
+        if entry is None:
+            entry = self._users[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        task = asyncio.current_task()
+        profiler.tag_task(task, key)
+        try:
+            # asyncio.Lock wakes waiters first in, first out, so arrival order holds
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            profiler.untag_task(task)
+            entry[1] -= 1
+            if not entry[1]:
+                del self._users[key]
+
+    async def _run(self, coroutine):
+        async with self._running:
+            self.running += 1
+            start = time.perf_counter()
+            try:
+                await coroutine
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - start)
+                self.running -= 1
+                self.processed += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        """Running updates, users with updates in progress, and the total processed."""
+        return {
+            'running': self.running,
+            'running_limit': self.running_limit,
+            'active_users': len(self._users),
+            'waiting_behind_user': sum(waiters - 1 for _, waiters in self._users.values()),
+            'processed': self.processed,
+        }
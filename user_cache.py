@@ -0,0 +1,314 @@
+# user_cache.py
+#
+# In-process cache of user accounts in front of async_database. Balance reads
+# are memory lookups, and charges are decided in memory and written back to
+# SQLite as deltas every FLUSH_INTERVAL seconds.
+#
+# Crash safety: purchased credits (add_credits, apply_payment) and resets
+# (update_user) are written through immediately. Only charges made in the last
+# flush window can be lost on a crash, and those are always in the user's
+# favour. Balances and the credit ledger in the database change together, so
+# they agree whatever is still pending here.
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import async_database
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Defaults for the shared cache
+MAX_USERS = 10000
+FLUSH_INTERVAL = 1.0  # Seconds between write-back flushes; 0 = write-through
+
+class UserAccount:
+    """A cached users row plus the changes not yet written to the database."""
+
+    __slots__ = ('user_id', 'free_interactions_used', 'indecent_credits', 'pending_free', 'pending_credits')
+
+    def __init__(self, user_id, free_interactions_used, indecent_credits):
+        self.user_id = user_id
+        self.free_interactions_used = free_interactions_used
+        self.indecent_credits = indecent_credits
+        self.pending_free = 0
+        self.pending_credits = 0
+
+    def __getitem__(self, key):
+        # Lets handlers keep using user['indecent_credits'] without a dict per call
+        if key not in ('free_interactions_used', 'indecent_credits'):
+            raise KeyError(key)
+        return getattr(self, key)
+
+    @property
+    def dirty(self):
+        return self.pending_free != 0 or self.pending_credits != 0
+
+    def __repr__(self):
+        return (f"UserAccount(user_id={self.user_id}, free_interactions_used={self.free_interactions_used}, "
+                f"indecent_credits={self.indecent_credits}, pending_free={self.pending_free}, pending_credits={self.pending_credits})")
+
+class UserCache:
+    """LRU cache of UserAccount records with periodic write-back of dirty records."""
+
+    def __init__(self, max_users=MAX_USERS, flush_interval=FLUSH_INTERVAL):
+        self.max_users = max_users
+        self.flush_interval = flush_interval
+        self._accounts = OrderedDict()
+        self._evicted = {}  # Dirty records pushed out of the LRU but not yet flushed
+        self._in_flight = {}  # Records whose deltas are being written; the database doesn't show them yet
+        self._loading = {}  # user_id -> future, so concurrent misses share one query
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+
+    @property
+    def write_back(self):
+        return self.flush_interval > 0
+
+    async def _account(self, user_id):
+        account = self._accounts.get(user_id)
+        if account is not None:
+            self._accounts.move_to_end(user_id)
+            self.hits += 1
+            return account
+
+        self.misses += 1
+        account = self._evicted.pop(user_id, None)
+        if account is None:
+            # Evicted during a flush: reloading now could read the balance from before its deltas
+            account = self._in_flight.get(user_id)
+        if account is None:
+            pending = self._loading.get(user_id)
+            if pending is not None:
+                return await asyncio.shield(pending)
+            pending = asyncio.get_running_loop().create_future()
+            self._loading[user_id] = pending
+            try:
+                row = await async_database.get_user(user_id)
+                account = UserAccount(user_id, row['free_interactions_used'], row['indecent_credits'])
+                pending.set_result(account)
+            except Exception as e:
+                pending.set_exception(e)
+                pending.exception()  # Mark retrieved; the caller gets it via raise
+                raise
+            finally:
+                del self._loading[user_id]
+                if not pending.done():
+                    # This loader was cancelled; concurrent waiters must not hang on it
+                    pending.cancel()
+        self._insert(account)
+        return account
+
+    def _insert(self, account):
+        self._accounts[account.user_id] = account
+        while len(self._accounts) > self.max_users:
+            _, evicted = self._accounts.popitem(last=False)
+            self.evictions += 1
+            if evicted.dirty:
+                self._evicted[evicted.user_id] = evicted
+
+    async def get_user(self, user_id):
+        """Return the user's account; reads are served from memory after the first load."""
+        return await self._account(user_id)
+
+    async def charge_interaction(self, user_id, free_limit, cost):
+        """Charge one interaction. Same result as database.charge_interaction()."""
+        if not self.write_back:
+            result = await async_database.charge_interaction(user_id, free_limit, cost)
+            if self.max_users == 0:
+                return result  # Nothing is cached, so there is no account to update
+            account = self._accounts.get(user_id)
+            if account is None and user_id not in self._loading:
+                # The result carries the whole balance; no need to read it back
+                account = UserAccount(user_id, result['free_interactions_used'], result['indecent_credits'])
+                self._insert(account)
+            else:
+                if account is None:
+                    account = await self._account(user_id)
+                account.free_interactions_used = result['free_interactions_used']
+                account.indecent_credits = result['indecent_credits']
+            return result
+
+        # No await between the check and the debit, so this is atomic on the event loop
+        account = await self._account(user_id)
+        free = account.free_interactions_used < free_limit
+        if free:
+            account.free_interactions_used += 1
+            account.pending_free += 1
+        elif account.indecent_credits >= cost:
+            account.indecent_credits -= cost
+            account.pending_credits -= cost
+        else:
+            return {'charged': False, 'free': False, 'free_interactions_used': account.free_interactions_used,
+                    'indecent_credits': account.indecent_credits}
+        return {'charged': True, 'free': free, 'free_interactions_used': account.free_interactions_used,
+                'indecent_credits': account.indecent_credits}
+
+    async def add_credits(self, user_id, credits_to_add):
+        """Add Indecent Credits. Always written through: purchases must never be lost."""
+        await self._account(user_id)  # Load first so the new credits aren't counted twice
+        await async_database.add_credits(user_id, credits_to_add)
+        # The account may have been evicted and reloaded meanwhile; update the one now cached
+        account = await self._account(user_id)
+        account.indecent_credits += credits_to_add
+
+    async def apply_payment(self, user_id, charge_id, credits):
+        """Credit a purchase once per charge_id. Written through; returns False for a payment already applied."""
+        await self._account(user_id)
+        applied = await async_database.apply_payment(user_id, charge_id, credits)
+        if applied:
+            account = await self._account(user_id)
+            account.indecent_credits += credits
+        return applied
+
+    async def update_user(self, user_id, free_interactions_used=None, indecent_credits=None):
+        """Set absolute values. Written through; overrides any pending change to the same field."""
+        account = await self._account(user_id)
+        # Hold the flush lock so an in-flight delta can't land on top of the new value
+        async with self._flush_lock:
+            await async_database.update_user(user_id, free_interactions_used=free_interactions_used, indecent_credits=indecent_credits)
+        if free_interactions_used is not None:
+            account.free_interactions_used = free_interactions_used
+            account.pending_free = 0
+        if indecent_credits is not None:
+            account.indecent_credits = indecent_credits
+            account.pending_credits = 0
+
+    async def flush(self):
+        """Write every pending change to the database in one transaction."""
+        async with self._flush_lock:
+            dirty = [account for account in self._accounts.values() if account.dirty]
+            dirty.extend(self._evicted.values())
+            if not dirty:
+                return 0
+
+            # Take the deltas now; charges made while the write is in flight start a new batch
+            deltas = [(account.user_id, account.pending_free, account.pending_credits) for account in dirty]
+            for account in dirty:
+                account.pending_free = 0
+                account.pending_credits = 0
+            self._evicted = {}
+            self._in_flight = {account.user_id: account for account in dirty}
+
+            try:
+                await async_database.apply_deltas(deltas)
+            except Exception as e:
+                # Put the deltas back so the next flush retries them, keeping evicted records reachable
+                for account, (_, free_delta, credit_delta) in zip(dirty, deltas):
+                    account.pending_free += free_delta
+                    account.pending_credits += credit_delta
+                    if account.user_id not in self._accounts:
+                        self._evicted[account.user_id] = account
+                logger.exception(f"Failed to flush {len(deltas)} cached user accounts: {e}")
+                raise
+            finally:
+                self._in_flight = {}
+
+            self.flushes += 1
+            logger.debug("Flushed cached user accounts", extra={'accounts': len(deltas)})
+            return len(deltas)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                pass  # Already logged; retried on the next interval
+
+    def start(self):
+        """Start the background write-back task. Must be called from the event loop."""
+        if self.write_back and self._flush_task is None:
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_periodically())
+
+    async def stop(self):
+        """Stop the background task and flush everything that is still pending."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+    def stats(self):
+        """Hit/miss counters and occupancy, for logging or a stats command."""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'size': len(self._accounts),
+            'dirty': sum(1 for account in self._accounts.values() if account.dirty) + len(self._evicted),
+            'evictions': self.evictions,
+            'flushes': self.flushes,
+        }
+
+# Shared cache used by the bots
+_cache = UserCache()
+
+CHARGE_SECONDS = metrics.histogram('bot_charge_seconds', 'Seconds spent charging an interaction.',
+                                   buckets=metrics.FAST_BUCKETS)
+CHARGES = metrics.counter('bot_charges_total', 'Charged interactions by result (free, credit, declined, error).',
+                          ('result',))
+PAYMENTS = metrics.counter('bot_payments_total', 'Successful payments by result (applied, duplicate).', ('result',))
+
+def configure(max_users=MAX_USERS, flush_interval=FLUSH_INTERVAL):
+    """
+    Replace the shared cache; call before start(). When several processes share
+    the database, use max_users=0 and flush_interval=0 so every read and charge
+    goes to the database.
+    """
+    global _cache
+    _cache = UserCache(max_users=max_users, flush_interval=flush_interval)
+
+async def get_user(user_id):
+    """Retrieve a user's account, from memory when cached."""
+    return await _cache.get_user(user_id)
+
+async def charge_interaction(user_id, free_limit, cost):
+    """Charge one interaction. See UserCache.charge_interaction()."""
+    start = time.perf_counter()
+    try:
+        result = await _cache.charge_interaction(user_id, free_limit, cost)
+    except Exception:
+        CHARGES.labels('error').inc()
+        raise
+    finally:
+        CHARGE_SECONDS.observe(time.perf_counter() - start)
+    CHARGES.labels('free' if result['free'] else 'credit' if result['charged'] else 'declined').inc()
+    return result
+
+async def add_credits(user_id, credits_to_add):
+    """Add Indecent Credits to a user's balance."""
+    return await _cache.add_credits(user_id, credits_to_add)
+
+async def apply_payment(user_id, charge_id, credits):
+    """Credit a purchase exactly once. See UserCache.apply_payment()."""
+    applied = await _cache.apply_payment(user_id, charge_id, credits)
+    PAYMENTS.labels('applied' if applied else 'duplicate').inc()
+    return applied
+
+async def update_user(user_id, free_interactions_used=None, indecent_credits=None):
+    """Update user data in the cache and the database."""
+    return await _cache.update_user(user_id, free_interactions_used=free_interactions_used, indecent_credits=indecent_credits)
+
+async def start(application=None):
+    """Start write-back flushing. Usable as an ApplicationBuilder post_init hook."""
+    _cache.start()
+
+async def stop(application=None):
+    """Flush pending writes. Usable as an ApplicationBuilder post_shutdown hook."""
+    await _cache.stop()
+    logger.debug("User cache stopped", extra=_cache.stats())
+
+def stats():
+    """Return the shared cache's counters."""
+    return _cache.stats()
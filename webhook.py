@@ -0,0 +1,283 @@
+# webhook.py
+#
+# Webhook serving mode. Telegram POSTs each update to a small asyncio HTTP
+# server, which checks the secret token and puts the update on the
+# Application's queue, so there is no long-poll delay. GET /healthz reports
+# liveness and GET /readyz readiness (application running and database
+# reachable) for a load balancer.
+#
+# Several worker processes can listen on one port with SO_REUSEPORT. They
+# share the SQLite database, so each worker runs the user cache write-through
+# (every charge is an atomic database update), reloads conversation history and
+# user settings for every message, and takes an equal share of the global
+# outbound send rate.
+
+import asyncio
+import hmac
+import json
+import logging
+import multiprocessing
+import signal
+from http import HTTPStatus
+
+from telegram import Update
+
+import conversation
+import metrics
+import outbound
+import persistence
+import profiler
+import user_cache
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = '/telegram'
+LISTEN = '0.0.0.0'
+PORT = 8443
+MAX_CONNECTIONS = 40          # Concurrent connections Telegram may open to the webhook
+MAX_BODY_BYTES = 1024 * 1024
+MAX_HEADERS = 100
+IDLE_TIMEOUT = 75.0           # Seconds a keep-alive connection may sit idle
+SECRET_TOKEN_HEADER = 'x-telegram-bot-api-secret-token'
+
+class _HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+class WebhookServer:
+    """Minimal HTTP/1.1 server for Telegram webhook deliveries and health checks."""
+
+    def __init__(self, application, path=WEBHOOK_PATH, secret_token=None, listen=LISTEN, port=PORT,
+                 reuse_port=False, ready_check=None):
+        self.application = application
+        self.path = path
+        self.secret_token = secret_token
+        self.listen = listen
+        self.port = port
+        self.reuse_port = reuse_port
+        self.ready_check = ready_check  # Optional coroutine function; raising or False means not ready
+        self.stopping = False
+        self._server = None
+        self.received = 0
+        self.rejected = 0
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._serve_connection, self.listen, self.port, reuse_port=self.reuse_port or None
+        )
+        logger.info("Webhook server listening", extra={'listen': self.listen, 'port': self.port, 'url_path': self.path})
+
+    async def stop(self):
+        """Report not ready, then stop accepting connections."""
+        self.stopping = True
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _serve_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), IDLE_TIMEOUT)
+                except _HTTPError as e:
+                    self._write_response(writer, e.status, b'', keep_alive=False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, payload = await self._route(method, path, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close' and not self.stopping
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _read_request(self, reader):
+        try:
+            line = await reader.readline()
+            if not line:
+                return None
+            method, target, _ = line.decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+                if len(headers) > MAX_HEADERS:
+                    raise _HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            if 'transfer-encoding' in headers:
+                raise _HTTPError(HTTPStatus.LENGTH_REQUIRED)  # Telegram always sends Content-Length
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            # Malformed request line or Content-Length, or a line over the stream limit
+            raise _HTTPError(HTTPStatus.BAD_REQUEST)
+        if length > MAX_BODY_BYTES:
+            raise _HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b''
+        return method, target.split('?', 1)[0], headers, body
+
+    async def _route(self, method, path, headers, body):
+        if path == self.path:
+            if method != 'POST':
+                return HTTPStatus.METHOD_NOT_ALLOWED, b''
+            return await self._receive_update(headers, body)
+        if path == '/healthz':
+            return HTTPStatus.OK, b'ok'
+        if path == '/readyz':
+            if await self._ready():
+                return HTTPStatus.OK, b'ready'
+            return HTTPStatus.SERVICE_UNAVAILABLE, b'not ready'
+        return HTTPStatus.NOT_FOUND, b''
+
+    async def _receive_update(self, headers, body):
+        if self.secret_token and not hmac.compare_digest(
+            headers.get(SECRET_TOKEN_HEADER, '').encode(), self.secret_token.encode()
+        ):
+            self.rejected += 1
+            logger.warning("Rejected webhook request with a missing or wrong secret token.")
+            return HTTPStatus.FORBIDDEN, b''
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.warning(f"Rejected malformed webhook update: {e}")
+            return HTTPStatus.BAD_REQUEST, b''
+        # Acknowledge right away; the Application processes the queue concurrently
+        await self.application.update_queue.put(update)
+        self.received += 1
+        return HTTPStatus.OK, b''
+
+    async def _ready(self):
+        if self.stopping or not self.application.running:
+            return False
+        if self.ready_check is None:
+            return True
+        try:
+            return await self.ready_check() is not False
+        except Exception as e:
+            logger.warning(f"Readiness check failed: {e}")
+            return False
+
+    @staticmethod
+    def _write_response(writer, status, body, keep_alive):
+        status = HTTPStatus(status)
+        head = (
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + body)
+
+    def stats(self):
+        """Updates received and requests rejected for a bad secret token."""
+        return {'received': self.received, 'rejected': self.rejected}
+
+async def _serve(application, server, url=None, secret_token=None, max_connections=MAX_CONNECTIONS):
+    # The same lifecycle as Application.run_polling, with the webhook server in place of the updater
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        await server.start()
+        if url:
+            # Registered with the worker's own bot, once it is listening for the first delivery
+            await _set_webhook(application.bot, url, secret_token, max_connections)
+        await stop.wait()
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        logger.info("Webhook server stopped", extra=server.stats())
+
+def _run_worker(build_application, path, secret_token, listen, port, workers, ready_check, cleanup, url=None,
+                max_connections=MAX_CONNECTIONS, index=0):
+    metrics.configure(port_offset=index)
+    if workers > 1:
+        # Other processes change balances too, so don't serve them from memory,
+        # and split Telegram's global send limit between the workers
+        user_cache.configure(max_users=0, flush_interval=0)
+        conversation.configure(max_conversations=0)
+        persistence.configure(update_interval=1.0, shared=True)
+        outbound.configure(
+            global_rate=outbound.GLOBAL_RATE / workers,
+            global_burst=max(1, outbound.GLOBAL_BURST // workers),
+        )
+        profiler.configure(socket_suffix=f'.{index}')  # One control socket per worker
+    application = build_application()
+    server = WebhookServer(application, path, secret_token, listen, port, reuse_port=workers > 1, ready_check=ready_check)
+    try:
+        # Only the first worker registers the webhook
+        asyncio.run(_serve(application, server, url if index == 0 else None, secret_token, max_connections))
+    finally:
+        if cleanup is not None:
+            cleanup()
+
+async def _set_webhook(bot, url, secret_token, max_connections):
+    await bot.set_webhook(
+        url,
+        secret_token=secret_token,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=max_connections,
+    )
+    logger.info("Webhook registered", extra={'url': url})
+
+def run(build_application, url=None, secret_token=None, path=WEBHOOK_PATH, listen=LISTEN, port=PORT,
+        workers=1, ready_check=None, cleanup=None, max_connections=MAX_CONNECTIONS):
+    """
+    Serve the bot over a webhook until SIGINT/SIGTERM.
+
+    `build_application` is a module-level function returning a configured
+    Application; with workers > 1 every worker process calls it. If `url` (the
+    public base URL) is given, the first worker registers the webhook with
+    Telegram once it is serving.
+    `ready_check` is an optional coroutine function for /readyz, and `cleanup`
+    runs in each worker after it stops. Both must be module-level functions.
+    """
+    url = url.rstrip('/') + path if url else None
+    worker_args = (build_application, path, secret_token, listen, port, workers, ready_check, cleanup, url, max_connections)
+    if workers <= 1:
+        _run_worker(*worker_args)
+        return
+
+    # Spawned, not forked, so workers don't inherit open database connections or threads
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=_run_worker, args=worker_args + (n,), name=f"webhook-worker-{n}")
+                 for n in range(workers)]
+    for process in processes:
+        process.start()
+    logger.info("Started webhook workers", extra={'workers': workers, 'port': port})
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                process.terminate()  # SIGTERM, which each worker handles with a clean stop
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+        if process.exitcode:
+            logger.error(f"{process.name} exited with code {process.exitcode}.")